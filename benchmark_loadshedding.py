@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Benchmarks of schedule parsing, evaluation, configuration loading and a
+full `main()` run against a local stub stage API.
+
+Results are written as JSON, to track regressions across releases on the
+target hardware:
+
+    python3 benchmark_loadshedding.py --output benchmark.json
+"""
+import argparse
+import datetime
+import http.server
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+import timeit
+
+import configuration
+import loadshedding
+import lutils.lcsv
+
+SCHEDULES = {
+    'city_of_cape_town': 'schedules/load_shedding_city_of_cape_town.csv',
+    'city_power': 'schedules/load_shedding_city_power.csv',
+    'tshwane': 'schedules/load_shedding_tshwane.csv',
+}
+
+
+def measure(fn, repeat: int, number: int):
+    """Times fn
+
+    Args:
+        fn (callable): Function without arguments to time
+        repeat (int): Number of measurements
+        number (int): Calls of fn per measurement
+
+    Returns:
+        [dict]: The settings, and the best and median time per call, in
+            seconds
+    """
+    times = [t / number for t in
+             timeit.repeat(fn, repeat=repeat, number=number)]
+    return {
+        'repeat': repeat,
+        'number': number,
+        'best_s': min(times),
+        'median_s': statistics.median(times),
+    }
+
+
+class StubServer():
+    """A local stub of the stage API, serving body in a thread"""
+
+    def __init__(self, body: bytes):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/'
+        threading.Thread(target=self.httpd.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def bench_read_csv(results: dict, repeat: int):
+    transforms = {
+        'stage': lambda x: int(x)
+    }
+    for name, path in SCHEDULES.items():
+        results[f'read_csv[{name}]'] = measure(
+            lambda: lutils.lcsv.read_csv(path, transforms=transforms,
+                                         delimiter=';'),
+            repeat, 20)
+        results[f'compile_schedule[{name}]'] = measure(
+            lambda: loadshedding.compile_schedule(path), repeat, 20)
+
+
+def bench_evaluation(results: dict, repeat: int, directory: str):
+    path = os.path.join(directory, 'schedule.csv')
+    shutil.copy(SCHEDULES['city_power'], path)
+    schedule = loadshedding.read_schedule(path)
+    results['read_schedule[cached]'] = measure(
+        lambda: loadshedding.read_schedule(path), repeat, 20)
+
+    configuration_user = {'AREA': '8', 'PAD_START': 17, 'IGNORE_END': 30}
+    date_start = datetime.datetime(2021, 7, 1)
+    minutes = [date_start + datetime.timedelta(minutes=m)
+               for m in range(31 * 24 * 60)]
+
+    def month(fn):
+        def run():
+            for minute in minutes:
+                fn(4, schedule, configuration_user, minute)
+        return run
+
+    for fn in (loadshedding.check_shedding, loadshedding.blocks_shedding):
+        result = measure(month(fn), repeat, 1)
+        result['calls'] = len(minutes)
+        results[f'{fn.__name__}[month]'] = result
+
+    results['next_shedding_windows[month]'] = measure(
+        lambda: loadshedding.next_shedding_windows(
+            4, schedule, configuration_user, date_start, count=1000,
+            days=31),
+        repeat, 1)
+
+
+def bench_configuration(results: dict, repeat: int, directory: str,
+                        path_system: str, path_user: str):
+    for cache in (False, True):
+        results[f'read_configuration[cache={cache}]'] = measure(
+            lambda: (
+                configuration.read_configuration_system(path_system, cache),
+                configuration.read_configuration_user(path_user, cache),
+            ),
+            repeat, 20)
+
+
+def area_shed(schedule, stage: int, shed: bool, date_check):
+    """An area of schedule that is (not) shed at stage at date_check"""
+    for area in schedule.schedule.areas:
+        configuration_user = {'AREA': area, 'PAD_START': 17,
+                              'IGNORE_END': 30}
+        if loadshedding.check_shedding(
+                stage, schedule, configuration_user, date_check) == shed:
+            return area
+    raise RuntimeError('No such area')
+
+
+def bench_main(results: dict, repeat: int, directory: str,
+               configuration_system: dict, configuration_user: dict):
+    loadshedding.logger = logging.getLogger('benchmark')
+    loadshedding.logger_stage = logging.getLogger('benchmark_stage')
+
+    schedule = loadshedding.read_schedule(configuration_user['SCHEDULE_CSV'])
+    date_now = loadshedding.get_date_now()
+    scenarios = {
+        # Not shed at any stage, the stage is not queried
+        'not_shed': area_shed(schedule, schedule.schedule.n_stages, False,
+                              date_now),
+        # Shed, the stage is queried. The command runs once, after that the
+        # ran check cancels it
+        'shed': area_shed(schedule, schedule.schedule.n_stages, True,
+                          date_now),
+    }
+
+    server = StubServer(f'{schedule.schedule.n_stages + 1}'.encode())
+    try:
+        for scenario, area in scenarios.items():
+            for ttl in (0, 300):
+                c = configuration_user.as_dict()
+                c.update({
+                    'API_URL': server.url,
+                    'AREA': area,
+                    'HTTP_CACHE': os.path.join(directory, 'http_cache'),
+                    'HTTP_CACHE_TTL': ttl,
+                })
+                c = configuration.UserConfiguration.from_dict(c)
+
+                def run():
+                    try:
+                        loadshedding.main(
+                            configuration_system, c,
+                            loadshedding.logger, loadshedding.logger_stage)
+                    except SystemExit:
+                        pass
+
+                results[f'main[{scenario},http_cache_ttl={ttl}]'] = \
+                    measure(run, repeat, 10)
+    finally:
+        server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        '--output', type=str, default='benchmark.json',
+        help='Path of the JSON results file.'
+    )
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help='Number of measurements per benchmark.'
+    )
+    args = parser.parse_args()
+
+    # Run from the repository, the schedule paths are relative
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    logging.getLogger('benchmark').addHandler(logging.NullHandler())
+    logging.getLogger('benchmark').propagate = False
+    logging.getLogger('benchmark_stage').propagate = False
+
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path_system = os.path.join(directory, 'configuration_system.yaml')
+        path_user = os.path.join(directory, 'configuration_user.yaml')
+        with open(path_system, 'w') as f:
+            f.write(
+                "VERSION: '0.2.2'\n"
+                f"LOGSTAGE: '{directory}/stage.log'\n"
+                f"LOG: '{directory}/log.log'\n"
+                f"LOGRAN: '{directory}/ran.log'\n"
+                "NOTIFICATION_TIMEOUT: 0\n")
+        with open(path_user, 'w') as f:
+            f.write(
+                "VERSION: '0.2.2'\n"
+                "AREA: '8'\n"
+                "QUERY_MODE: DIRECT\n"
+                f"SCHEDULE_CSV: '{SCHEDULES['city_power']}'\n"
+                "API_URL: 'http://127.0.0.1:1/'\n"
+                "CMD: 'true'\n"
+                "GUI_NOTIFICATION: False\n"
+                "PAD_START: 17\n"
+                "IGNORE_END: 30\n"
+                "RAN_CHECK: True\n"
+                "SCHEDULE_CACHE: False\n")
+
+        bench_read_csv(results, args.repeat)
+        bench_evaluation(results, args.repeat, directory)
+        bench_configuration(results, args.repeat, directory,
+                            path_system, path_user)
+        bench_main(
+            results, args.repeat, directory,
+            configuration.read_configuration_system(path_system, False),
+            configuration.read_configuration_user(path_user, False))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    for name, result in results.items():
+        print(f'{name:<48} {result["best_s"] * 1e3:10.3f} ms')
+
+
+if __name__ == '__main__':
+    main()
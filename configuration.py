@@ -3,17 +3,391 @@ Simply library to
     (i)     read YAML configuration files
     (ii)    check their validity
 """
-import yaml
+import lutils.lcache
 
 
-class MissingKeyError(LookupError):
+class ConfigurationError(Exception):
+    """Raised when a configuration file is invalid
+
+    Args:
+        errors (str or list(str)): All problems found in the configuration
+            file
+    """
+
+    def __init__(self, errors):
+        if isinstance(errors, str):
+            errors = [errors]
+        self.errors = list(errors)
+        super().__init__('\n'.join(self.errors))
+
+
+class MissingKeyError(ConfigurationError, LookupError):
+    pass
+
+
+class VersionError(ConfigurationError, RuntimeError):
     pass
 
 
-class VersionError(RuntimeError):
+class InvalidValueError(ConfigurationError, ValueError):
     pass
 
 
+class Configuration():
+    """
+    A validated configuration, with a slot per known key.
+
+    Values can be read as attributes (configuration.PAD_START) or, like the
+    configuration dicts, by key (configuration['PAD_START']). Keys in the
+    configuration file that are not known are kept, and can only be read by
+    key.
+
+    Subclasses define the known keys:
+        KEYS (tuple(str)): Keys that must be present
+        DEFAULTS (dict): Optional keys, and their default values
+        TYPES (dict): Types (a type or tuple of types) of the values of keys
+        VERSION_MIN (str): Minimum version of the configuration file
+    """
+    __slots__ = ('VERSION', '_extra')
+    KEYS = ()
+    DEFAULTS = {}
+    TYPES = {}
+    VERSION_MIN = '0.0.0'
+    _known = frozenset(('VERSION',))
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._known = frozenset(cls.slots())
+
+    def __init__(self, configuration: dict):
+        extra = dict(configuration)
+        for key in self.slots():
+            if key in extra:
+                setattr(self, key, extra.pop(key))
+        self._extra = extra
+
+    @classmethod
+    def slots(cls):
+        """All known keys"""
+        return ('VERSION',) + tuple(cls.KEYS) + tuple(cls.DEFAULTS)
+
+    @classmethod
+    def schema(cls):
+        """A string that changes when the known keys or defaults change"""
+        return repr((cls.__name__, cls.slots(), cls.DEFAULTS,
+                     sorted(cls.TYPES), cls.VERSION_MIN))
+
+    @classmethod
+    def validate(cls, configuration: dict, path: str = ''):
+        """Checks configuration in a single pass, and collects all problems
+
+        Args:
+            configuration (dict): Configuration dictionary, with the defaults
+                applied
+            path (str): Path of the configuration file, for the messages
+
+        Returns:
+            [tuple(list, list, list)]: Messages of the version problems,
+                missing keys and invalid values
+        """
+        def version_split(version: str):
+            return tuple(int(x) for x in str(version).split('.'))
+
+        versions, missing, invalid = [], [], []
+        file_type = cls.__name__.replace('Configuration', '').lower()
+
+        if 'VERSION' not in configuration:
+            versions.append('VERSION not specified in configuration file')
+        else:
+            try:
+                if version_split(configuration['VERSION']) < \
+                        version_split(cls.VERSION_MIN):
+                    versions.append(
+                        'VERSION mismatch. '
+                        f'Expected: {cls.VERSION_MIN} - '
+                        f'Specified: {configuration["VERSION"]}')
+            except ValueError:
+                versions.append(
+                    f'Invalid VERSION {configuration["VERSION"]!r}')
+
+        for key in cls.KEYS:
+            if key not in configuration:
+                missing.append(
+                    f'{key} not in {file_type} '
+                    f'configuration file "{path}"')
+
+        for key, types in cls.TYPES.items():
+            if key not in configuration:
+                continue
+            if not isinstance(types, tuple):
+                types = (types,)
+            value = configuration[key]
+            # bool is a subclass of int, but True is not a number of minutes
+            if not isinstance(value, types) or \
+                    (isinstance(value, bool) and bool not in types):
+                invalid.append(
+                    f'{key} in {file_type} configuration file "{path}" '
+                    f'must be of type '
+                    f'{" or ".join(t.__name__ for t in types)}, '
+                    f'not {type(value).__name__}')
+
+        invalid.extend(
+            f'{message} in {file_type} configuration file "{path}"'
+            for message in cls.validate_values(configuration))
+
+        return versions, missing, invalid
+
+    @classmethod
+    def validate_values(cls, configuration: dict):
+        """Checks the values beyond their types, e.g. nested settings
+
+        Args:
+            configuration (dict): Configuration dictionary, with the defaults
+                applied
+
+        Returns:
+            [list(str)]: Messages of the invalid values
+        """
+        return []
+
+    @classmethod
+    def from_dict(cls, configuration: dict, path: str = ''):
+        """Validates configuration, and builds the configuration object
+
+        Args:
+            configuration (dict): Configuration dictionary, with uppercase
+                keys
+            path (str): Path of the configuration file, for the messages
+
+        Raises:
+            VersionError: Raised when VERSION is missing or too old
+            MissingKeyError: Raised when one or more keys are not present in
+                the configuration file
+            InvalidValueError: Raised when one or more values have the wrong
+                type
+            All are raised with the messages of all problems found.
+
+        Returns:
+            [Configuration]: The configuration
+        """
+        configuration = dict(configuration)
+        for key, value in cls.DEFAULTS.items():
+            if key not in configuration:
+                # Copy mutable defaults, so that configurations do not share
+                # them
+                configuration[key] = value.copy() \
+                    if isinstance(value, (list, dict)) else value
+
+        versions, missing, invalid = cls.validate(configuration, path)
+        errors = versions + missing + invalid
+        if versions:
+            raise VersionError(errors)
+        if missing:
+            raise MissingKeyError(errors)
+        if invalid:
+            raise InvalidValueError(errors)
+
+        return cls(cls.normalize(configuration))
+
+    @classmethod
+    def normalize(cls, configuration: dict):
+        """Converts validated values to the form the code uses"""
+        return configuration
+
+    def __getitem__(self, key):
+        if key in self._known:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        return self._extra[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def as_dict(self):
+        """The configuration as a dict"""
+        configuration = {
+            key: getattr(self, key) for key in self.slots()
+            if hasattr(self, key)
+        }
+        configuration.update(self._extra)
+        return configuration
+
+    def __repr__(self):
+        return repr(self.as_dict())
+
+
+class SystemConfiguration(Configuration):
+    KEYS = ('LOGSTAGE', 'LOG', 'LOGRAN', 'NOTIFICATION_TIMEOUT')
+    DEFAULTS = {
+        'TIMINGS': False,
+        'TIMINGS_LOG': None,
+        'METRICS_PORT': None,
+        'METRICS_ADDRESS': '127.0.0.1',
+        'STAGE_PROXY_PORT': 8080,
+        'STAGE_PROXY_ADDRESS': '127.0.0.1',
+        'STAGE_PROXY_TTL': 60,
+    }
+    TYPES = {
+        'LOGSTAGE': str,
+        'LOG': str,
+        'LOGRAN': str,
+        'NOTIFICATION_TIMEOUT': (int, float),
+        'TIMINGS': bool,
+        'TIMINGS_LOG': (str, type(None)),
+        'METRICS_PORT': (int, type(None)),
+        'METRICS_ADDRESS': str,
+        'STAGE_PROXY_PORT': int,
+        'STAGE_PROXY_ADDRESS': str,
+        'STAGE_PROXY_TTL': (int, float),
+    }
+    VERSION_MIN = '0.2.2'
+    __slots__ = KEYS + tuple(DEFAULTS)
+
+
+class UserConfiguration(Configuration):
+    KEYS = (
+        'API_URL', 'AREA', 'QUERY_MODE', 'CMD',
+        'SCHEDULE_CSV', 'PAD_START', 'IGNORE_END',
+        'RAN_CHECK',
+    )
+    DEFAULTS = {
+        'GUI_NOTIFICATION': False,
+        'CMD_TIMEOUT': None,
+        'PRE_SHUTDOWN_HOOKS': [],
+        'PRE_SHUTDOWN_TIMEOUT': 30,
+        'PRE_SHUTDOWN_DEADLINE': 60,
+        'PRE_SHUTDOWN_WITH_NOTIFICATION': True,
+        'SCHEDULE_CACHE': True,
+        'HTTP_CACHE': 'http_cache',
+        'HTTP_CACHE_TTL': 0,
+        'HTTP_CACHE_STALE_IF_ERROR': 0,
+        'RETRY': {},
+        'STAGE_SOURCES': [],
+        'STAGE_QUORUM': 1,
+        'STAGE_TIMELINE': 'stage_timeline.cache',
+        'STAGE_TIMELINE_DAYS': 7,
+        'POLL_INTERVAL': 300,
+        'STAGE_SUBSCRIBE': None,
+        'STAGE_SUBSCRIBE_WAIT': 60,
+    }
+    TYPES = {
+        'API_URL': str,
+        'AREA': (str, int),
+        'QUERY_MODE': str,
+        'CMD': str,
+        'SCHEDULE_CSV': str,
+        'PAD_START': int,
+        'IGNORE_END': int,
+        'RAN_CHECK': bool,
+        'GUI_NOTIFICATION': bool,
+        'CMD_TIMEOUT': (int, float, type(None)),
+        'PRE_SHUTDOWN_HOOKS': list,
+        'PRE_SHUTDOWN_TIMEOUT': (int, float, type(None)),
+        'PRE_SHUTDOWN_DEADLINE': (int, float, type(None)),
+        'PRE_SHUTDOWN_WITH_NOTIFICATION': bool,
+        'SCHEDULE_CACHE': bool,
+        'HTTP_CACHE': (str, type(None)),
+        'HTTP_CACHE_TTL': (int, float),
+        'HTTP_CACHE_STALE_IF_ERROR': (int, float),
+        'RETRY': dict,
+        'STAGE_SOURCES': list,
+        'STAGE_QUORUM': int,
+        'STAGE_TIMELINE': (str, type(None)),
+        'STAGE_TIMELINE_DAYS': (int, float),
+        'POLL_INTERVAL': (int, float),
+        'STAGE_SUBSCRIBE': (str, type(None)),
+        'STAGE_SUBSCRIBE_WAIT': (int, float),
+    }
+    VERSION_MIN = '0.2.2'
+    __slots__ = KEYS + tuple(DEFAULTS)
+
+    # QUERY_MODEs of the STAGE_SOURCES
+    QUERY_MODES = ('direct', 'loadshedding_thingamabob')
+
+    @classmethod
+    def validate_values(cls, configuration: dict):
+        # Only import when needed, the validated configuration is cached
+        import lutils.lretry
+
+        invalid = []
+        retry = configuration.get('RETRY')
+        if isinstance(retry, dict):
+            for key, value in retry.items():
+                if str(key).lower() not in lutils.lretry.SETTINGS:
+                    invalid.append(f'Unknown RETRY setting {key}')
+                elif isinstance(value, bool) or \
+                        not isinstance(value, (int, float)):
+                    invalid.append(f'RETRY {key} must be a number')
+
+        sources = configuration.get('STAGE_SOURCES')
+        if isinstance(sources, list):
+            for i, source in enumerate(sources):
+                if not isinstance(source, dict):
+                    invalid.append(
+                        f'STAGE_SOURCES entry {i} must have API_URL and '
+                        f'QUERY_MODE')
+                    continue
+                source = {str(k).upper(): v for k, v in source.items()}
+                for key in sorted(set(source) - {'API_URL', 'QUERY_MODE'}):
+                    invalid.append(
+                        f'Unknown STAGE_SOURCES entry {i} setting {key}')
+                if not isinstance(source.get('API_URL'), str):
+                    invalid.append(
+                        f'STAGE_SOURCES entry {i} API_URL must be a str')
+                mode = source.get('QUERY_MODE')
+                if not isinstance(mode, str) or \
+                        mode.lower() not in cls.QUERY_MODES:
+                    invalid.append(
+                        f'STAGE_SOURCES entry {i} QUERY_MODE must be one of '
+                        f'{", ".join(m.upper() for m in cls.QUERY_MODES)}')
+
+        hooks = configuration.get('PRE_SHUTDOWN_HOOKS')
+        if isinstance(hooks, list):
+            for i, hook in enumerate(hooks):
+                if isinstance(hook, str):
+                    continue
+                if not isinstance(hook, dict):
+                    invalid.append(
+                        f'PRE_SHUTDOWN_HOOKS entry {i} must be a command, or '
+                        f'have CMD and optionally TIMEOUT')
+                    continue
+                hook = {str(k).upper(): v for k, v in hook.items()}
+                for key in sorted(set(hook) - {'CMD', 'TIMEOUT'}):
+                    invalid.append(
+                        f'Unknown PRE_SHUTDOWN_HOOKS entry {i} setting {key}')
+                if not isinstance(hook.get('CMD'), str):
+                    invalid.append(
+                        f'PRE_SHUTDOWN_HOOKS entry {i} CMD must be a str')
+                timeout = hook.get('TIMEOUT')
+                if timeout is not None and (
+                        isinstance(timeout, bool) or
+                        not isinstance(timeout, (int, float)) or
+                        timeout < 0):
+                    invalid.append(
+                        f'PRE_SHUTDOWN_HOOKS entry {i} TIMEOUT must be a '
+                        f'number >= 0')
+        return invalid
+
+    @classmethod
+    def normalize(cls, configuration: dict):
+        # The schedule areas are strings, convert once instead of on every
+        # comparison
+        configuration['AREA'] = str(configuration['AREA'])
+        return configuration
+
+
 def read_configuration(path: str):
     """Reads the YAML configuration file at path and converts all keys to uppercase
 
@@ -23,6 +397,9 @@ def read_configuration(path: str):
     Returns:
         [dict]: Configuration dictionary
     """
+    # Only import when needed, it is relatively slow to import
+    import yaml
+
     with open(path, 'r') as f:
         configuration = yaml.safe_load(f)
     configuration = {k.upper(): v for k, v in configuration.items()}
@@ -30,83 +407,63 @@ def read_configuration(path: str):
     return configuration
 
 
-def read_configuration_and_check(
-        path: str, keys: list, configuration_file_type, version: str):
-    """Reads the YAML configuration file at path and
-    check that all all keys are present in the configuration file
+def read_configuration_cached(path: str, cls, cache: bool = True):
+    """Reads and validates a configuration file into a cls object
+
+    The validated object is cached next to the configuration file (as
+    <path>.cache), keyed by the file's modification time and contents, so
+    that on the common path neither the YAML parser is imported nor the
+    configuration validated again.
 
     Args:
         path (str): Path to YAML configuration file
-        keys (list): List of keys that must be present
-        configuration_file_type (str): Type of configuration file read
-        version (str): Expected version
+        cls (type): Configuration subclass
+        cache (bool, optional): Use the cache
 
     Raises:
         FileNotFoundError: Raised when the file at path does not exist
-        MissingKeyError: Raised when one or more keys are not present in the
-            configuration file
+        ConfigurationError: Raised when the configuration file is invalid
 
     Returns:
-        [dict]: Configuration dictionary
+        [Configuration]: The configuration
     """
-    def version_split(version: str):
-        return tuple(int(x) for x in version.split('.'))
-
-    configuration = read_configuration(path)
-
-    for key in keys:
-        if 'VERSION' not in configuration:
-            raise VersionError('VERSION not specified in configuration file')
-        if version_split(configuration['VERSION']) < version_split(version):
-            raise VersionError(
-                'VERSION mismatch. '
-                f'Expected: {version} - Specified: {configuration["VERSION"]}'
-            )
-        if key not in configuration:
-            raise MissingKeyError(
-                f'{key} not in {configuration_file_type} '
-                'configuration file "{path}"')
+    def build(path):
+        return cls.from_dict(read_configuration(path), path)
 
-    return configuration
+    if not cache:
+        return build(path)
+    return lutils.lcache.load(path, build, tag=cls.schema())
 
 
-def read_configuration_system(path):
+def read_configuration_system(path, cache: bool = True):
     """Reads and validates a system configuration file
 
     Args:
         path (str): Path to YAML configuration file
+        cache (bool, optional): Use the cache of the validated configuration
 
     Raises:
         FileNotFoundError: Raised when the file at path does not exist
-        MissingKeyError: Raised when one or more keys are not present in the
-            configuration file
+        ConfigurationError: Raised when the configuration file is invalid
 
     Returns:
-        [dict]: System configuration dictionary
+        [SystemConfiguration]: System configuration
     """
-    keys = ['LOGSTAGE', 'LOG', 'LOGRAN', 'NOTIFICATION_TIMEOUT']
-    version = '0.2.2'
-    return read_configuration_and_check(path, keys, 'system', version)
+    return read_configuration_cached(path, SystemConfiguration, cache)
 
 
-def read_configuration_user(path):
+def read_configuration_user(path, cache: bool = True):
     """Reads and validates a user configuration file
 
     Args:
         path (str): Path to YAML configuration file
+        cache (bool, optional): Use the cache of the validated configuration
 
     Raises:
         FileNotFoundError: Raised when the file at path does not exist
-        MissingKeyError: Raised when one or more keys are not present in the
-            configuration file
+        ConfigurationError: Raised when the configuration file is invalid
 
     Returns:
-        [dict]: System configuration dictionary
+        [UserConfiguration]: User configuration
     """
-    keys = [
-        'API_URL', 'AREA', 'QUERY_MODE', 'CMD',
-        'SCHEDULE_CSV', 'PAD_START', 'IGNORE_END',
-        'RAN_CHECK',
-    ]
-    version = '0.2.2'
-    return read_configuration_and_check(path, keys, 'user', version)
+    return read_configuration_cached(path, UserConfiguration, cache)
@@ -1,21 +1,83 @@
 #!/usr/bin/env python3
 import logging
-import logging.handlers
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+import functools
+import heapq
+import itertools
 import os
-import urllib.request
-import json
-import pathlib
-import zoneinfo
+import time
 
 import configuration
-import lutils.lcsv
+import lutils.lcache
+import lutils.lindex
+import lutils.lschedule
+import lutils.lstate
+import lutils.ltiming
+
+# Modules that are only needed on some paths (e.g. querying the stage, or a
+# cache miss) are imported where they are used, to keep the startup of the
+# per-minute cron job short
+
+# South Africa Standard Time, South Africa does not observe daylight saving
+# time. Cheaper than loading the 'Africa/Johannesburg' zoneinfo every run
+SAST = timezone(timedelta(hours=2), 'SAST')
+
+
+# Metrics of the daemon, see Metrics. None if not enabled
+metrics = None
+
+
+class StageQueryError(RuntimeError):
+    pass
+
+
+class Metrics():
+    """
+    The metrics exposed by the daemon, in the Prometheus text format
+
+    Attributes:
+        registry (lutils.lmetrics.Registry): All metrics
+    """
+
+    def __init__(self):
+        import lutils.lmetrics
+
+        self.registry = lutils.lmetrics.Registry()
+        self.stage = self.registry.gauge(
+            'loadshedding_stage', 'Current loadshedding stage')
+        self.shedding = self.registry.gauge(
+            'loadshedding_shedding',
+            '1 if the configured area is being shed, 0 otherwise')
+        self.window_start = self.registry.gauge(
+            'loadshedding_next_window_start_timestamp_seconds',
+            'Start of the next (or current) shedding window, including '
+            'PAD_START, as a unix timestamp')
+        self.fetch_seconds = self.registry.histogram(
+            'loadshedding_stage_fetch_duration_seconds',
+            'Duration of the stage API requests')
+        self.fetch_last_seconds = self.registry.gauge(
+            'loadshedding_stage_fetch_last_duration_seconds',
+            'Duration of the last stage API request')
+        self.fetch_errors = self.registry.counter(
+            'loadshedding_stage_fetch_errors_total',
+            'Number of failed stage API requests')
+        self.evaluation_seconds = self.registry.histogram(
+            'loadshedding_evaluation_duration_seconds',
+            'Duration of the schedule evaluations (check_shedding)')
+
+    def serve(self, port: int, address: str = '127.0.0.1'):
+        import lutils.lmetrics
+
+        return lutils.lmetrics.serve(self.registry, port, address)
 
 
 def main(
         configuration_system: dict, configuration_user: dict,
-        logger: logging.Logger, logger_stage: logging.Logger
+        logger: logging.Logger, logger_stage: logging.Logger,
+        timings: lutils.ltiming.Timings = None
 ):
+    if timings is None:
+        timings = lutils.ltiming.Timings()
     if configuration_user['GUI_NOTIFICATION']:
         # This is re-imported in lutils.tktimeoutdialog, if
         # GUI_NOTIFICATION is enabled, and the system needs to shutdown.
@@ -32,52 +94,80 @@ def main(
         f'configuration_user={configuration_user} '
     )
 
-    # Get the current datetime in the 'Africa/Johannesburg' timezone
-    # But remove the timezone info, since the rest of the script is not timezone aware
-    date_now = datetime.now(tz=zoneinfo.ZoneInfo('Africa/Johannesburg')).replace(tzinfo=None)
+    date_now = get_date_now()
+    ran = None
+    # Emit the timings on all paths, including exit()
+    try:
+        with timings.phase('schedule'):
+            schedule = read_schedule(
+                configuration_user['SCHEDULE_CSV'],
+                cache=configuration_user['SCHEDULE_CACHE'])
 
-    if configuration_user['QUERY_MODE'].lower() == 'direct':
-        stage_current = get_stage_direct(configuration_user['API_URL'])
-    elif configuration_user['QUERY_MODE'].lower() == \
-            'loadshedding_thingamabob':
-        response = get_stage_schedule(configuration_user['API_URL'])
-        logger_stage.info(f'{response}')
-
-        # Build schedule
-        import loadshedding_thingamabob.schedule
-        response_d = json.loads(response)
-        stage_schedule_csv = response_d['schedule_csv']
-        stage_schedule = \
-            loadshedding_thingamabob.schedule.Schedule.from_string(
-                stage_schedule_csv,
-                timezone=response_d['timezone'] if 'timezone' in response_d else 'Africa/Johannesburg',
-            )
-        logger.info(f'stage_schedule:\n{stage_schedule}')
+        # Fast path: if the area is not shed even at the highest stage, the
+        # current stage does not matter and need not be queried. LOGSTAGE
+        # then only marks the run, see lutils.lreplay.StageHistory
+        with timings.phase('evaluation'):
+            shed_any = check_shedding(
+                schedule.schedule.n_stages, schedule, configuration_user,
+                date_now)
+        if not shed_any:
+            logger.info('not shed at any stage, stage not queried')
+            # lutils.lreplay.SKIPPED, not imported to keep the start fast
+            logger_stage.info('skipped')
+            stage_current = 0
+        else:
+            try:
+                with timings.phase('stage'):
+                    stage_current = get_stage_current(
+                        configuration_user, date_now)
+            except StageQueryError:
+                exit()
+            logger.info(f'stage_current: {stage_current}')
 
-        # Get current stage
-        date_soon = date_now + timedelta(minutes=configuration_user['PAD_START'])
-        date_soon = date_soon.replace(tzinfo=zoneinfo.ZoneInfo('Africa/Johannesburg'))
-        stage_current = stage_schedule.stage(date_soon)
-    logger.info(f'stage_current: {stage_current}')
+        ran = run_shedding(
+            configuration_system, configuration_user, logger,
+            stage_current, schedule, date_now, timings=timings
+        )
+    finally:
+        timings.emit(event='timings', date=date_now, ran=ran)
+    if ran:
+        exit()
+    return ran
 
-    transforms = {
-        'stage': lambda x: int(x)
-    }
-    schedule = lutils.lcsv.read_csv(configuration_user['SCHEDULE_CSV'],
-                                    transforms=transforms,
-                                    delimiter=';')
 
-    shedding = check_shedding(
-        stage_current, schedule,
-        configuration_user,
-        date_now
-    )
+def run_shedding(
+        configuration_system: dict, configuration_user: dict,
+        logger: logging.Logger, stage_current: int, schedule,
+        date_now: datetime, timings: lutils.ltiming.Timings = None
+):
+    """Runs CMD if shedding, unless overridden by the ran check or the user
+
+    Args:
+        timings (Timings, optional): Records the durations of the evaluation,
+            ran check, notification and command phases
 
+    Returns:
+        [bool or None]: False if not shedding, None if cancelled by the ran
+            check, True if the command was executed or cancelled by the user
+    """
+    if timings is None:
+        timings = lutils.ltiming.Timings()
+
+    with timings.phase('evaluation'):
+        shedding = check_shedding(
+            stage_current, schedule,
+            configuration_user,
+            date_now
+        )
+
+    store = lutils.lstate.StateStore(configuration_system['LOGRAN'])
     if not shedding:
         try:
-            if (configuration_user['RAN_CHECK']):
-                if os.path.exists(configuration_system['LOGRAN']):
-                    os.remove(configuration_system['LOGRAN'])
+            with timings.phase('ran_check'):
+                if (configuration_user['RAN_CHECK']) and \
+                        os.path.exists(store.path):
+                    with store.lock():
+                        store.clear()
         except Exception as e:
             logger.exception(e)
         logger.info('status: not shedding any loads')
@@ -88,52 +178,53 @@ def main(
     #   expected behaviour (e.g. running the command)
     override_ran = False
     try:
-        if (configuration_user['RAN_CHECK']):
-            if os.path.exists(configuration_system['LOGRAN']):
-                with open(configuration_system['LOGRAN'], 'r') as f:
-                    area_ran, datetime_ran, stage_ran = \
-                        f.read().strip().split(';')
-                area_ran = str(area_ran)
-                datetime_ran = datetime.fromisoformat(datetime_ran)
-                stage_ran = int(stage_ran)
-
-                blocks_ran = set(blocks_shedding(
-                    stage_ran, schedule,
-                    configuration_user,
-                    datetime_ran
-                ))
-                blocks_current = set(blocks_shedding(
-                    stage_current, schedule,
-                    configuration_user,
-                    date_now
-                ))
-
-                # Dont run the loadshedding command if:
-                # (1) the area is the same and
-                # (2) there is some overlap between the blocks for which the
-                #   command previously ran and the current triggered blocks
-                # (3) And the difference between the previous trigger and this
-                #   trigger is less than a day. This handles cases where the
-                #   device is only turned on on the same day of the following
-                #   month and it is still loadshedding
-                if (area_ran == str(configuration_user['AREA']) and
-                            blocks_ran.intersection(blocks_current) and
-                            (date_now - datetime_ran < timedelta(days=1))
-                        ):
-                    override_ran = True
-
-            if not override_ran:
-                with open(configuration_system['LOGRAN'], 'w') as f:
-                    f.write(
-                        f'{configuration_user["AREA"]}'
-                        f';{date_now.isoformat()}'
-                        f';{stage_current}'
-                    )
+        with timings.phase('ran_check'):
+            if (configuration_user['RAN_CHECK']):
+                # Read, decide and write under the lock, so that concurrent
+                # runs do not both run the command
+                with store.lock():
+                    state = store.read()
+                    blocks_current = frozenset(blocks_shedding(
+                        stage_current, schedule,
+                        configuration_user,
+                        date_now
+                    ))
+
+                    if state is not None:
+                        blocks_ran = state.blocks
+                        if blocks_ran is None:
+                            # Written by an older version, without the blocks
+                            blocks_ran = frozenset(blocks_shedding(
+                                state.stage, schedule,
+                                configuration_user,
+                                state.date
+                            ))
+
+                        # Dont run the loadshedding command if:
+                        # (1) the area is the same and
+                        # (2) there is some overlap between the blocks for
+                        #   which the command previously ran and the current
+                        #   triggered blocks
+                        # (3) And the difference between the previous trigger
+                        #   and this trigger is less than a day. This handles
+                        #   cases where the device is only turned on on the
+                        #   same day of the following month and it is still
+                        #   loadshedding
+                        if (state.area == str(configuration_user['AREA']) and
+                                    not blocks_ran.isdisjoint(blocks_current) and
+                                    (date_now - state.date < timedelta(days=1))
+                                ):
+                            override_ran = True
+
+                    if not override_ran:
+                        store.write(lutils.lstate.RanState(
+                            configuration_user['AREA'], date_now,
+                            stage_current, blocks_current))
     except Exception as e:
         logger.exception(e)
 
     if override_ran:
-        message = f'Cancelled by override ran check ({datetime_ran})'
+        message = f'Cancelled by override ran check ({state.date})'
         logger.info(message)
         return
 
@@ -142,10 +233,31 @@ def main(
         configuration_user['CMD'])
     logger.info(message)
 
+    def start_hooks_or_skip():
+        # The ran state is already written, a failure of the hooks must not
+        # keep CMD from running
+        try:
+            return start_hooks(
+                configuration_user, logger, stage_current, schedule)
+        except Exception as e:
+            logger.exception(e)
+            logger.error('Skipping the pre-shutdown hooks')
+            return None
+
+    hook_run = None
     if configuration_user['GUI_NOTIFICATION']:
-        override_gui, reason = get_override_status(
-            configuration_system['NOTIFICATION_TIMEOUT'],
-            "Loadshedding imminent!")
+        if configuration_user['PRE_SHUTDOWN_WITH_NOTIFICATION']:
+            # Prepare while the dialog counts down, instead of after it
+            hook_run = start_hooks_or_skip()
+        try:
+            with timings.phase('notification'):
+                override_gui, reason = get_override_status(
+                    configuration_system['NOTIFICATION_TIMEOUT'],
+                    "Loadshedding imminent!")
+        except BaseException:
+            if hook_run is not None:
+                hook_run.cancel()
+            raise
     else:
         override_gui, reason = False, None
 
@@ -154,61 +266,621 @@ def main(
             reason,
             configuration_user['CMD'])
         logger.info(message)
+        if hook_run is not None:
+            hook_run.cancel()
+            log_hooks(hook_run, logger)
     else:
         message = 'Executing loadshedding cmd "{}"'.format(
             configuration_user['CMD'])
         logger.info(message)
 
-        os.system(configuration_user['CMD'])
-    exit()
+        if hook_run is None:
+            hook_run = start_hooks_or_skip()
+        run_command(configuration_user, logger, hook_run, timings)
+    return True
 
 
-def check_row(row, date_now, tomorrow, configuration_user):
-    start = time_to_min(row['start'])
-    end = time_to_min(row['end'])
-    now = time_to_min("{}:{}".format(date_now.hour, date_now.minute))
-    # The schedule, and therefore the csv,
-    # loops over to 00:30 for the next morning.
-    # We wanna compare fairly
-    if end < start:
-        end += 24*60
+def start_hooks(configuration_user: dict, logger: logging.Logger,
+                stage_current: int, schedule):
+    """Starts the PRE_SHUTDOWN_HOOKS concurrently, in the background
+
+    The hooks must finish within PRE_SHUTDOWN_DEADLINE seconds, and before the
+    power goes off if it is still on.
+
+    Returns:
+        [lutils.lcommand.HookRun or None]: The running hooks, None if there
+            are none
+    """
+    import lutils.lcommand
+
+    hooks = []
+    for hook in configuration_user['PRE_SHUTDOWN_HOOKS']:
+        try:
+            hooks.append(lutils.lcommand.Hook.from_configuration(
+                hook, configuration_user['PRE_SHUTDOWN_TIMEOUT']))
+        except ValueError as e:
+            logger.error(str(e))
+    if not hooks:
+        return None
+
+    deadline = configuration_user['PRE_SHUTDOWN_DEADLINE']
+    date_now = get_date_now()
+    windows = next_shedding_windows(
+        stage_current, schedule,
+        {'AREA': configuration_user['AREA'], 'PAD_START': 0,
+         'IGNORE_END': 0},
+        date_now, count=1, days=1)
+    if windows and windows[0][0] > date_now:
+        deadline = min(
+            deadline, (windows[0][0] - date_now).total_seconds())
+    return lutils.lcommand.HookRun(hooks, deadline)
+
+
+def log_hooks(hook_run, logger: logging.Logger):
+    """Waits for the hooks, and logs the outcome of each"""
+    for result in hook_run.wait():
+        if result.ok:
+            logger.info(f'Pre-shutdown hook {result}')
+        else:
+            logger.warning(f'Pre-shutdown hook {result}')
+
+
+def run_command(configuration_user: dict, logger: logging.Logger,
+                hook_run, timings: lutils.ltiming.Timings):
+    """Waits for the pre-shutdown hooks, then runs CMD
+
+    CMD runs even if hooks failed.
+
+    Args:
+        hook_run (lutils.lcommand.HookRun or None): The running hooks, see
+            start_hooks
+    """
+    import lutils.lcommand
+
+    if hook_run is not None:
+        with timings.phase('hooks'):
+            log_hooks(hook_run, logger)
+
+    with timings.phase('command'):
+        result = lutils.lcommand.run_command(
+            configuration_user['CMD'], configuration_user['CMD_TIMEOUT'])
+    if result.ok:
+        logger.info(f'Loadshedding cmd {result}')
+    else:
+        logger.error(f'Loadshedding cmd {result}')
+    return result
+
+
+def get_next_wakeup(
+        stage_current, schedule, configuration_user, date_now, date_poll):
+    """Computes when the daemon should evaluate the schedule again
+
+    While shedding, the daemon wakes up every minute, like the cron job
+    would. Otherwise it sleeps until the next window starts (i.e. the start
+    minus PAD_START) or the next stage query is due, whichever is first.
+
+    Args:
+        stage_current (int): Loadshedding stage
+        schedule (ScheduleIndex or list(dict)): The schedule
+        configuration_user (dict): User configuration
+        date_now (datetime): Current time
+        date_poll (datetime): Time at which the next stage query is due
+
+    Returns:
+        [datetime]: Time to wake up
+    """
+    minute_next = date_now.replace(second=0, microsecond=0) + \
+        timedelta(minutes=1)
+    windows = next_shedding_windows(
+        stage_current, schedule, configuration_user, date_now, days=2)
+    if windows:
+        window_start, _, _ = windows[0]
+        if window_start <= date_now:
+            return minute_next
+        date_poll = min(date_poll, window_start)
+    return max(date_poll, date_now)
+
+
+def daemon(
+        configuration_system: dict, configuration_user: dict,
+        logger: logging.Logger, logger_stage: logging.Logger
+):
+    """Runs the loadshedding check continuously
+
+    The configuration and schedule are kept in memory. The stage is queried
+    every POLL_INTERVAL seconds, and the schedule is only evaluated when the
+    next window is due. If an evaluation fails, the error is logged, and the
+    daemon keeps the previous stage and tries again at the next poll. If a
+    response of the STAGE_SUBSCRIBE subscription fails, the subscription is
+    stopped, and the stage is polled instead.
+    """
+    if configuration_user['GUI_NOTIFICATION']:
+        # See main
+        import lutils.tktimeoutdialog as _
+    logger.info(
+        'Running loadshedding daemon: '
+        f'configuration_system={configuration_system} '
+        f'configuration_user={configuration_user} '
+    )
+
+    start_metrics(configuration_system, logger)
+
+    schedule = read_schedule(
+        configuration_user['SCHEDULE_CSV'],
+        cache=configuration_user['SCHEDULE_CACHE'])
+    poll_interval = timedelta(seconds=configuration_user['POLL_INTERVAL'])
+
+    subscriber = get_stage_subscriber(configuration_user, logger)
+
+    def sleep(seconds):
+        if subscriber is None or subscriber.stopped:
+            time.sleep(max(seconds, 0))
+        else:
+            # Wake up as soon as the stage changes
+            subscriber.wait(seconds)
+
+    stage_current = None
+    response = None
+    date_poll = get_date_now()
+    while True:
+        date_now = get_date_now()
+        # An error in one evaluation (e.g. a malformed response, or a failing
+        # command) must not stop the daemon
+        try:
+            if subscriber is not None and subscriber.connected:
+                # Only poll if the subscription breaks
+                changed = subscriber.body is not response
+                response = subscriber.body
+                try:
+                    stage_subscribed = get_stage_response(
+                        response, configuration_user, date_now)
+                except Exception as e:
+                    # E.g. a schedule without the area, that passed the
+                    # validation of the subscriber. Keep the previous stage,
+                    # and poll instead
+                    logger.exception(e)
+                    logger.warning('Stage subscription stopped, polling')
+                    subscriber.stop()
+                    subscriber = None
+                    date_poll = date_now
+                else:
+                    stage_current = stage_subscribed
+                    if changed:
+                        logger.info(f'stage_current: {stage_current}')
+                        # As logged by the stage queries
+                        if configuration_user['QUERY_MODE'].lower() == \
+                                'direct':
+                            logger_stage.info(f'{stage_current}')
+                        else:
+                            logger_stage.info(response.decode())
+                    if metrics is not None:
+                        metrics.stage.set(stage_current)
+                    date_poll = date_now + poll_interval
+            # Also query if the subscription is not connected and the poll is
+            # overdue, e.g. after resuming from hibernation
+            if (subscriber is None or not subscriber.connected) and \
+                    date_now >= date_poll:
+                date_poll = date_now + poll_interval
+                try:
+                    stage_current = get_stage_current(
+                        configuration_user, date_now)
+                    logger.info(f'stage_current: {stage_current}')
+                    if metrics is not None:
+                        metrics.stage.set(stage_current)
+                except StageQueryError:
+                    # Keep using the previous stage, if any
+                    pass
+                except Exception as e:
+                    # E.g. a malformed response, keep the previous stage too
+                    logger.exception(e)
+
+            if stage_current is None:
+                date_wakeup = date_poll
+            else:
+                ran = run_shedding(
+                    configuration_system, configuration_user, logger,
+                    stage_current, schedule, date_now
+                )
+
+                date_now = get_date_now()
+                if metrics is not None:
+                    metrics.shedding.set(0 if ran is False else 1)
+                    windows = next_shedding_windows(
+                        stage_current, schedule, configuration_user,
+                        date_now, days=2)
+                    metrics.window_start.set(
+                        windows[0][0].replace(tzinfo=SAST).timestamp()
+                        if windows else float('nan'))
+                date_wakeup = get_next_wakeup(
+                    stage_current, schedule, configuration_user, date_now,
+                    date_poll)
+        except Exception as e:
+            # Keep the previous stage, and try again at the next poll
+            logger.exception(e)
+            date_now = get_date_now()
+            if date_poll <= date_now:
+                date_poll = date_now + poll_interval
+            date_wakeup = date_poll
+        logger.debug(f'Sleeping until {date_wakeup}')
+        sleep((date_wakeup - date_now).total_seconds())
+
+
+def get_stage_subscriber(configuration_user: dict, logger: logging.Logger):
+    """A started subscription to the stage changes at API_URL, if
+    STAGE_SUBSCRIBE is set
+
+    Returns:
+        [lutils.lsubscribe.Subscriber or None]: The subscriber
+    """
+    import json
+    import lutils.lsubscribe
+
+    mode = configuration_user['STAGE_SUBSCRIBE']
+    if not mode:
+        return None
+    if configuration_user['STAGE_SOURCES']:
+        logger.warning('STAGE_SUBSCRIBE is not used with STAGE_SOURCES')
+        return None
+    if mode.lower() == 'sse':
+        subscribe = lutils.lsubscribe.subscribe_sse
+    elif mode.lower() == 'long_poll':
+        subscribe = lutils.lsubscribe.subscribe_long_poll
+    else:
+        logger.error(f'Unknown STAGE_SUBSCRIBE {mode}, polling instead')
+        return None
+
+    if configuration_user['QUERY_MODE'].lower() == 'direct':
+        validate = parse_stage_direct
+    else:
+        validate = json.loads
+    return lutils.lsubscribe.Subscriber(
+        functools.partial(subscribe, configuration_user['API_URL'],
+                          configuration_user['STAGE_SUBSCRIBE_WAIT']),
+        validate=validate,
+        on_error=lambda e: logger.warning(f'Stage subscription: {e}'),
+    ).start()
+
+
+def get_stage_response(response: bytes, configuration_user: dict,
+                       date_now: datetime):
+    """The current stage, from a response of API_URL"""
+    if configuration_user['QUERY_MODE'].lower() == 'direct':
+        return parse_stage_direct(response)
+    timeline = get_stage_timeline(
+        response.decode(), configuration_user, date_now)
+    return timeline.stage(
+        date_now + timedelta(minutes=configuration_user['PAD_START']))
+
+
+def start_metrics(configuration_system: dict, logger: logging.Logger):
+    """Serves the metrics, if METRICS_PORT is set"""
+    global metrics
+    if configuration_system['METRICS_PORT'] is None:
+        return
+    metrics = Metrics()
+    metrics.serve(configuration_system['METRICS_PORT'],
+                  configuration_system['METRICS_ADDRESS'])
+    logger.info(
+        'Serving metrics on '
+        f'{configuration_system["METRICS_ADDRESS"]}:'
+        f'{configuration_system["METRICS_PORT"]}')
+
+
+def get_stage_proxy(configuration_user: dict, ttl: float,
+                    logger: logging.Logger):
+    """The single-flight fetch of the API_URL response, see serve_stage
+
+    Returns:
+        [lutils.lproxy.SingleFlight]: Gets the response body
+    """
+    import json
+    import lutils.lproxy
+    import lutils.lretry
+
+    api_url = configuration_user['API_URL']
+    # Validate as the clients will, so that an invalid response (e.g. the
+    # negative stages of the direct API) is not served for the TTL
+    if configuration_user['QUERY_MODE'].lower() == 'direct':
+        validate = parse_stage_direct
+    else:
+        validate = json.loads
+    http_cache = get_http_cache(configuration_user)
+    retry_policy = get_retry_policy(configuration_user)
+
+    def attempt(timeout):
+        body, source = fetch_stage_api(
+            api_url, timeout, http_cache, validate)
+        if source == 'stale':
+            logger.warning('API unavailable, serving cached response')
+        return body
+
+    def fetch():
+        try:
+            return retry_policy.call(
+                attempt, on_error=lambda e: logger.warning(str(e)))
+        except lutils.lretry.RetryError as e:
+            message = f'Failure calling API: {e}'
+            logger.error(message)
+            raise StageQueryError(message) from e
+
+    return lutils.lproxy.SingleFlight(fetch, ttl)
+
+
+def serve_stage(
+        configuration_system: dict, configuration_user: dict,
+        logger: logging.Logger
+):
+    """Serves the API_URL response to the hosts of a fleet, which set their
+    API_URL to the proxy
+
+    The upstream API is requested at most once per STAGE_PROXY_TTL seconds,
+    and concurrent requests wait for the same upstream request. The response
+    is passed on as is, so it works in both QUERY_MODEs.
+    """
+    import lutils.lproxy
+
+    logger.info(
+        'Running loadshedding stage proxy: '
+        f'configuration_system={configuration_system} '
+        f'configuration_user={configuration_user} '
+    )
+    start_metrics(configuration_system, logger)
+
+    if configuration_user['QUERY_MODE'].lower() == 'direct':
+        content_type = 'text/plain; charset=utf-8'
+    else:
+        content_type = 'application/json'
+    server = lutils.lproxy.make_server(
+        get_stage_proxy(configuration_user,
+                        configuration_system['STAGE_PROXY_TTL'], logger),
+        configuration_system['STAGE_PROXY_PORT'],
+        configuration_system['STAGE_PROXY_ADDRESS'],
+        content_type=content_type)
+    logger.info(
+        'Serving the stage on '
+        f'{configuration_system["STAGE_PROXY_ADDRESS"]}:'
+        f'{configuration_system["STAGE_PROXY_PORT"]}')
+    server.serve_forever()
+
+
+def get_date_now():
+    # Get the current datetime in the 'Africa/Johannesburg' timezone
+    # But remove the timezone info, since the rest of the script is not timezone aware
+    return datetime.now(tz=SAST).replace(tzinfo=None)
+
+
+def get_stage_current(configuration_user: dict, date_now: datetime):
+    if configuration_user['STAGE_SOURCES']:
+        return get_stage_hedged(configuration_user, date_now)
+    return get_stage_source(
+        configuration_user['API_URL'], configuration_user['QUERY_MODE'],
+        configuration_user, date_now)
 
-    if tomorrow:
-        start += 24*60
-        end += 24*60
-    if (start - configuration_user['PAD_START']
-            <= now <=
-            end - configuration_user['IGNORE_END']):
-        # We're shedding now
-        return True
 
-    return False
+def get_stage_source(api_url: str, query_mode: str,
+                     configuration_user: dict, date_now: datetime,
+                     cancel=None, log_stage=None):
+    """Queries the stage from one source
+
+    Args:
+        cancel (threading.Event, optional): Stops the retries when set
+        log_stage (callable, optional): Receives the line to log to LOGSTAGE,
+            defaults to logger_stage.info
+    """
+    if log_stage is None:
+        log_stage = logger_stage.info
+    if query_mode.lower() == 'direct':
+        stage_current = get_stage_direct(
+            api_url,
+            http_cache=get_http_cache(configuration_user),
+            retry_policy=get_retry_policy(configuration_user),
+            cancel=cancel, log_stage=log_stage)
+    elif query_mode.lower() == \
+            'loadshedding_thingamabob':
+        response = get_stage_schedule(
+            api_url,
+            http_cache=get_http_cache(configuration_user),
+            retry_policy=get_retry_policy(configuration_user),
+            cancel=cancel)
+        log_stage(f'{response}')
+
+        # Get current stage
+        timeline = get_stage_timeline(
+            response, configuration_user, date_now,
+            source=api_url if configuration_user['STAGE_SOURCES'] else None)
+        date_soon = date_now + timedelta(minutes=configuration_user['PAD_START'])
+        stage_current = timeline.stage(date_soon)
+    return stage_current
+
+
+def build_stage_timeline(response: str, key: str, date_from: datetime,
+                         days: float):
+    """Computes the stage timeline of a loadshedding_thingamabob response
+
+    Args:
+        response (str): The API response, with the stage schedule csv
+        key (str): Key of the timeline, see get_stage_timeline
+        date_from (datetime): Start of the timeline
+        days (float): Length of the timeline
+
+    Returns:
+        [lutils.ltimeline.StageTimeline]: The timeline
+    """
+    import lutils.ltimeline
+    import json
+    import zoneinfo
+    import loadshedding_thingamabob.schedule
+
+    # Build schedule
+    response_d = json.loads(response)
+    stage_schedule_csv = response_d['schedule_csv']
+    stage_schedule = \
+        loadshedding_thingamabob.schedule.Schedule.from_string(
+            stage_schedule_csv,
+            timezone=response_d['timezone'] if 'timezone' in response_d else 'Africa/Johannesburg',
+        )
+    logger.info(f'stage_schedule:\n{stage_schedule}')
+
+    zone = zoneinfo.ZoneInfo('Africa/Johannesburg')
+    return lutils.ltimeline.StageTimeline.from_function(
+        key, lambda date: stage_schedule.stage(date.replace(tzinfo=zone)),
+        date_from, date_from + timedelta(days=days))
+
+
+def get_stage_timeline(response: str, configuration_user: dict,
+                       date_now: datetime, source: str = None):
+    """The stage timeline of a loadshedding_thingamabob response
+
+    The timeline is computed once per stage schedule, identified by the hash
+    of the response, for STAGE_TIMELINE_DAYS, and stored at STAGE_TIMELINE.
+    Until the stage schedule changes (or the timeline runs out), later runs
+    only look up the stage in the stored timeline.
+
+    Args:
+        response (str): The API response, with the stage schedule csv
+        configuration_user (dict): User configuration
+        date_now (datetime): Current time
+        source (str, optional): The API_URL of one of the STAGE_SOURCES. Its
+            timeline is stored next to STAGE_TIMELINE, so that the sources
+            do not overwrite each other's timeline
+
+    Returns:
+        [lutils.ltimeline.StageTimeline]: The timeline, covering at least
+            date_now + PAD_START
+    """
+    import lutils.ltimeline
+    import hashlib
+
+    key = hashlib.sha256(response.encode()).hexdigest()
+    date_soon = date_now + timedelta(minutes=configuration_user['PAD_START'])
+    path = configuration_user['STAGE_TIMELINE']
+    if path and source is not None:
+        path = f'{path}.{hashlib.sha256(source.encode()).hexdigest()[:16]}'
+    if path:
+        timeline = lutils.ltimeline.load(path, key)
+        if timeline is not None and timeline.covers(date_soon):
+            return timeline
+
+    timeline = build_stage_timeline(
+        response, key, date_now, configuration_user['STAGE_TIMELINE_DAYS'])
+    logger.info(
+        f'stage timeline {timeline.start} - {timeline.end}: '
+        f'{len(timeline.times)} stage changes')
+    if path:
+        lutils.ltimeline.store(path, timeline)
+    return timeline
+
+
+def get_stage_hedged(configuration_user: dict, date_now: datetime):
+    """Queries all STAGE_SOURCES concurrently, and returns the first stage
+    STAGE_QUORUM of them agree on
+
+    Raises:
+        StageQueryError: Raised when the sources do not reach the quorum
+    """
+    import threading
+    import lutils.lhedge
+
+    sources = [
+        {k.upper(): v for k, v in source.items()}
+        for source in configuration_user['STAGE_SOURCES']
+    ]
+    # Only the answer that is used is logged to LOGSTAGE, and the sources
+    # that are still retrying stop once there is one
+    cancel = threading.Event()
+    lines = {}
+    calls = [
+        functools.partial(
+            get_stage_source, source['API_URL'], source['QUERY_MODE'],
+            configuration_user, date_now, cancel=cancel,
+            log_stage=functools.partial(lines.__setitem__, i))
+        for i, source in enumerate(sources)
+    ]
+    try:
+        stage, indices = lutils.lhedge.hedge(
+            calls, quorum=configuration_user['STAGE_QUORUM'],
+            timeout=get_retry_policy(configuration_user).deadline,
+            on_error=lambda i, e: logger.warning(
+                f'{sources[i]["API_URL"]}: {e}'),
+            cancel=cancel)
+    except lutils.lhedge.HedgeError as e:
+        message = f'Failure calling STAGE_SOURCES: {e}'
+        logger.error(message)
+        raise StageQueryError(message) from e
+    logger.info(
+        'stage from '
+        f'{", ".join(sources[i]["API_URL"] for i in indices)}')
+    logger_stage.info(lines[indices[0]])
+    return stage
+
+
+def compile_schedule(path: str):
+    schedule = lutils.lschedule.Schedule.from_csv(path, delimiter=';')
+    return lutils.lindex.ScheduleIndex(schedule)
+
+
+def read_schedule(path: str, cache: bool = True):
+    """Reads and compiles the schedule csv at path
+
+    Args:
+        path (str): Path to the schedule csv
+        cache (bool, optional): Load the compiled schedule from a cache file
+            next to the csv, and update the cache if it is stale
+
+    Returns:
+        [ScheduleIndex]: The compiled schedule
+    """
+    if not cache:
+        return compile_schedule(path)
+    # Only the arrays of the schedule are stored, the index compiles the
+    # intervals of an area when they are first looked up
+    return lutils.lcache.load(
+        path, compile_schedule, tag='Schedule.3',
+        dumps=lambda index: index.schedule.to_bytes(),
+        loads=lambda data: lutils.lindex.ScheduleIndex(
+            lutils.lschedule.Schedule.from_bytes(data)))
 
 
 def iterate_shedding_blocks(
         stage_current, schedule, configuration_user, date_check):
-    day = str(date_check.day)
+    index = lutils.lindex.ScheduleIndex.of(schedule)
+    area = str(configuration_user['AREA'])
+    now = date_check.hour*60 + date_check.minute
+    day = date_check.day
     date_tomorrow = date_check + timedelta(days=1)
-    day_tomorrow = str(date_tomorrow.day)
-
-    for i, row in enumerate(schedule):
-        if not row['stage'] <= stage_current:
-            continue
+    day_tomorrow = date_tomorrow.day
 
-        if (row[day] == str(configuration_user['AREA']) and
-                check_row(row, date_check, False, configuration_user)):
-            yield i, row['start'], row['end'], row['stage'], row[day]
+    # The schedule, and therefore the csv,
+    # loops over to 00:30 for the next morning.
+    # Check today's blocks, and tomorrow's blocks shifted by a day
+    blocks = []
+    for d, offset in ((day, 0), (day_tomorrow, 24*60)):
+        for entry in index.lookup(
+                area, d, now, stage_current,
+                configuration_user['PAD_START'],
+                configuration_user['IGNORE_END'],
+                offset=offset):
+            i, start, end = entry[3:]
+            blocks.append((i, offset, start, end, entry[2]))
 
-        if (row[day_tomorrow] == str(configuration_user['AREA'])
-                and check_row(row, date_check, True, configuration_user)):
-            yield i, row['start'], row['end'], row['stage'], row[day_tomorrow]
+    # Keep the row order of the schedule
+    for i, _, start, end, stage in sorted(blocks):
+        yield i, start, end, stage, area
 
 
 def check_shedding(
         stage_current, schedule, configuration_user, date_check):
-    return any(iterate_shedding_blocks(
+    if metrics is None:
+        return any(iterate_shedding_blocks(
+            stage_current, schedule, configuration_user, date_check
+        ))
+
+    time_start = time.perf_counter()
+    shedding = any(iterate_shedding_blocks(
         stage_current, schedule, configuration_user, date_check
     ))
+    metrics.evaluation_seconds.observe(time.perf_counter() - time_start)
+    return shedding
 
 
 def blocks_shedding(
@@ -218,45 +890,298 @@ def blocks_shedding(
     ))
 
 
-def get_stage_direct(api_url: str, attempts=20):
-    # We'll try x times
-    for x in range(attempts):
-        try:
-            req = urllib.request.urlopen(api_url, timeout=10)
-            stage_str = req.read().decode()
-            stage = int(stage_str) - 1  # The API has +1
+def iterate_shedding_windows(
+        stage_current, schedule, configuration_user, date_from, days=62,
+        cut_midnight=True):
+    """Yields the shedding windows of the configured area from date_from on
 
-            if stage < 0:
-                # The API often returns negative numbers. Try again till
-                # we get a valid response
-                raise Exception(f"Invalid negative stage! {stage}")
-            logger_stage.info(f'{stage}')
+    Windows are computed directly from the schedule, with the start padded
+    by PAD_START and the last IGNORE_END minutes ignored, i.e. a window covers
+    exactly the minutes for which check_shedding returns True.
+    Overlapping and adjacent windows are merged.
 
-            return stage
-        except Exception as e:
-            logger.warning(str(e))
-    logger.error('Failure calling API, after {} attempts'.format(attempts))
-    exit()
+    Args:
+        stage_current (int): Loadshedding stage
+        schedule (ScheduleIndex or list(dict)): The schedule
+        configuration_user (dict): User configuration, with AREA, PAD_START
+            and IGNORE_END
+        date_from (datetime): Only windows that have not ended at this time
+            are yielded
+        days (int, optional): Number of days after date_from to look ahead
+        cut_midnight (bool, optional): Cut the blocks that run past midnight
+            at midnight, as check_shedding does. If False, the windows end
+            when the blocks do, e.g. 22:00 - 00:30 the next day.
 
+    Yields:
+        [tuple(datetime, datetime, int)]: (start, end, stage) of each window.
+            Both start and end are inclusive and have minute resolution.
+            The stage is the lowest stage at which (part of) the window is
+            shed.
+    """
+    index = lutils.lindex.ScheduleIndex.of(schedule)
+    area = str(configuration_user['AREA'])
+    pad_start = timedelta(minutes=configuration_user['PAD_START'])
+    ignore_end = timedelta(minutes=configuration_user['IGNORE_END'])
+    minute_from = date_from.replace(second=0, microsecond=0)
+    date_first = datetime.combine(date_from.date(), datetime.min.time())
 
-def get_stage_schedule(api_url: str, attempts=20):
-    # We'll try x times
-    for x in range(attempts):
-        try:
-            response = urllib.request.urlopen(api_url, timeout=10)
-            response = response.read().decode()
+    pending = []
+    window = None
+    # Uncut, the intervals of the previous day can still be running
+    for d in range(0 if cut_midnight else -1, days + 1):
+        date_day = date_first + timedelta(days=d)
+        # check_shedding only considers the intervals of today and tomorrow,
+        # so an interval running past midnight stops at midnight
+        date_last = date_day + timedelta(days=1, minutes=-1)
+        for start, end, stage, *_ in index.intervals(area, date_day.day):
+            if stage > stage_current:
+                continue
+            window_start = date_day + timedelta(minutes=start) - pad_start
+            window_end = date_day + timedelta(minutes=end) - ignore_end
+            if cut_midnight:
+                window_end = min(window_end, date_last)
+            if window_end < minute_from or window_end < window_start:
+                continue
+            heapq.heappush(pending, (window_start, window_end, stage))
+
+        # No interval of the following days can start before this
+        date_next = date_day + timedelta(days=1) - pad_start
+        while pending and (pending[0][0] < date_next or d == days):
+            window_start, window_end, stage = heapq.heappop(pending)
+            if window is not None and \
+                    window_start <= window[1] + timedelta(minutes=1):
+                window = (window[0], max(window[1], window_end),
+                          min(window[2], stage))
+                continue
+            if window is not None:
+                yield window
+            window = (window_start, window_end, stage)
+    if window is not None:
+        yield window
+
+
+def next_shedding_windows(
+        stage_current, schedule, configuration_user, date_from, count=1,
+        days=62):
+    """Returns the next count shedding windows of the configured area
+
+    See iterate_shedding_windows. A window that is active at date_from is
+    included.
+
+    Returns:
+        [list(tuple(datetime, datetime, int))]: Up to count (start, end,
+            stage) tuples
+    """
+    return list(itertools.islice(iterate_shedding_windows(
+        stage_current, schedule, configuration_user, date_from, days=days
+    ), count))
+
+
+def iterate_timeline_windows(
+        timeline, schedule, configuration_user, date_from,
+        cut_midnight=True):
+    """Yields the shedding windows of the configured area over a stage
+    timeline, from date_from on
+
+    A minute is in a window if the area is shed at the stage of the timeline
+    PAD_START minutes later, as evaluated by main, i.e. the windows combine
+    the stage schedule and the area schedule.
+
+    Args:
+        timeline (lutils.ltimeline.StageTimeline): The stage timeline
+        schedule (ScheduleIndex or list(dict)): The schedule
+        configuration_user (dict): User configuration
+        date_from (datetime): Only windows that have not ended at this time
+            are yielded
+        cut_midnight (bool, optional): See iterate_shedding_windows
+
+    Yields:
+        [tuple(datetime, datetime, int)]: (start, end, stage) of each window,
+            see iterate_shedding_windows
+    """
+    pad_start = timedelta(minutes=configuration_user['PAD_START'])
+    minute = timedelta(minutes=1)
+    date_from = date_from.replace(second=0, microsecond=0)
+    window = None
+    for segment_start, segment_end, stage in timeline.segments(
+            date_from + pad_start):
+        # Minutes whose stage is looked up in this segment
+        first = max(segment_start - pad_start, date_from)
+        last = segment_end - pad_start - minute
+        days = (last - first).days + 2
+        for window_start, window_end, window_stage in \
+                iterate_shedding_windows(
+                    stage, schedule, configuration_user, first, days=days,
+                    cut_midnight=cut_midnight):
+            if window_start > last:
+                break
+            window_start = max(window_start, first)
+            window_end = min(window_end, last)
+            if window is not None and window_start <= window[1] + minute:
+                window = (window[0], max(window[1], window_end),
+                          min(window[2], window_stage))
+                continue
+            if window is not None:
+                yield window
+            window = (window_start, window_end, window_stage)
+    if window is not None:
+        yield window
 
-            return response
-        except Exception as e:
-            logger.warning(str(e))
-    logger.error('Failure calling API, after {} attempts'.format(attempts))
-    exit()
 
+def iterate_area_windows(
+        schedule, area, date_from, date_to, stage=None, timeline=None,
+        pad_start=0, ignore_end=0):
+    """Yields the shedding windows of area between date_from and date_to, at
+    a stage or over a stage timeline, e.g. to export them
+
+    Args:
+        schedule (ScheduleIndex or list(dict)): The schedule
+        area (str): The area
+        date_from (datetime): Start of the range
+        date_to (datetime): End of the range (exclusive)
+        stage (int, optional): Loadshedding stage, if timeline is None
+        timeline (lutils.ltimeline.StageTimeline, optional): Stage timeline
+        pad_start (int, optional): Minutes to start the windows early
+        ignore_end (int, optional): Minutes at the end of the windows to
+            ignore
+
+    Yields:
+        [tuple(datetime, datetime, int)]: (start, end, stage) of each window,
+            clipped to the range. Unlike iterate_shedding_windows, the end is
+            exclusive, i.e. the end time of the schedule less ignore_end, and
+            blocks that run past midnight are not cut at midnight.
+    """
+    # iterate_shedding_windows treats the end minute of the schedule as shed
+    # (check_shedding does), ignore one more minute for the exclusive end
+    configuration_user = {
+        'AREA': area, 'PAD_START': pad_start, 'IGNORE_END': ignore_end + 1,
+    }
+    if timeline is None:
+        windows = iterate_shedding_windows(
+            stage, schedule, configuration_user, date_from,
+            days=(date_to - date_from).days + 1, cut_midnight=False)
+    else:
+        windows = iterate_timeline_windows(
+            timeline, schedule, configuration_user, date_from,
+            cut_midnight=False)
+
+    minute = timedelta(minutes=1)
+    for start, end, window_stage in windows:
+        if start >= date_to:
+            break
+        yield max(start, date_from), min(end + minute, date_to), window_stage
+
+
+def get_http_cache(configuration_user: dict):
+    """The HTTP response cache for the stage queries, or None if disabled
+    """
+    import lutils.lhttp
+
+    if not configuration_user['HTTP_CACHE']:
+        return None
+    return lutils.lhttp.HttpCache(
+        configuration_user['HTTP_CACHE'],
+        ttl=configuration_user['HTTP_CACHE_TTL'],
+        stale_if_error=configuration_user['HTTP_CACHE_STALE_IF_ERROR'],
+    )
+
+
+def parse_stage_direct(body: bytes):
+    stage = int(body.decode()) - 1  # The API has +1
+
+    if stage < 0:
+        # The API often returns negative numbers. Try again till
+        # we get a valid response
+        raise Exception(f"Invalid negative stage! {stage}")
+    return stage
+
+
+def fetch_stage_api(api_url: str, timeout: float, http_cache, validate):
+    """Fetches api_url with lutils.lhttp.fetch, and records the duration in
+    the metrics, if enabled
+    """
+    import lutils.lhttp
+
+    time_start = time.perf_counter()
+    try:
+        return lutils.lhttp.fetch(
+            api_url, timeout=timeout, cache=http_cache, validate=validate)
+    except Exception:
+        if metrics is not None:
+            metrics.fetch_errors.inc(api_url=api_url)
+        raise
+    finally:
+        if metrics is not None:
+            seconds = time.perf_counter() - time_start
+            metrics.fetch_seconds.observe(seconds, api_url=api_url)
+            metrics.fetch_last_seconds.set(seconds, api_url=api_url)
 
-def time_to_min(time: str):
-    hour, minute = [int(x) for x in time.split(':')][:2]
 
-    return hour*60 + minute
+def get_retry_policy(configuration_user: dict):
+    """The retry policy for the stage queries
+    """
+    import lutils.lretry
+
+    return lutils.lretry.RetryPolicy.from_configuration(
+        configuration_user['RETRY'])
+
+
+def get_stage_direct(api_url: str, http_cache=None, retry_policy=None,
+                     cancel=None, log_stage=None):
+    import lutils.lretry
+
+    if retry_policy is None:
+        retry_policy = lutils.lretry.RetryPolicy()
+    if log_stage is None:
+        log_stage = logger_stage.info
+
+    def attempt(timeout):
+        body, source = fetch_stage_api(
+            api_url, timeout, http_cache, parse_stage_direct)
+        if source == 'stale':
+            logger.warning('API unavailable, using cached stage')
+        return parse_stage_direct(body)
+
+    try:
+        stage = retry_policy.call(
+            attempt, on_error=lambda e: logger.warning(str(e)),
+            cancel=cancel)
+    except lutils.lretry.RetryCancelled as e:
+        raise StageQueryError(f'{api_url}: {e}') from e
+    except lutils.lretry.RetryError as e:
+        message = f'Failure calling API: {e}'
+        logger.error(message)
+        raise StageQueryError(message) from e
+    log_stage(f'{stage}')
+
+    return stage
+
+
+def get_stage_schedule(api_url: str, http_cache=None, retry_policy=None,
+                       cancel=None):
+    import json
+    import lutils.lretry
+
+    if retry_policy is None:
+        retry_policy = lutils.lretry.RetryPolicy()
+
+    def attempt(timeout):
+        body, source = fetch_stage_api(
+            api_url, timeout, http_cache, json.loads)
+        if source == 'stale':
+            logger.warning('API unavailable, using cached schedule')
+        return body.decode()
+
+    try:
+        return retry_policy.call(
+            attempt, on_error=lambda e: logger.warning(str(e)),
+            cancel=cancel)
+    except lutils.lretry.RetryCancelled as e:
+        raise StageQueryError(f'{api_url}: {e}') from e
+    except lutils.lretry.RetryError as e:
+        message = f'Failure calling API: {e}'
+        logger.error(message)
+        raise StageQueryError(message) from e
 
 
 def get_override_status(timeout: int, dialog_msg: str):
@@ -277,19 +1202,23 @@ def get_override_status(timeout: int, dialog_msg: str):
 
 if __name__ == "__main__":
     def get_logger(name, filename):
-        filename = pathlib.Path(filename)
-        if not filename.suffix:
-            filename = filename.with_suffix('.log')
+        import logging.handlers
+
+        if not os.path.splitext(filename)[1]:
+            filename = filename + '.log'
 
-        filename.parent.mkdir(exist_ok=True, parents=True)
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
 
         logger_crash = logging.getLogger(name)
         logger_crash.setLevel(logging.DEBUG)
         ch = logging.StreamHandler()
         ch.setLevel(logging.DEBUG)
         logger_crash.addHandler(ch)
+        # Only open the file when the first message is logged
         fh = logging.handlers.TimedRotatingFileHandler(
             filename, when="midnight", backupCount=30,  # Manually set backup count for testing
+            delay=True,
         )
         fh.setLevel(logging.DEBUG)
         fh.setFormatter(
@@ -297,6 +1226,23 @@ if __name__ == "__main__":
         logger_crash.addHandler(fh)
         return logger_crash
 
+    def get_timings_logger(filename):
+        import logging.handlers
+
+        if os.path.dirname(filename):
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        logger_timings = logging.getLogger('timings')
+        logger_timings.setLevel(logging.INFO)
+        logger_timings.propagate = False
+        # One JSON object per line, without a prefix
+        fh = logging.handlers.TimedRotatingFileHandler(
+            filename, when="midnight", backupCount=30, delay=True,
+        )
+        fh.setFormatter(logging.Formatter('%(message)s'))
+        logger_timings.addHandler(fh)
+        return logger_timings
+
     def get_crash_logger():
         return get_logger('crash', 'crash.log')
 
@@ -318,11 +1264,197 @@ if __name__ == "__main__":
             default='configuration_user.yaml',
             help='Path to the user configuration file.'
         )
+        parser.add_argument(
+            '--daemon', action='store_true',
+            help='Keep running, and only evaluate the schedule when needed, '
+                 'instead of being run from cron every minute.'
+        )
+        parser.add_argument(
+            '--serve-stage', action='store_true',
+            help='Serve the API_URL response to other hosts, requesting it '
+                 'at most once per STAGE_PROXY_TTL seconds.'
+        )
+        subparsers = parser.add_subparsers(dest='command')
+        parser_next = subparsers.add_parser(
+            'next',
+            help='Show the next shedding windows of the configured area.'
+        )
+        parser_next.add_argument(
+            '--stage', type=int, default=None,
+            help='Stage to compute the windows for. '
+                 'Queried via API_URL if not specified.'
+        )
+        parser_next.add_argument(
+            '--count', type=int, default=5,
+            help='Number of windows to show.'
+        )
+        parser_next.add_argument(
+            '--date', type=datetime.fromisoformat, default=None,
+            help='Show windows after this (ISO format) date. Default is now.'
+        )
+        parser_export = subparsers.add_parser(
+            'export',
+            help='Export the shedding windows of one or all areas of a '
+                 'schedule as iCalendar or JSON lines. Needs no '
+                 'configuration files.'
+        )
+        parser_export.add_argument(
+            '--schedule', type=str, required=True,
+            help='Path to the schedule csv.'
+        )
+        parser_export.add_argument(
+            '--area', type=str, action='append',
+            help='Area to export, can be repeated. Default is all areas.'
+        )
+        parser_export.add_argument(
+            '--from', dest='date_from', type=datetime.fromisoformat,
+            required=True,
+            help='Start of the range, ISO format.'
+        )
+        parser_export.add_argument(
+            '--to', dest='date_to', type=datetime.fromisoformat,
+            required=True,
+            help='End of the range (exclusive), ISO format.'
+        )
+        parser_export.add_argument(
+            '--stage', type=int, default=None,
+            help='Stage to export the windows for.'
+        )
+        parser_export.add_argument(
+            '--timeline', type=str, default=None,
+            help='Export over the stage timeline stored at this path '
+                 '(STAGE_TIMELINE) instead of at a fixed stage.'
+        )
+        parser_export.add_argument(
+            '--format', choices=('ical', 'jsonl'), default='ical',
+            help='Export format.'
+        )
+        parser_export.add_argument(
+            '--pad-start', type=int, default=0,
+            help='Minutes to start the windows early.'
+        )
+        parser_export.add_argument(
+            '--ignore-end', type=int, default=0,
+            help='Minutes at the end of the windows to ignore.'
+        )
+        parser_export.add_argument(
+            '--output', type=str, default='-',
+            help='Output file, default is stdout.'
+        )
+        parser_replay = subparsers.add_parser(
+            'replay',
+            help='Replay the stage history in LOGSTAGE for a grid of areas, '
+                 'PAD_START and IGNORE_END values, and print the number of '
+                 'CMD executions, early shutdowns and missed windows of each '
+                 'as JSON lines. Needs NumPy, and no configuration files.'
+        )
+        parser_replay.add_argument(
+            '--log', type=str, required=True,
+            help='Path to the stage log (LOGSTAGE), its rotated logs are '
+                 'read too.'
+        )
+        parser_replay.add_argument(
+            '--schedule', type=str, required=True,
+            help='Path to the schedule csv.'
+        )
+        parser_replay.add_argument(
+            '--area', type=str, action='append',
+            help='Area to replay, can be repeated. Default is all areas.'
+        )
+        parser_replay.add_argument(
+            '--pad-start', type=int, nargs='+', default=[17],
+            help='PAD_START values to replay.'
+        )
+        parser_replay.add_argument(
+            '--ignore-end', type=int, nargs='+', default=[30],
+            help='IGNORE_END values to replay.'
+        )
+        parser_replay.add_argument(
+            '--from', dest='date_from', type=datetime.fromisoformat,
+            default=None,
+            help='Start of the replay, ISO format. Default is the start of '
+                 'the log.'
+        )
+        parser_replay.add_argument(
+            '--to', dest='date_to', type=datetime.fromisoformat,
+            default=None,
+            help='End of the replay, ISO format. Default is the end of the '
+                 'log.'
+        )
         args = parser.parse_args()
     except Exception as e:
         logger_crash.exception(e)
         exit()
 
+    if args.command == 'replay':
+        # Needs no configuration, e.g. to tune the settings of a fleet
+        import json
+        import lutils.lreplay
+
+        schedule = read_schedule(args.schedule)
+        areas = args.area
+        if not areas or 'all' in areas:
+            areas = sorted(schedule.schedule.areas)
+        # build_stage_timeline logs the stage schedules, not needed here
+        logger = logging.getLogger('replay')
+
+        def build_timeline(response, date_from, date_to):
+            import hashlib
+
+            return build_stage_timeline(
+                response, hashlib.sha256(response.encode()).hexdigest(),
+                date_from, (date_to - date_from) / timedelta(days=1))
+
+        try:
+            history = lutils.lreplay.StageHistory.from_logs(
+                args.log, build_timeline)
+        except (ValueError, ImportError) as e:
+            parser_replay.error(str(e))
+        results = lutils.lreplay.replay(
+            history, schedule, areas, args.pad_start, args.ignore_end,
+            date_from=args.date_from, date_to=args.date_to)
+        for result in results:
+            print(json.dumps(result))
+        exit()
+
+    if args.command == 'export':
+        # Needs no configuration, e.g. to publish calendars on a server
+        import lutils.lexport
+        import lutils.ltimeline
+        import sys
+
+        if (args.stage is None) == (args.timeline is None):
+            parser_export.error('specify one of --stage and --timeline')
+        timeline = None
+        if args.timeline is not None:
+            timeline = lutils.ltimeline.load(args.timeline)
+            if timeline is None:
+                parser_export.error(f'no stage timeline at {args.timeline}')
+
+        schedule = read_schedule(args.schedule)
+        areas = args.area
+        if not areas or 'all' in areas:
+            areas = sorted(schedule.schedule.areas)
+        events = lutils.lexport.merge_areas({
+            area: iterate_area_windows(
+                schedule, area, args.date_from, args.date_to,
+                stage=args.stage, timeline=timeline,
+                pad_start=args.pad_start, ignore_end=args.ignore_end)
+            for area in areas
+        })
+        lines = lutils.lexport.export_lines(events, args.format)
+        if args.output == '-':
+            sys.stdout.writelines(lines)
+        else:
+            with open(args.output, 'w', newline='') as f:
+                f.writelines(lines)
+        exit()
+
+    # The configuration phase is only known to be timed once the system
+    # configuration is read
+    timings = lutils.ltiming.Timings()
+    time_configuration = time.perf_counter()
+
     try:
         configuration_system = configuration.read_configuration_system(
             args.configuration_system)
@@ -331,7 +1463,7 @@ if __name__ == "__main__":
         message = f'Configuration file does not exist\n\t{str(e)}'
         logger_crash.critical(message)
         exit()
-    except configuration.MissingKeyError as e:
+    except configuration.ConfigurationError as e:
         message = str(e)
         logger_crash.critical(message)
         exit()
@@ -347,15 +1479,60 @@ if __name__ == "__main__":
         logger.critical(message)
         logger_crash.critical(message)
         exit()
-    except configuration.MissingKeyError as e:
+    except configuration.ConfigurationError as e:
         message = str(e)
         logger.critical(message)
         logger_crash.critical(message)
         exit()
-    except configuration.VersionError as e:
-        message = str(e)
-        logger.critical(message)
-        logger_crash.critical(message)
+
+    if configuration_system['TIMINGS']:
+        if configuration_system['TIMINGS_LOG']:
+            timings.logger = get_timings_logger(
+                configuration_system['TIMINGS_LOG'])
+        else:
+            timings.logger = logger
+        timings.add('configuration', time.perf_counter() - time_configuration)
+
+    if args.command == 'next':
+        date_from = args.date if args.date is not None else get_date_now()
+        schedule = read_schedule(
+            configuration_user['SCHEDULE_CSV'],
+            cache=configuration_user['SCHEDULE_CACHE'])
+        stage = args.stage
+        if stage is None and not configuration_user['STAGE_SOURCES'] and \
+                configuration_user['QUERY_MODE'].lower() == \
+                'loadshedding_thingamabob':
+            # The stage changes over time, follow the stage schedule
+            try:
+                timeline = get_stage_timeline(
+                    get_stage_schedule(
+                        configuration_user['API_URL'],
+                        http_cache=get_http_cache(configuration_user),
+                        retry_policy=get_retry_policy(configuration_user)),
+                    configuration_user, date_from)
+            except StageQueryError:
+                exit()
+            windows = list(itertools.islice(iterate_timeline_windows(
+                timeline, schedule, configuration_user, date_from
+            ), args.count))
+        else:
+            if stage is None:
+                try:
+                    stage = get_stage_current(configuration_user, date_from)
+                except StageQueryError:
+                    exit()
+            windows = next_shedding_windows(
+                stage, schedule, configuration_user, date_from,
+                count=args.count)
+        for window_start, window_end, window_stage in windows:
+            print(f'{window_start.isoformat(" ")} - '
+                  f'{window_end.isoformat(" ")} (stage {window_stage})')
         exit()
 
-    main(configuration_system, configuration_user, logger, logger_stage)
+    if args.serve_stage:
+        serve_stage(configuration_system, configuration_user, logger)
+    elif args.daemon:
+        daemon(configuration_system, configuration_user, logger, logger_stage)
+    else:
+        main(configuration_system, configuration_user, logger, logger_stage,
+             timings=timings)
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+"""
+Implements minute resolution bitmaps of the shedding schedules, for set
+queries over many areas, e.g. when all of a group of areas have power
+"""
+import functools
+from datetime import datetime, timedelta
+
+from lutils.lindex import ScheduleIndex
+from lutils.lschedule import DAYS
+
+MINUTE = timedelta(minutes=1)
+DAY_MINUTES = 24*60
+
+
+class MinuteBitmap():
+    """
+    A set of the minutes from start on, as the bits of an int: bit i is set
+    if minute start + i minutes is in the set
+
+    Bitmaps over the same minutes can be combined with & (and), | (or),
+    ^ (xor), - (and not) and ~ (not).
+
+    Args:
+        start (datetime): The first minute
+        length (int): Number of minutes
+        bits (int): The bits, bits past length are dropped
+    """
+    __slots__ = ('start', 'length', 'bits')
+
+    def __init__(self, start: datetime, length: int, bits: int = 0):
+        self.start = start
+        self.length = length
+        self.bits = bits & ((1 << length) - 1)
+
+    @property
+    def end(self):
+        """The minute after the last minute"""
+        return self.start + self.length * MINUTE
+
+    def _check(self, other):
+        if not isinstance(other, MinuteBitmap):
+            return NotImplemented
+        if (self.start, self.length) != (other.start, other.length):
+            raise ValueError(
+                f'Bitmaps over different minutes: {self.start} +{self.length}'
+                f' and {other.start} +{other.length}')
+        return other
+
+    def __and__(self, other):
+        if self._check(other) is NotImplemented:
+            return NotImplemented
+        return MinuteBitmap(self.start, self.length, self.bits & other.bits)
+
+    def __or__(self, other):
+        if self._check(other) is NotImplemented:
+            return NotImplemented
+        return MinuteBitmap(self.start, self.length, self.bits | other.bits)
+
+    def __xor__(self, other):
+        if self._check(other) is NotImplemented:
+            return NotImplemented
+        return MinuteBitmap(self.start, self.length, self.bits ^ other.bits)
+
+    def __sub__(self, other):
+        if self._check(other) is NotImplemented:
+            return NotImplemented
+        return MinuteBitmap(self.start, self.length, self.bits & ~other.bits)
+
+    def __invert__(self):
+        return MinuteBitmap(self.start, self.length, ~self.bits)
+
+    def __eq__(self, other):
+        if not isinstance(other, MinuteBitmap):
+            return NotImplemented
+        return ((self.start, self.length, self.bits) ==
+                (other.start, other.length, other.bits))
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __contains__(self, date: datetime):
+        i = (date - self.start) // MINUTE
+        return 0 <= i < self.length and bool(self.bits >> i & 1)
+
+    def __repr__(self):
+        return (f'MinuteBitmap({self.start!r}, {self.length}, '
+                f'{self.count()} minutes set)')
+
+    def count(self):
+        """Number of minutes in the set"""
+        return bin(self.bits).count('1')
+
+    def runs(self):
+        """Yields the runs of set bits
+
+        Yields:
+            [tuple(int, int)]: (first, end) of each run, in minutes from
+                start, end exclusive
+        """
+        bits = self.bits
+        while bits:
+            first = (bits & -bits).bit_length() - 1
+            # Adding the lowest set bit carries through the run, up to the
+            # first unset bit after it
+            carried = bits + (1 << first)
+            end = (carried & -carried).bit_length() - 1
+            yield first, end
+            bits &= carried
+
+    def windows(self):
+        """Yields the runs of minutes in the set
+
+        Yields:
+            [tuple(datetime, datetime)]: (start, end) of each run, end
+                exclusive
+        """
+        for first, end in self.runs():
+            yield self.start + first * MINUTE, self.start + end * MINUTE
+
+
+def _reduce(function, bitmaps, bits: int, start: datetime, length: int):
+    if start is not None and length is not None:
+        return functools.reduce(
+            function, bitmaps, MinuteBitmap(start, length, bits))
+    bitmaps = iter(bitmaps)
+    first = next(bitmaps, None)
+    if first is None:
+        raise ValueError('No bitmaps, and no start and length of the result')
+    return functools.reduce(function, bitmaps, first)
+
+
+def union(bitmaps, start: datetime = None, length: int = None):
+    """The minutes in any of bitmaps, see MinuteBitmap
+
+    Args:
+        bitmaps (iterable(MinuteBitmap)): Bitmaps over the same minutes
+        start (datetime, optional): The first minute of the bitmaps, the
+            union of no bitmaps is then empty
+        length (int, optional): Number of minutes of the bitmaps
+
+    Raises:
+        ValueError: Raised when there are no bitmaps and no start and length,
+            or the bitmaps are over different minutes
+    """
+    return _reduce(MinuteBitmap.__or__, bitmaps, 0, start, length)
+
+
+def intersection(bitmaps, start: datetime = None, length: int = None):
+    """The minutes in all of bitmaps, see MinuteBitmap
+
+    Args:
+        bitmaps (iterable(MinuteBitmap)): Bitmaps over the same minutes
+        start (datetime, optional): The first minute of the bitmaps, the
+            intersection of no bitmaps is then all minutes
+        length (int, optional): Number of minutes of the bitmaps
+
+    Raises:
+        ValueError: Raised when there are no bitmaps and no start and length,
+            or the bitmaps are over different minutes
+    """
+    return _reduce(MinuteBitmap.__and__, bitmaps, -1, start, length)
+
+
+def _minutes(date_from: datetime, date_to: datetime):
+    """The first minute and number of minutes from date_from to date_to"""
+    start = date_from.replace(second=0, microsecond=0)
+    return start, max(0, -((start - date_to) // MINUTE))
+
+
+class BitmapIndex():
+    """
+    The minutes in which each area is shed, per day of the month and stage,
+    as bitmaps
+
+    Bit m of the bitmap of a day is set if the area is shed at minute m after
+    midnight. The schedule times are the times the power goes off and comes
+    back, i.e. a block covers [start, end). Unlike check_shedding, which cuts
+    blocks at midnight, a block that runs past midnight (e.g. 22:00 - 00:30)
+    covers the first minutes of the next day too, so the bitmaps of a day can
+    be longer than a day.
+
+    The bitmap of a stage includes the blocks of all lower stages.
+
+    Args:
+        schedule (ScheduleIndex, Schedule or list(dict)): The schedule
+
+    Attributes:
+        schedule (Schedule): The schedule
+    """
+
+    def __init__(self, schedule):
+        index = ScheduleIndex.of(schedule)
+        self.schedule = index.schedule
+        n_stages = self.schedule.n_stages
+
+        self._days = {}
+        for area in self.schedule.areas:
+            for day in range(1, DAYS + 1):
+                stages = [0] * (n_stages + 1)
+                for start, end, stage, *_ in index.intervals(area, day):
+                    stages[stage] |= ((1 << (end - start)) - 1) << start
+                for stage in range(1, n_stages + 1):
+                    stages[stage] |= stages[stage - 1]
+                self._days[(area, day)] = tuple(stages)
+
+    def day(self, area: str, day: int, stage: int):
+        """The bitmap of area on a day of the month
+
+        Args:
+            area (str): The area, as it appears in the schedule
+            day (int): Day of the month
+            stage (int): Loadshedding stage
+
+        Raises:
+            KeyError: Raised when area is not in the schedule
+
+        Returns:
+            [int]: The bits, bit m for minute m after midnight
+        """
+        try:
+            stages = self._days[(str(area), day)]
+        except KeyError:
+            raise KeyError(f'Area {area!r} not in the schedule') from None
+        return stages[max(0, min(stage, len(stages) - 1))]
+
+    def shed(self, area: str, date_from: datetime, date_to: datetime,
+             stage: int):
+        """The minutes between date_from and date_to in which area is shed
+
+        Args:
+            area (str): The area, as it appears in the schedule
+            date_from (datetime): Start of the range, truncated to the minute
+            date_to (datetime): End of the range (exclusive)
+            stage (int): Loadshedding stage
+
+        Raises:
+            KeyError: Raised when area is not in the schedule
+
+        Returns:
+            [MinuteBitmap]: The minutes shed
+        """
+        start, length = _minutes(date_from, date_to)
+
+        # Start a day early, blocks of the previous day can run past midnight
+        date_day = datetime.combine(start.date(), datetime.min.time()) - \
+            timedelta(days=1)
+        base = date_day
+        bits = 0
+        while date_day < date_to:
+            bits |= self.day(area, date_day.day, stage) << \
+                ((date_day - base) // MINUTE)
+            date_day += timedelta(days=1)
+        return MinuteBitmap(start, length, bits >> ((start - base) // MINUTE))
+
+    def shed_any(self, areas: list, date_from: datetime, date_to: datetime,
+                 stage: int):
+        """The minutes in which any of areas is shed, see shed. No minutes
+        if areas is empty
+        """
+        return union((self.shed(area, date_from, date_to, stage)
+                      for area in areas), *_minutes(date_from, date_to))
+
+    def powered_all(self, areas: list, date_from: datetime,
+                    date_to: datetime, stage: int):
+        """The minutes in which all of areas have power, see shed"""
+        return ~self.shed_any(areas, date_from, date_to, stage)
+
+    def shed_at(self, date: datetime, stage: int):
+        """The areas shed at date
+
+        Args:
+            date (datetime): The minute
+            stage (int): Loadshedding stage
+
+        Returns:
+            [list(str)]: The areas shed, in the order of the schedule
+        """
+        now = date.hour*60 + date.minute
+        day = date.day
+        day_before = (date - timedelta(days=1)).day
+        return [
+            area for area in self.schedule.areas
+            if self.day(area, day, stage) >> now & 1 or
+            self.day(area, day_before, stage) >> (now + DAY_MINUTES) & 1
+        ]
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Implements an on-disk cache of data derived from a source file, e.g. compiled
+schedules
+"""
+import os
+import pickle
+import struct
+import threading
+
+# Increment when the layout of the cache file changes
+CACHE_VERSION = 2
+
+# Header of the cache files: magic, version, mtime_ns, size and SHA-256 hash
+# of the source, and the lengths of the source path and of the tag. These
+# follow the header, then the data
+_MAGIC = b'LCACHE'
+_HEADER = struct.Struct('<6sHqq32sHH')
+
+
+def cache_path_for(source: str):
+    """Default path of the cache file for a source file, next to the source
+
+    Args:
+        source (str): Path to the source file
+
+    Returns:
+        [str]: Path to the cache file
+    """
+    return f'{source}.cache'
+
+
+def _read_cache(cache_path: str):
+    try:
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        (magic, version, mtime_ns, size, sha256, n_path,
+         n_tag) = _HEADER.unpack_from(data)
+        if magic != _MAGIC or version != CACHE_VERSION:
+            return None
+        offset = _HEADER.size
+        path = data[offset:offset + n_path].decode('utf-8')
+        offset += n_path
+        tag = data[offset:offset + n_tag].decode('utf-8')
+        offset += n_tag
+    except Exception:
+        return None
+    return {
+        'path': path, 'tag': tag, 'mtime_ns': mtime_ns, 'size': size,
+        'sha256': sha256, 'data': data[offset:],
+    }
+
+
+def write_atomic(path: str, data: bytes):
+    """Writes data to path, replacing it atomically
+
+    The data is written to a temporary file that is then renamed, so that a
+    concurrent reader never sees a partially written file. Writing is best
+    effort, e.g. the directory may be read-only.
+
+    Args:
+        path (str): Path of the file to write
+        data (bytes): The file contents
+
+    Returns:
+        [bool]: True if the file was written
+    """
+    path_tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(path_tmp, 'wb') as f:
+            f.write(data)
+        os.replace(path_tmp, path)
+        return True
+    except OSError:
+        try:
+            os.remove(path_tmp)
+        except OSError:
+            pass
+        return False
+
+
+def _write_cache(cache_path: str, entry: dict, data: bytes):
+    path = entry['path'].encode('utf-8')
+    tag = entry['tag'].encode('utf-8')
+    write_atomic(cache_path, b''.join((
+        _HEADER.pack(_MAGIC, CACHE_VERSION, entry['mtime_ns'], entry['size'],
+                     entry['sha256'], len(path), len(tag)),
+        path, tag, data)))
+
+
+def load(source: str, build, tag: str = '', cache_path: str = None,
+         dumps=None, loads=None):
+    """Loads the data built from source, from the cache if it is up to date
+
+    The cache is keyed by the path, modification time, size and SHA-256 hash
+    of source, and by tag. If the modification time or size of source
+    changed, its hash is compared, and the data is only rebuilt if the
+    contents actually changed.
+
+    The cache file is a small binary header with the key, followed by the
+    data as serialized by dumps.
+
+    Args:
+        source (str): Path to the source file
+        build (callable): Function that receives source, and returns the data
+            to cache
+        tag (str, optional): Identifies the kind of data built from source.
+            Change it when build changes the data it returns.
+        cache_path (str, optional): Path to the cache file. Defaults to
+            cache_path_for(source).
+        dumps (callable, optional): Serializes the data to bytes. Defaults to
+            pickling it.
+        loads (callable, optional): Deserializes the data written by dumps,
+            and raises an exception if it is invalid. Defaults to unpickling
+            it.
+
+    Raises:
+        FileNotFoundError: Raised when source does not exist
+
+    Returns:
+        The data returned by build(source)
+    """
+    if cache_path is None:
+        cache_path = cache_path_for(source)
+    if dumps is None:
+        def dumps(data):
+            return pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+    if loads is None:
+        loads = pickle.loads
+
+    stat = os.stat(source)
+    path = os.path.abspath(source)
+    entry = _read_cache(cache_path)
+    data = None
+    if entry is not None and entry['path'] == path and entry['tag'] == tag:
+        try:
+            data = loads(entry['data'])
+        except Exception:
+            entry = None
+        else:
+            if (entry['mtime_ns'] == stat.st_mtime_ns and
+                    entry['size'] == stat.st_size):
+                return data
+    else:
+        entry = None
+
+    import hashlib
+
+    with open(source, 'rb') as f:
+        sha256 = hashlib.sha256(f.read()).digest()
+
+    if entry is not None and entry['sha256'] == sha256:
+        # Only touched, refresh the key
+        serialized = entry['data']
+    else:
+        data = build(source)
+        serialized = dumps(data)
+
+    _write_cache(cache_path, {
+        'path': path,
+        'tag': tag,
+        'mtime_ns': stat.st_mtime_ns,
+        'size': stat.st_size,
+        'sha256': sha256,
+    }, serialized)
+    return data
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+"""
+Implements running shell commands with a timeout, and running pre-shutdown
+hooks concurrently, in the background, under a deadline
+"""
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds a timed out command gets to exit after SIGTERM, before SIGKILL
+KILL_GRACE = 2
+# Seconds between checks for cancellation while a command runs
+CANCEL_INTERVAL = 0.1
+
+
+class CommandResult():
+    """
+    The outcome of a command
+
+    Args:
+        command (str): The command
+        returncode (int or None): Exit status, negative if killed by a
+            signal, None if the command could not be started
+        seconds (float): Duration
+        timed_out (bool): True if the command was killed after its timeout
+        error (Exception, optional): The error starting the command
+        cancelled (bool): True if the command was killed, or not started,
+            since it was cancelled
+    """
+
+    def __init__(self, command: str, returncode: int, seconds: float,
+                 timed_out: bool = False, error: Exception = None,
+                 cancelled: bool = False):
+        self.command = command
+        self.returncode = returncode
+        self.seconds = seconds
+        self.timed_out = timed_out
+        self.error = error
+        self.cancelled = cancelled
+
+    @property
+    def ok(self):
+        return (self.returncode == 0 and not self.timed_out and
+                not self.cancelled)
+
+    def __str__(self):
+        if self.error is not None:
+            outcome = f'failed to start ({self.error})'
+        elif self.cancelled:
+            outcome = 'cancelled'
+        elif self.timed_out:
+            outcome = 'timed out'
+        else:
+            outcome = f'exited with {self.returncode}'
+        return f'"{self.command}" {outcome} after {self.seconds:.2f} s'
+
+    def __repr__(self):
+        return (f'CommandResult({self.command!r}, {self.returncode!r}, '
+                f'{self.seconds!r}, timed_out={self.timed_out!r})')
+
+
+def run_command(command: str, timeout: float = None,
+                cancel: threading.Event = None):
+    """Runs command through the shell, like os.system
+
+    The command runs in its own process group, so that on timeout or
+    cancellation the shell and everything it started is terminated (SIGTERM,
+    then SIGKILL after KILL_GRACE seconds).
+
+    Args:
+        command (str): The shell command
+        timeout (float, optional): Seconds after which the command is killed,
+            None to wait for it
+        cancel (threading.Event, optional): Kills the command when set, it is
+            checked every CANCEL_INTERVAL seconds
+
+    Returns:
+        [CommandResult]: The outcome
+    """
+    time_start = time.monotonic()
+    if cancel is not None and cancel.is_set():
+        return CommandResult(command, None, 0.0, cancelled=True)
+    try:
+        process = subprocess.Popen(command, shell=True,
+                                   start_new_session=True)
+    except OSError as e:
+        return CommandResult(command, None, time.monotonic() - time_start,
+                             error=e)
+
+    deadline = None if timeout is None else time_start + timeout
+    timed_out = cancelled = False
+    while True:
+        wait = None if deadline is None else deadline - time.monotonic()
+        if cancel is not None:
+            wait = CANCEL_INTERVAL if wait is None else \
+                min(wait, CANCEL_INTERVAL)
+        try:
+            process.wait(max(wait, 0) if wait is not None else None)
+            break
+        except subprocess.TimeoutExpired:
+            if cancel is not None and cancel.is_set():
+                cancelled = True
+            elif deadline is None or time.monotonic() < deadline:
+                continue
+            else:
+                timed_out = True
+            _kill(process)
+            break
+    return CommandResult(command, process.returncode,
+                         time.monotonic() - time_start, timed_out=timed_out,
+                         cancelled=cancelled)
+
+
+def _kill(process: subprocess.Popen):
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+        try:
+            process.wait(KILL_GRACE)
+            return
+        except subprocess.TimeoutExpired:
+            continue
+
+
+class Hook():
+    """
+    A pre-shutdown hook: a shell command, and its timeout
+
+    Args:
+        command (str): The shell command
+        timeout (float, optional): Seconds after which the hook is killed
+    """
+
+    def __init__(self, command: str, timeout: float = None):
+        self.command = command
+        self.timeout = timeout
+
+    @classmethod
+    def from_configuration(cls, hook, timeout: float = None):
+        """Builds a hook from a PRE_SHUTDOWN_HOOKS entry
+
+        Args:
+            hook (str or dict): The command, or a dict with the keys CMD and,
+                optionally, TIMEOUT (case insensitive)
+            timeout (float, optional): Timeout if the entry has none
+
+        Raises:
+            ValueError: Raised when the entry is not a command, or its
+                TIMEOUT is not a number >= 0
+
+        Returns:
+            [Hook]: The hook
+        """
+        if isinstance(hook, str):
+            return cls(hook, timeout)
+        if isinstance(hook, dict):
+            hook = {k.upper(): v for k, v in hook.items()}
+            timeout = hook.get('TIMEOUT', timeout)
+            if isinstance(hook.get('CMD'), str) and (
+                    timeout is None or
+                    (isinstance(timeout, (int, float)) and
+                     not isinstance(timeout, bool) and timeout >= 0)):
+                return cls(hook['CMD'], timeout)
+        raise ValueError(f'Invalid pre-shutdown hook {hook!r}')
+
+
+class HookRun():
+    """
+    Hooks running concurrently in background threads, each until its
+    timeout or the deadline
+
+    Args:
+        hooks (list(Hook)): The hooks
+        deadline (float, optional): Seconds all hooks must finish in
+
+    Methods:
+        cancel():
+            Kills the hooks that are still running.
+        wait():
+            Waits for the hooks, and returns the outcome of each.
+    """
+
+    def __init__(self, hooks: list, deadline: float = None):
+        self.hooks = list(hooks)
+        self._cancel = threading.Event()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(len(self.hooks), 1))
+        self._futures = [
+            self._executor.submit(run_command, hook.command,
+                                  self._timeout(hook, deadline), self._cancel)
+            for hook in self.hooks
+        ]
+        # The threads exit once the hooks are done
+        self._executor.shutdown(wait=False)
+
+    @staticmethod
+    def _timeout(hook: Hook, deadline: float):
+        timeouts = [t for t in (hook.timeout, deadline) if t is not None]
+        return max(min(timeouts), 0) if timeouts else None
+
+    def cancel(self):
+        self._cancel.set()
+
+    def done(self):
+        return all(future.done() for future in self._futures)
+
+    def wait(self):
+        """Waits for the hooks
+
+        Returns:
+            [list(CommandResult)]: The outcome of each hook, in order
+        """
+        return [future.result() for future in self._futures]
+
+
+def run_hooks(hooks: list, deadline: float = None):
+    """Runs hooks concurrently, each until its timeout or the deadline
+
+    Args:
+        hooks (list(Hook)): The hooks
+        deadline (float, optional): Seconds all hooks must finish in
+
+    Returns:
+        [list(CommandResult)]: The outcome of each hook, in order
+    """
+    return HookRun(hooks, deadline).wait()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Implements streaming exports of shedding windows as iCalendar or JSON lines
+
+All functions are generators, so that exports of many areas over long date
+ranges run in constant memory.
+"""
+import heapq
+from datetime import datetime, timedelta, timezone
+
+# The schedules are in South Africa Standard Time, UTC+2 without daylight
+# saving time
+UTC_OFFSET = timedelta(hours=2)
+
+FORMATS = ('ical', 'jsonl')
+
+
+def merge_areas(windows_by_area: dict):
+    """Merges the windows of several areas into one stream, ordered by start
+
+    Args:
+        windows_by_area (dict): Iterables of (start, end, stage) windows,
+            ordered by start, per area
+
+    Yields:
+        [tuple(str, datetime, datetime, int)]: (area, start, end, stage)
+    """
+    def events(area, windows):
+        for start, end, stage in windows:
+            yield area, start, end, stage
+
+    streams = [
+        events(area, windows) for area, windows in windows_by_area.items()
+    ]
+    yield from heapq.merge(*streams, key=lambda event: (event[1], event[0]))
+
+
+def format_utc(date: datetime):
+    return (date - UTC_OFFSET).strftime('%Y%m%dT%H%M%SZ')
+
+
+def ical_lines(events, date_stamp: datetime = None):
+    """Yields an iCalendar file, line by line
+
+    Args:
+        events (iterable): (area, start, end, stage) of each window, with
+            naive SAST times and an exclusive end
+        date_stamp (datetime, optional): Creation time of the events, in
+            SAST. Default is now
+
+    Yields:
+        [str]: Lines, with CRLF line endings
+    """
+    if date_stamp is None:
+        date_stamp = datetime.now(timezone.utc).replace(tzinfo=None) + \
+            UTC_OFFSET
+    stamp = format_utc(date_stamp)
+
+    yield 'BEGIN:VCALENDAR\r\n'
+    yield 'VERSION:2.0\r\n'
+    yield 'PRODID:-//loadshedding//schedule export//EN\r\n'
+    yield 'CALSCALE:GREGORIAN\r\n'
+    for area, start, end, stage in events:
+        start_utc = format_utc(start)
+        yield 'BEGIN:VEVENT\r\n'
+        yield f'UID:{start_utc}-{area}-{stage}@loadshedding\r\n'
+        yield f'DTSTAMP:{stamp}\r\n'
+        yield f'DTSTART:{start_utc}\r\n'
+        yield f'DTEND:{format_utc(end)}\r\n'
+        yield f'SUMMARY:Loadshedding area {area} (stage {stage})\r\n'
+        yield 'END:VEVENT\r\n'
+    yield 'END:VCALENDAR\r\n'
+
+
+def jsonl_lines(events):
+    """Yields a JSON object per window
+
+    Args:
+        events (iterable): (area, start, end, stage) of each window, with
+            naive SAST times and an exclusive end
+
+    Yields:
+        [str]: Lines, e.g.
+            {"area": "8", "start": "2021-07-13T10:00:00+02:00",
+             "end": "2021-07-13T12:30:00+02:00", "stage": 3}
+    """
+    import json
+
+    for area, start, end, stage in events:
+        yield json.dumps({
+            'area': area,
+            'start': start.isoformat() + '+02:00',
+            'end': end.isoformat() + '+02:00',
+            'stage': stage,
+        }) + '\n'
+
+
+def export_lines(events, format: str):
+    """Yields the lines of events in format, one of FORMATS"""
+    if format == 'ical':
+        return ical_lines(events)
+    if format == 'jsonl':
+        return jsonl_lines(events)
+    raise ValueError(f'Unknown export format {format!r}, expected one of '
+                     f'{", ".join(FORMATS)}')
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Implements the evaluation of the shedding status of many hosts at once
+"""
+from datetime import datetime, timedelta
+
+from lutils.lindex import ScheduleIndex
+from lutils.lschedule import Schedule
+
+
+def _schedule_of(schedule):
+    if isinstance(schedule, ScheduleIndex):
+        return schedule.schedule
+    if isinstance(schedule, Schedule):
+        return schedule
+    raise TypeError(f'Expected a Schedule or ScheduleIndex, got {schedule!r}')
+
+
+def _evaluate_numpy(np, schedule: Schedule, entries: list, stage: int,
+                    date_check: datetime):
+    tensor = schedule.to_numpy()
+    stage = min(stage, schedule.n_stages)
+    now = date_check.hour*60 + date_check.minute
+    day = date_check.day
+    day_tomorrow = (date_check + timedelta(days=1)).day
+
+    codes = np.array([schedule.area_code(area) for area, _, _ in entries],
+                     dtype=np.uint16)
+    pad_start = np.array([pad for _, pad, _ in entries], dtype=np.int32)
+    ignore_end = np.array([ignore for _, _, ignore in entries],
+                          dtype=np.int32)
+    starts = np.array(schedule.starts, dtype=np.int32)[:, None]
+    ends = np.array(schedule.ends, dtype=np.int32)[:, None]
+
+    shedding = np.zeros(len(entries), dtype=bool)
+    for d, offset in ((day, 0), (day_tomorrow, 24*60)):
+        # (slots, stage) areas shed up to the current stage
+        areas = tensor[:, :stage, d - 1]
+        # (slots, entries) whether the entry's area is shed in the slot
+        shed = (areas[:, :, None] == codes[None, None, :]).any(axis=1)
+        active = ((starts + offset - pad_start[None, :] <= now) &
+                  (now <= ends + offset - ignore_end[None, :]))
+        shedding |= (shed & active & (codes != 0)[None, :]).any(axis=0)
+    return shedding.tolist()
+
+
+def _evaluate_index(index: ScheduleIndex, entries: list, stage: int,
+                    date_check: datetime):
+    now = date_check.hour*60 + date_check.minute
+    day = date_check.day
+    day_tomorrow = (date_check + timedelta(days=1)).day
+
+    shedding = []
+    for area, pad_start, ignore_end in entries:
+        shedding.append(any(
+            any(index.lookup(str(area), d, now, stage, pad_start, ignore_end,
+                             offset=offset))
+            for d, offset in ((day, 0), (day_tomorrow, 24*60))
+        ))
+    return shedding
+
+
+def evaluate_fleet(entries: list, stage_current: int, date_check: datetime,
+                   use_numpy: bool = None):
+    """Evaluates the shedding status of many (schedule, area) pairs at once
+
+    The status of each entry is the same as check_shedding in loadshedding.py
+    would return for it. Entries are grouped by schedule, and each group is
+    evaluated in one vectorized pass over the schedule tensor.
+
+    NumPy is only imported when it is used, it is not a hard dependency.
+
+    Args:
+        entries (list(tuple)): Tuples of (schedule, area, PAD_START,
+            IGNORE_END), where schedule is a Schedule or ScheduleIndex. Share
+            the schedule objects between entries, entries are grouped by
+            schedule object.
+        stage_current (int): Loadshedding stage
+        date_check (datetime): Time to evaluate
+        use_numpy (bool, optional): Use NumPy. By default NumPy is used if it
+            is installed, otherwise the ScheduleIndex of each schedule is
+            used.
+
+    Returns:
+        [list(bool)]: Shedding status of each entry, in the order of entries
+    """
+    np = None
+    if use_numpy or use_numpy is None:
+        try:
+            import numpy as np
+        except ImportError:
+            if use_numpy:
+                raise
+
+    groups = {}
+    for i, (schedule, area, pad_start, ignore_end) in enumerate(entries):
+        group = groups.setdefault(id(schedule), (schedule, [], []))
+        group[1].append(i)
+        group[2].append((area, pad_start, ignore_end))
+
+    shedding = [False] * len(entries)
+    for schedule, indices, group_entries in groups.values():
+        if stage_current <= 0:
+            continue
+        if np is not None:
+            status = _evaluate_numpy(np, _schedule_of(schedule),
+                                     group_entries, stage_current, date_check)
+        else:
+            if not isinstance(schedule, ScheduleIndex):
+                schedule = ScheduleIndex(_schedule_of(schedule))
+            status = _evaluate_index(schedule, group_entries, stage_current,
+                                     date_check)
+        for i, s in zip(indices, status):
+            shedding[i] = s
+    return shedding
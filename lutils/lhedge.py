@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Implements hedged calls: the same question is asked to several sources
+concurrently, and the first valid answer (or the first answer a quorum of
+sources agree on) is used
+"""
+import asyncio
+import threading
+
+
+class HedgeError(RuntimeError):
+    """Raised when no answer reached the quorum
+
+    Args:
+        errors (list(Exception)): The errors of the sources that failed
+    """
+
+    def __init__(self, message: str, errors: list = None):
+        super().__init__(message)
+        self.errors = list(errors) if errors is not None else []
+
+
+def _run_in_thread(loop: asyncio.AbstractEventLoop, fn):
+    """Runs the blocking fn in a daemon thread, as an asyncio future
+
+    Unlike asyncio.to_thread, the thread does not keep the event loop (or the
+    interpreter) from exiting once the future is cancelled.
+    """
+    future = loop.create_future()
+
+    def set_result(result, error):
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run():
+        try:
+            result, error = fn(), None
+        except Exception as e:
+            result, error = None, e
+        try:
+            loop.call_soon_threadsafe(set_result, result, error)
+        except RuntimeError:
+            # The loop is already closed, the answer is no longer needed
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+async def hedge_async(calls: list, quorum: int = 1, timeout: float = None,
+                      on_error=None, cancel: threading.Event = None):
+    """Runs calls concurrently, and returns the first answer quorum of them
+    agree on. The remaining calls are cancelled.
+
+    A thread cannot be stopped from the outside, so the calls that are still
+    running are told to stop with cancel, and their answers are ignored.
+
+    Args:
+        calls (list(callable)): Blocking functions without arguments, each
+            returning an answer or raising an exception
+        quorum (int, optional): Number of calls that must return the same
+            answer
+        timeout (float, optional): Seconds to wait for the quorum
+        on_error (callable, optional): Receives the index of the call and the
+            exception of each failed call, e.g. to log it
+        cancel (threading.Event, optional): Set when hedge_async returns or
+            raises, the calls should check it and stop early
+
+    Raises:
+        HedgeError: Raised when the quorum cannot be reached, or the timeout
+            expired
+
+    Returns:
+        [tuple]: The answer, and the indices of the calls that returned it
+    """
+    loop = asyncio.get_running_loop()
+    futures = {_run_in_thread(loop, call): i for i, call in enumerate(calls)}
+    pending = set(futures)
+    answers = {}
+    errors = []
+    deadline = None if timeout is None else loop.time() + timeout
+    try:
+        while pending:
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                break
+            done, pending = await asyncio.wait(
+                pending, timeout=remaining,
+                return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                i = futures[future]
+                if future.exception() is not None:
+                    errors.append(future.exception())
+                    if on_error is not None:
+                        on_error(i, future.exception())
+                    continue
+                indices = answers.setdefault(future.result(), [])
+                indices.append(i)
+                if len(indices) >= quorum:
+                    return future.result(), sorted(indices)
+            # Stop early if the quorum is out of reach
+            if max(map(len, answers.values()), default=0) + len(pending) \
+                    < quorum:
+                break
+    finally:
+        for future in pending:
+            future.cancel()
+        if cancel is not None:
+            cancel.set()
+
+    raise HedgeError(
+        f'No answer reached a quorum of {quorum}: answers {answers}, '
+        f'errors {[str(e) for e in errors]}',
+        errors)
+
+
+def hedge(calls: list, quorum: int = 1, timeout: float = None,
+          on_error=None, cancel: threading.Event = None):
+    """Blocking version of hedge_async, see hedge_async
+    """
+    return asyncio.run(hedge_async(
+        calls, quorum=quorum, timeout=timeout, on_error=on_error,
+        cancel=cancel))
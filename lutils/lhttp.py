@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Implements an on-disk HTTP response cache for the stage queries, honoring
+ETag, Last-Modified and Cache-Control, with a stale-if-error fallback
+"""
+import hashlib
+import os
+import pickle
+import time
+import urllib.error
+import urllib.request
+
+import lutils.lcache
+
+
+def parse_cache_control(header: str):
+    """Parses a Cache-Control header into a dict of directives
+
+    Args:
+        header (str): The header value, e.g. 'public, max-age=60'
+
+    Returns:
+        [dict]: Lowercase directive names, and their value (None if the
+            directive has no value)
+    """
+    directives = {}
+    for directive in (header or '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"') if value else None
+    return directives
+
+
+class HttpCache():
+    """
+    An on-disk cache of HTTP GET responses, one file per URL.
+
+    A cached response is reused without a request for ttl seconds, or for
+    less if the server's Cache-Control max-age is shorter. Responses marked
+    no-cache or no-store are always revalidated. Once a response is stale,
+    it is revalidated with a conditional request (If-None-Match and
+    If-Modified-Since), so an unchanged response is not downloaded again.
+
+    If the request fails, a cached response that is at most stale_if_error
+    seconds old is used instead, without retrying.
+
+    Args:
+        directory (str): Directory for the cache files
+        ttl (float): Maximum seconds a response is reused without a request
+        stale_if_error (float): Maximum age, in seconds, of a cached response
+            that is used if the request fails
+
+    Methods:
+        fetch(url: str, timeout: float = 10, validate=None):
+            Gets the body of url, from the cache or the network.
+    """
+
+    def __init__(self, directory: str, ttl: float = 0,
+                 stale_if_error: float = 0):
+        self.directory = directory
+        self.ttl = ttl
+        self.stale_if_error = stale_if_error
+
+    def path(self, url: str):
+        """Path of the cache file for url"""
+        name = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, name)
+
+    def load(self, url: str):
+        """The cached entry for url, or None
+
+        Returns:
+            [dict or None]: With the keys url, body (bytes), etag,
+                last_modified, cache_control, freshness (seconds) and fetched
+                (seconds since the epoch).
+        """
+        try:
+            with open(self.path(url), 'rb') as f:
+                entry = pickle.loads(f.read())
+        except Exception:
+            return None
+        if not isinstance(entry, dict) or entry.get('url') != url:
+            return None
+        return entry
+
+    def store(self, url: str, entry: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        lutils.lcache.write_atomic(
+            self.path(url),
+            pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def freshness(self, cache_control: dict):
+        """Seconds a response may be reused without a request
+
+        Args:
+            cache_control (dict): The response's Cache-Control directives
+        """
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return 0
+        if 'max-age' in cache_control:
+            try:
+                return min(self.ttl, max(int(cache_control['max-age']), 0))
+            except ValueError:
+                return 0
+        return self.ttl
+
+    def fetch(self, url: str, timeout: float = 10, validate=None):
+        """Gets the body of url, from the cache or the network
+
+        Args:
+            url (str): URL to GET
+            timeout (float, optional): Timeout of the request, in seconds
+            validate (callable, optional): Receives the body, and raises an
+                exception if it is not a valid response. Invalid responses are
+                not cached, and are handled like a failed request.
+
+        Raises:
+            Exception: The error of the request, or of validate, if there is
+                no usable cached response
+
+        Returns:
+            [tuple(bytes, str)]: The body, and where it came from: 'fresh'
+                (the cache, without a request), 'revalidated' (the cache, the
+                server responded 304 Not Modified), 'fetched' (the network) or
+                'stale' (the cache, since the request failed).
+        """
+        now = time.time()
+        entry = self.load(url)
+        if entry is not None and now - entry['fetched'] < entry['freshness']:
+            return entry['body'], 'fresh'
+
+        request = urllib.request.Request(url)
+        if entry is not None:
+            if entry['etag']:
+                request.add_header('If-None-Match', entry['etag'])
+            if entry['last_modified']:
+                request.add_header('If-Modified-Since',
+                                   entry['last_modified'])
+
+        try:
+            try:
+                with urllib.request.urlopen(
+                        request, timeout=timeout) as response:
+                    body = response.read()
+                    headers = response.headers
+                source = 'fetched'
+            except urllib.error.HTTPError as e:
+                if e.code != 304 or entry is None:
+                    raise
+                body = entry['body']
+                headers = e.headers
+                source = 'revalidated'
+
+            if validate is not None:
+                validate(body)
+        except Exception:
+            if (entry is not None and
+                    now - entry['fetched'] <= self.stale_if_error):
+                return entry['body'], 'stale'
+            raise
+
+        # A 304 response only updates the headers it includes
+        stored = {
+            'etag': headers.get('ETag'),
+            'last_modified': headers.get('Last-Modified'),
+            'cache_control': headers.get('Cache-Control'),
+        }
+        if source == 'revalidated':
+            stored = {k: v if v is not None else entry[k]
+                      for k, v in stored.items()}
+        cache_control = parse_cache_control(stored['cache_control'])
+        if 'no-store' not in cache_control:
+            self.store(url, {
+                'url': url,
+                'body': body,
+                **stored,
+                'freshness': self.freshness(cache_control),
+                'fetched': now,
+            })
+        return body, source
+
+
+def fetch(url: str, timeout: float = 10, cache: HttpCache = None,
+          validate=None):
+    """Gets the body of url, through cache if given
+
+    See HttpCache.fetch
+    """
+    if cache is not None:
+        return cache.fetch(url, timeout=timeout, validate=validate)
+
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        body = response.read()
+    if validate is not None:
+        validate(body)
+    return body, 'fetched'
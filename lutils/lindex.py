@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Implements a compiled, per-area interval index of the schedules
+"""
+from bisect import bisect_left, bisect_right
+
+from lutils.lschedule import Schedule
+
+
+class ScheduleIndex():
+    """
+    A compiled lookup structure over a `lutils.lschedule.Schedule`.
+
+    For every (area, day-of-month) pair the index holds the intervals in which
+    the area is shed, sorted by start time, with the start and end already
+    parsed to minutes since midnight. Intervals that wrap around midnight
+    (e.g. 22:00 - 00:30) have 24 hours added to their end, as the schedule
+    intends.
+
+    Each interval is tagged with the stage at which it appears in the
+    schedule, i.e. the minimum stage at which the area is shed during that
+    interval.
+
+    Args:
+        schedule (Schedule or list(dict)): The schedule, or its rows as read
+            by `lutils.lcsv.read_csv` with the 'stage' column transformed to
+            int.
+
+    Attributes:
+        schedule (Schedule): The schedule
+        max_length (int): Length of the longest interval in the schedule, in
+            minutes.
+    """
+
+    def __init__(self, schedule):
+        if not isinstance(schedule, Schedule):
+            schedule = Schedule.from_rows(schedule)
+        self.schedule = schedule
+        self.max_length = max(
+            (end - start for start, end in zip(schedule.starts, schedule.ends)),
+            default=0)
+
+        # Compiled on first use, per (area code, day), so that loading a
+        # cached schedule does not compile the intervals of every area
+        self._intervals = {}
+
+    def _entries(self, area: str, day: int):
+        code = self.schedule.area_code(area)
+        key = (code, day)
+        try:
+            return self._intervals[key]
+        except KeyError:
+            pass
+        if not code:
+            return ((), ())
+
+        schedule = self.schedule
+        entries = []
+        for slot, ((start_str, end_str), start, end) in enumerate(
+                zip(schedule.slots, schedule.starts, schedule.ends)):
+            for stage in range(1, schedule.n_stages + 1):
+                if schedule.codes[schedule.offset(slot, stage, day)] == code:
+                    entries.append((start, end, stage,
+                                    schedule.row(slot, stage),
+                                    start_str, end_str))
+        entries.sort()
+        self._intervals[key] = ([entry[0] for entry in entries], entries)
+        return self._intervals[key]
+
+    @classmethod
+    def of(cls, schedule):
+        """Returns schedule if it is already compiled, else compiles it
+
+        Args:
+            schedule (ScheduleIndex, Schedule or list(dict)): The schedule
+
+        Returns:
+            [ScheduleIndex]: The compiled schedule
+        """
+        if isinstance(schedule, cls):
+            return schedule
+        return cls(schedule)
+
+    def intervals(self, area: str, day: int):
+        """All intervals for an area on a day-of-month, sorted by start
+
+        Args:
+            area (str): The area, as it appears in the schedule
+            day (int): Day of the month
+
+        Returns:
+            [list(tuple)]: Tuples of (start, end, stage, row index, start str,
+                end str), start and end in minutes since midnight.
+        """
+        return self._entries(area, day)[1]
+
+    def lookup(self, area: str, day: int, now: int, stage: int,
+               pad_start: int, ignore_end: int, offset: int = 0):
+        """Yields the intervals of area on day that are active at now
+
+        An interval is active if
+            start + offset - pad_start <= now <= end + offset - ignore_end
+        and its stage is not higher than stage.
+
+        Args:
+            area (str): The area, as it appears in the schedule
+            day (int): Day of the month of the intervals
+            now (int): Minutes since midnight to check
+            stage (int): Current loadshedding stage
+            pad_start (int): Minutes to pad the start of intervals with
+            ignore_end (int): Minutes to ignore at the end of intervals
+            offset (int, optional): Minutes to shift the intervals by, e.g.
+                24*60 to check the intervals of the following day.
+
+        Yields:
+            [tuple]: (start, end, stage, row index, start str, end str)
+        """
+        starts, entries = self._entries(area, day)
+        if not starts:
+            return
+
+        # Only intervals starting at most pad_start after now can be active,
+        # and since no interval is longer than max_length, only those
+        # starting less than max_length before now can still be running.
+        hi = bisect_right(starts, now + pad_start - offset)
+        lo = bisect_left(starts, now + ignore_end - offset - self.max_length)
+        for entry in entries[lo:hi]:
+            start, end, entry_stage = entry[:3]
+            if (entry_stage <= stage and
+                    start + offset - pad_start <= now
+                    <= end + offset - ignore_end):
+                yield entry
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Implements counters, gauges and histograms, exposed in the Prometheus text
+format by a lightweight HTTP server on a thread
+"""
+import bisect
+import math
+import threading
+
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+    5, 10, 30,
+)
+
+
+def format_value(value: float):
+    if isinstance(value, int):
+        return str(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def format_labels(labels: tuple):
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+        for name, value in labels)
+    return '{' + pairs + '}'
+
+
+def labels_key(labels: dict):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+class Metric():
+    """
+    A metric, with a value per combination of labels
+
+    Args:
+        name (str): Metric name, e.g. 'loadshedding_stage'
+        help (str): Description of the metric
+    """
+    TYPE = 'untyped'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """Yields (name suffix, labels tuple, value) of each sample"""
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield '', labels, value
+
+    def render(self):
+        """The metric in the Prometheus text format"""
+        lines = [
+            f'# HELP {self.name} {self.help}',
+            f'# TYPE {self.name} {self.TYPE}',
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(
+                f'{self.name}{suffix}{format_labels(labels)} '
+                f'{format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = labels_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        return self._values.get(labels_key(labels), 0.0)
+
+
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[labels_key(labels)] = value
+
+    def value(self, **labels):
+        return self._values.get(labels_key(labels), math.nan)
+
+
+class Histogram(Metric):
+    """
+    A histogram of observed values, e.g. durations in seconds
+
+    Args:
+        buckets (tuple(float), optional): Sorted upper bounds of the buckets,
+            a +Inf bucket is always added
+    """
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = labels_key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(
+                key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        counts, _ = self._values.get(labels_key(labels), ((), 0.0))
+        return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            values = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._values.items()
+            }
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield '_bucket', labels + (('le', format_value(bound)),), \
+                    cumulative
+            yield '_sum', labels, total
+            yield '_count', labels, cumulative
+
+
+class Registry():
+    """A set of metrics, rendered together"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name: str, help: str):
+        return self.register(Gauge(name, help))
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text format"""
+        return ''.join(metric.render() for metric in self.metrics)
+
+
+def serve(registry: Registry, port: int, address: str = '127.0.0.1'):
+    """Serves registry at http://address:port/metrics, on a daemon thread
+
+    Args:
+        registry (Registry): The metrics
+        port (int): Port to listen on, 0 for any free port
+        address (str, optional): Address to listen on
+
+    Returns:
+        [http.server.ThreadingHTTPServer]: The server, call shutdown() to stop
+            it
+    """
+    # Only import when needed, the metrics are only served by the daemon
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header(
+                'Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Implements a single-flight proxy of the stage API, so that a fleet of hosts
+querying at the same minute results in one upstream request
+"""
+import threading
+import time
+
+
+class SingleFlight():
+    """
+    Calls fetch at most once at a time, and reuses its result for ttl seconds
+
+    Callers that arrive while fetch runs wait for it, and get its result (or
+    its error) instead of calling fetch again. Errors are not reused after
+    the call that raised them. If fetch raises a BaseException, e.g.
+    KeyboardInterrupt, the waiters get a RuntimeError.
+
+    Args:
+        fetch (callable): Returns the result, or raises an exception
+        ttl (float): Seconds a result is reused without calling fetch
+        clock (callable, optional): Monotonic clock, in seconds
+
+    Attributes:
+        fetches (int): Number of calls of fetch
+    """
+
+    def __init__(self, fetch, ttl: float, clock=time.monotonic):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.clock = clock
+        self.fetches = 0
+        self._condition = threading.Condition()
+        self._busy = False
+        self._flight = 0
+        self._result = None
+        self._error = None
+        self._fetched = None
+
+    def get(self):
+        """The result of fetch, from the last call if it is fresh
+
+        Raises:
+            Exception: The error of fetch
+
+        Returns:
+            [tuple(object, float)]: The result, and its age in seconds
+        """
+        with self._condition:
+            if (self._error is None and self._fetched is not None and
+                    self.clock() - self._fetched < self.ttl):
+                return self._result, self.clock() - self._fetched
+            if self._busy:
+                flight = self._flight
+                self._condition.wait_for(lambda: self._flight != flight)
+                if self._error is not None:
+                    raise self._error
+                return self._result, self.clock() - self._fetched
+            self._busy = True
+            self.fetches += 1
+
+        # Always release the waiters, also if fetch is interrupted, e.g. by
+        # KeyboardInterrupt, which they get as a RuntimeError
+        result, error = None, None
+        try:
+            result = self.fetch()
+        except Exception as e:
+            error = e
+            raise
+        except BaseException:
+            error = RuntimeError('The fetch was interrupted')
+            raise
+        finally:
+            self._done(result, error)
+        return result, 0.0
+
+    def _done(self, result, error: Exception):
+        with self._condition:
+            if error is None:
+                self._result = result
+                self._fetched = self.clock()
+            self._error = error
+            self._busy = False
+            self._flight += 1
+            self._condition.notify_all()
+
+
+def make_server(flight: SingleFlight, port: int, address: str = '127.0.0.1',
+                content_type: str = 'text/plain; charset=utf-8',
+                on_error=None):
+    """An HTTP server that responds to every GET with the body flight gets
+
+    The response has a Cache-Control max-age of the time left of the TTL, so
+    clients with an HTTP cache reuse it until then too. If the upstream
+    request fails, the response is 502 Bad Gateway.
+
+    Args:
+        flight (SingleFlight): Gets the body (bytes)
+        port (int): Port to listen on, 0 for any free port
+        address (str, optional): Address to listen on
+        content_type (str, optional): Content-Type of the responses
+        on_error (callable, optional): Receives the exception of each failed
+            request, e.g. to log it
+
+    Returns:
+        [http.server.ThreadingHTTPServer]: The server, call serve_forever()
+            to serve
+    """
+    # Only import when needed, the proxy only runs with --serve-stage
+    import http.server
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                body, age = flight.get()
+            except Exception as e:
+                if on_error is not None:
+                    on_error(e)
+                self.send_error(502, 'Stage API unavailable')
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header(
+                'Cache-Control', f'max-age={max(int(flight.ttl - age), 0)}')
+            self.send_header('Age', str(int(age)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Implements a what-if replay of the stage history in the LOGSTAGE logs: how
+many times CMD would have run, how many shutdowns were early, and how many
+outages were missed, for a grid of areas and PAD_START/IGNORE_END settings
+
+The replay is vectorized with NumPy over the minutes of the history. NumPy is
+only imported when replaying, it is not a dependency of loadshedding.
+"""
+import glob
+import itertools
+import re
+from array import array
+from datetime import datetime, timedelta
+
+from lutils.lindex import ScheduleIndex
+
+EPOCH = datetime(1970, 1, 1)
+
+# A line of the stage logger: '2021-07-13 10:00:00,123 - INFO - 3', or
+# 'skipped' if main did not query the stage, see SKIPPED
+LINE_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})(?:,\d+)? - \w+ - '
+    r'(-?\d+|skipped)\s*$')
+SKIPPED = 'skipped'
+# A stage schedule logged in loadshedding_thingamabob mode, the API response:
+# '2021-07-13 10:00:00,123 - INFO - {"schedule_csv": ...}'
+SCHEDULE_PATTERN = re.compile(
+    r'^(\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})(?:,\d+)? - \w+ - (\{.*\})\s*$')
+
+
+def to_minute(date: datetime):
+    """Minutes since EPOCH of the (naive) date"""
+    return int((date - EPOCH) // timedelta(minutes=1))
+
+
+def from_minute(minute: int):
+    return EPOCH + timedelta(minutes=int(minute))
+
+
+class StageHistory():
+    """
+    The stage over time, as the minutes at which it changed
+
+    A stage holds until the next logged stage. A stage schedule logged in
+    loadshedding_thingamabob mode holds until the next logged line, with the
+    stage at each minute taken from the schedule.
+
+    main only queries the stage while the configured AREA is shed at some
+    stage, given its PAD_START and IGNORE_END, and otherwise logs SKIPPED.
+    The last stage is carried across the skipped runs, and across the gaps
+    while the host is off, so the replay is exact around the windows of the
+    area that logged the history, and less so for other areas, or a larger
+    PAD_START, e.g. when the stage changed while skipped. The stage log of
+    the daemon, which queries every POLL_INTERVAL, is not skipped.
+
+    Args:
+        minutes (array): Sorted minutes since EPOCH at which the stage changed
+        stages (array): The stage from each minute on
+        end (int): Minute after the last logged line
+    """
+
+    def __init__(self, minutes: array, stages: array, end: int):
+        self.minutes = minutes
+        self.stages = stages
+        self.end = end
+
+    @classmethod
+    def from_lines(cls, lines, build_timeline=None):
+        """Parses stage logger lines, in any order
+
+        Args:
+            lines (iterable(str)): The lines
+            build_timeline (callable, optional): Receives a logged stage
+                schedule (the loadshedding_thingamabob API response), the
+                datetime it was logged and the datetime of the next line, and
+                returns its lutils.ltimeline.StageTimeline in between, e.g.
+                with loadshedding.build_stage_timeline. Without it, the stage
+                schedules are skipped.
+
+        Raises:
+            ValueError: Raised when there is no stage (or stage schedule)
+                line, instead of replaying no shedding at all
+        """
+        entries = []
+        n_lines = 0
+        for line in lines:
+            n_lines += 1
+            match = LINE_PATTERN.match(line)
+            if match is not None:
+                value = match.group(2)
+                # The stage is not known at a skipped run, None carries it
+                value = None if value == SKIPPED else max(int(value), 0)
+            elif build_timeline is not None:
+                match = SCHEDULE_PATTERN.match(line)
+                if match is None:
+                    continue
+                value = match.group(2)
+            else:
+                continue
+            date = datetime.strptime(match.group(1), '%Y-%m-%d %H:%M:%S')
+            entries.append((to_minute(date), value))
+        if all(value is None for _, value in entries):
+            raise ValueError(
+                f'No stage in the {n_lines} lines of the stage log')
+        entries.sort(key=lambda entry: entry[0])
+
+        records = []
+        for i, (minute, value) in enumerate(entries):
+            if value is None:
+                continue
+            if isinstance(value, int):
+                records.append((minute, value))
+                continue
+            # Until the next stage or stage schedule, or the end
+            end = next((m for m, v in entries[i + 1:] if v is not None),
+                       entries[-1][0] + 1)
+            timeline = build_timeline(
+                value, from_minute(minute), from_minute(max(end, minute + 1)))
+            for date, _, stage in timeline.segments():
+                records.append((to_minute(date), max(stage, 0)))
+
+        minutes, stages = array('q'), array('b')
+        for minute, stage in records:
+            if stages and stages[-1] == stage:
+                continue
+            if minutes and minutes[-1] == minute:
+                stages[-1] = stage
+                continue
+            minutes.append(minute)
+            stages.append(stage)
+        return cls(minutes, stages, entries[-1][0] + 1)
+
+    @classmethod
+    def from_logs(cls, path: str, build_timeline=None):
+        """Reads the stage log at path, and its rotated logs (path.*)
+
+        Args:
+            path (str): Path to the stage log
+            build_timeline (callable, optional): See from_lines
+
+        Raises:
+            ValueError: Raised when there is no stage line, see from_lines
+        """
+        paths = [path] + sorted(
+            p for p in glob.glob(glob.escape(path) + '.*')
+            if re.search(r'\.\d{4}-\d{2}-\d{2}(_\d{2}(-\d{2}){0,2})?$', p))
+
+        def lines():
+            for p in paths:
+                try:
+                    with open(p, 'r', errors='replace') as f:
+                        yield from f
+                except FileNotFoundError:
+                    continue
+        return cls.from_lines(lines(), build_timeline)
+
+    @property
+    def start(self):
+        return self.minutes[0] if self.minutes else 0
+
+    def per_minute(self, np, start: int, end: int):
+        """The stage of each minute in [start, end), 0 before the history"""
+        minutes = np.frombuffer(self.minutes, dtype=np.int64)
+        stages = np.frombuffer(self.stages, dtype=np.int8)
+        i = np.searchsorted(minutes, np.arange(start, end), side='right') - 1
+        return np.where(i >= 0, stages[np.maximum(i, 0)], 0).astype(np.int8)
+
+
+def schedule_blocks(np, index: ScheduleIndex, area: str, start: int,
+                    end: int):
+    """The shedding blocks of area between the minutes start and end
+
+    Returns:
+        [tuple(ndarray, ndarray, ndarray, ndarray)]: The start minute, the
+            end minute (exclusive), the last minute of the day (blocks are cut
+            at midnight, check_shedding does not look at the previous day) and
+            the lowest stage of each block
+    """
+    starts, ends, lasts, stages = [], [], [], []
+    day = from_minute(start).replace(hour=0, minute=0)
+    # Blocks of the next day can start within PAD_START
+    while to_minute(day) < end + 24*60:
+        day_start = to_minute(day)
+        for block_start, block_end, stage, *_ in index.intervals(
+                area, day.day):
+            starts.append(day_start + block_start)
+            ends.append(day_start + block_end)
+            lasts.append(day_start + 24*60 - 1)
+            stages.append(stage)
+        day += timedelta(days=1)
+    return (np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+            np.array(lasts, dtype=np.int64), np.array(stages, dtype=np.int64))
+
+
+# Bits per stage in the packed coverage counts, see _coverage
+STAGE_BITS = 4
+
+
+def _allowed(np, stage_minute):
+    """Per minute, the mask of the packed coverage fields of stages 1 up to
+    the stage of the minute, see _coverage
+    """
+    masks = np.array(
+        [(1 << (STAGE_BITS * stage)) - 1 for stage in range(16)],
+        dtype=np.int64)
+    return masks[np.clip(stage_minute, 0, 15)]
+
+
+def _coverage(np, allowed, begins, lasts, stages, start: int):
+    """Whether each minute is covered by a block at most at its stage
+
+    The number of blocks covering each minute is counted per stage, packed
+    in STAGE_BITS bit fields of one int64 (stage s in the bits from
+    STAGE_BITS * (s - 1)), by a single difference array. Up to 15 blocks of
+    a stage can overlap.
+
+    Args:
+        allowed (ndarray): Per minute, from the minute start, see _allowed
+        begins (ndarray): First minute of each block
+        lasts (ndarray): Last minute of each block, inclusive
+        stages (ndarray): Lowest stage of each block
+
+    Returns:
+        [ndarray]: bool per minute
+    """
+    n = len(allowed)
+    begins = np.clip(begins - start, 0, n)
+    ends = np.clip(lasts - start + 1, 0, n)
+    keep = (begins < ends) & (stages >= 1) & (stages <= 15)
+    fields = np.left_shift(1, STAGE_BITS * (stages[keep] - 1)).astype(
+        np.int64)
+    diff = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(diff, begins[keep], fields)
+    np.add.at(diff, ends[keep], -fields)
+    return (np.cumsum(diff[:n]) & allowed) != 0
+
+
+def _rising(np, mask):
+    """Whether each minute starts a run of True"""
+    rising = mask.copy()
+    rising[1:] &= ~mask[:-1]
+    return rising
+
+
+def replay(history: StageHistory, schedule, areas: list, pads_start: list,
+           ignores_end: list, date_from: datetime = None,
+           date_to: datetime = None):
+    """Replays the history for every combination of area, PAD_START and
+    IGNORE_END
+
+    A minute is shut down if check_shedding would return True for it (with
+    the stage of that minute), and is an outage if the area is shed then, per
+    the schedule. Unlike the shutdowns, which check_shedding cuts at midnight,
+    the outages last until the blocks end, e.g. 22:00 - 00:30 the next day.
+    For each combination:
+        executions: number of times CMD would run, one per run of shut down
+            minutes (the ran check keeps it from running again in a run)
+        early_shutdowns: executions without any outage before the end of the
+            run, e.g. the stage was lowered during PAD_START
+        early_minutes: shut down minutes without an outage
+        missed_windows: outages that start while not shut down
+        outage_windows: number of outages
+
+    Args:
+        history (StageHistory): The stage history
+        schedule (ScheduleIndex or Schedule): The schedule
+        areas (list(str)): Areas to replay
+        pads_start (list(int)): PAD_START values to replay
+        ignores_end (list(int)): IGNORE_END values to replay
+        date_from (datetime, optional): Start of the replay, default is the
+            start of the history
+        date_to (datetime, optional): End of the replay, default is the end
+            of the history
+
+    Returns:
+        [list(dict)]: Per combination, the area, PAD_START, IGNORE_END and
+            the counts
+    """
+    import numpy as np
+
+    index = ScheduleIndex.of(schedule)
+    start = history.start if date_from is None else to_minute(date_from)
+    end = history.end if date_to is None else to_minute(date_to)
+    if end <= start:
+        return []
+    allowed = _allowed(np, history.per_minute(np, start, end))
+
+    results = []
+    for area in areas:
+        begins, ends, day_lasts, stages = schedule_blocks(
+            np, index, str(area), start - 24*60, end)
+        outage = _coverage(np, allowed, begins, ends - 1, stages, start)
+        outage_starts = _rising(np, outage)
+        outage_windows = int(np.count_nonzero(outage_starts))
+
+        for pad_start, ignore_end in itertools.product(
+                pads_start, ignores_end):
+            shutdown = _coverage(
+                np, allowed, begins - pad_start,
+                np.minimum(ends - ignore_end, day_lasts), stages, start)
+            shutdown_starts = _rising(np, shutdown)
+            executions = int(np.count_nonzero(shutdown_starts))
+
+            # Runs of shut down minutes, numbered from 1, and whether each
+            # has an outage
+            run = np.cumsum(shutdown_starts)[shutdown]
+            with_outage = np.bincount(run, weights=outage[shutdown],
+                                      minlength=executions + 1)[1:] > 0
+
+            results.append({
+                'area': str(area),
+                'pad_start': pad_start,
+                'ignore_end': ignore_end,
+                'executions': executions,
+                'early_shutdowns': int(np.count_nonzero(~with_outage)),
+                'early_minutes': int(np.count_nonzero(shutdown & ~outage)),
+                'missed_windows': int(np.count_nonzero(
+                    outage_starts & ~shutdown)),
+                'outage_windows': outage_windows,
+            })
+    return results
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Implements a deadline-bounded retry policy with exponential backoff and
+jitter
+"""
+import random
+import threading
+import time
+import urllib.error
+
+
+# The settings of a RetryPolicy, the (lowercase) RETRY keys
+SETTINGS = ('deadline', 'attempts', 'backoff_initial', 'backoff_max',
+            'backoff_multiplier', 'jitter', 'attempt_timeout')
+
+
+class RetryError(RuntimeError):
+    """Raised when all attempts failed, or an error is not retryable
+
+    Args:
+        last_error (Exception): The error of the last attempt
+    """
+
+    def __init__(self, message: str, last_error: Exception = None):
+        super().__init__(message)
+        self.last_error = last_error
+
+
+class RetryCancelled(RetryError):
+    """Raised when the retries were cancelled, e.g. since another source
+    already answered
+    """
+
+
+class RetryPolicy():
+    """
+    A policy to retry a failing call, bounded by a total deadline.
+
+    Between attempts the policy sleeps for an exponentially increasing
+    backoff, of which a random fraction (jitter) is taken off, so that many
+    hosts failing at the same time do not retry at the same time.
+
+    Args:
+        deadline (float): Total seconds for all attempts, including the
+            backoff between them
+        attempts (int): Maximum number of attempts
+        backoff_initial (float): Seconds to wait after the first failure
+        backoff_max (float): Maximum seconds to wait between attempts
+        backoff_multiplier (float): Factor the backoff grows by per attempt
+        jitter (float): Fraction of the backoff that is randomized, between 0
+            (no jitter) and 1 (wait between 0 and the full backoff)
+        attempt_timeout (float): Timeout of a single attempt, in seconds. It
+            is shortened to the time left until the deadline.
+
+    Methods:
+        call(fn, on_error=None):
+            Calls fn(timeout) until it succeeds, following the policy.
+    """
+
+    def __init__(self, deadline: float = 60, attempts: int = 20,
+                 backoff_initial: float = 1, backoff_max: float = 30,
+                 backoff_multiplier: float = 2, jitter: float = 1,
+                 attempt_timeout: float = 10):
+        self.deadline = deadline
+        self.attempts = attempts
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.backoff_multiplier = backoff_multiplier
+        self.jitter = jitter
+        self.attempt_timeout = attempt_timeout
+
+        self.sleep = time.sleep
+        self.random = random.random
+
+    @classmethod
+    def from_configuration(cls, configuration: dict):
+        """Builds a policy from a configuration dict
+
+        Args:
+            configuration (dict): Any of the constructor's arguments, as
+                (case insensitive) keys, e.g. {'DEADLINE': 30}
+
+        Raises:
+            KeyError: Raised when the configuration contains an unknown key
+
+        Returns:
+            [RetryPolicy]: The policy
+        """
+        kwargs = {k.lower(): v for k, v in (configuration or {}).items()}
+        for k in kwargs:
+            if k not in SETTINGS:
+                raise KeyError(f'Unknown retry policy setting {k.upper()}')
+        return cls(**kwargs)
+
+    def is_retryable(self, error: Exception):
+        """Whether a call that failed with error may succeed when retried
+
+        Client errors (HTTP 4xx, except 408 Request Timeout and 429 Too Many
+        Requests) are not retryable. Connection errors, timeouts, server
+        errors and invalid responses are.
+        """
+        if isinstance(error, urllib.error.HTTPError):
+            return not (400 <= error.code < 500) or error.code in (408, 429)
+        return True
+
+    def backoff(self, attempt: int):
+        """Seconds to wait after the 0-based attempt failed"""
+        backoff = min(
+            self.backoff_initial * self.backoff_multiplier ** attempt,
+            self.backoff_max)
+        return backoff * (1 - self.jitter * self.random())
+
+    def call(self, fn, on_error=None, cancel: threading.Event = None):
+        """Calls fn(timeout) until it succeeds, following the policy
+
+        Args:
+            fn (callable): Receives the timeout of the attempt in seconds, and
+                returns the result or raises an exception
+            on_error (callable, optional): Receives the exception of each
+                failed attempt, e.g. to log it
+            cancel (threading.Event, optional): Stops the retries when set,
+                it is checked before each attempt and during the backoff
+
+        Raises:
+            RetryCancelled: Raised when cancel is set
+            RetryError: Raised when the error is not retryable, the attempts
+                are exhausted, or the deadline is reached
+
+        Returns:
+            The result of fn
+        """
+        deadline = time.monotonic() + self.deadline
+        error = None
+        tried = 0
+        for attempt in range(self.attempts):
+            timeout = min(self.attempt_timeout, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            if cancel is not None and cancel.is_set():
+                raise RetryCancelled(
+                    f'Cancelled after {tried} attempts', error)
+            tried += 1
+            try:
+                return fn(timeout)
+            except Exception as e:
+                error = e
+                if on_error is not None:
+                    on_error(e)
+                if not self.is_retryable(e):
+                    raise RetryError(f'Not retryable: {e}', e) from e
+
+            if attempt + 1 == self.attempts:
+                break
+            delay = self.backoff(attempt)
+            if time.monotonic() + delay >= deadline:
+                break
+            if cancel is None:
+                self.sleep(delay)
+            elif cancel.wait(delay):
+                raise RetryCancelled(
+                    f'Cancelled after {tried} attempts', error)
+
+        raise RetryError(
+            f'Failed after {tried} attempts', error) from error
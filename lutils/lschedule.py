@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+"""
+Implements a compact, array-backed representation of the schedules
+"""
+import struct
+import sys
+from array import array
+
+DAYS = 31
+
+# Header of Schedule.to_bytes: byte order, number of slots, number of stages,
+# length of the text (slot times and area table)
+_HEADER = struct.Struct('<cHHI')
+
+
+def time_to_min(time: str):
+    hour, minute = [int(x) for x in time.split(':')][:2]
+
+    return hour*60 + minute
+
+
+class Schedule():
+    """
+    A loadshedding schedule, stored as a [time-slot x stage x day] array of
+    integer-encoded areas.
+
+    Area names (e.g. '8' or '8B') are stored once, in an area table, and the
+    array holds the (1-based) index of the area in the table. 0 means that no
+    area is shed.
+
+    Args:
+        slots (list(tuple)): Tuples of (start str, end str) of each time slot,
+            sorted by start time.
+        n_stages (int): Number of stages in the schedule
+        areas (list(str)): The area table
+        codes (array): The area codes, of length
+            len(slots) * n_stages * DAYS, indexed by offset().
+        rows (array): The row index in the source csv, per
+            (slot, stage), of length len(slots) * n_stages. -1 if the
+            (slot, stage) combination was not in the csv.
+
+    Attributes:
+        starts (list(int)): Start of each slot, in minutes since midnight
+        ends (list(int)): End of each slot, in minutes since midnight. Slots
+            that wrap around midnight (e.g. 22:00 - 00:30) have 24 hours added
+            to their end.
+    """
+
+    def __init__(self, slots: list, n_stages: int, areas: list,
+                 codes: array, rows: array):
+        self.slots = slots
+        self.n_stages = n_stages
+        self.areas = areas
+        self.codes = codes
+        self.rows = rows
+
+        self._area_codes = {area: i + 1 for i, area in enumerate(areas)}
+        self.starts = [time_to_min(start) for start, _ in slots]
+        self.ends = []
+        for start, (_, end) in zip(self.starts, slots):
+            end = time_to_min(end)
+            if end < start:
+                end += 24*60
+            self.ends.append(end)
+
+    def __getstate__(self):
+        # The derived attributes are cheaper to recompute than to unpickle
+        return (self.slots, self.n_stages, self.areas, self.codes, self.rows)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def to_bytes(self):
+        """The schedule as bytes: a small header, the slot times and area
+        table as text, and the codes and rows arrays as they are in memory,
+        see from_bytes
+        """
+        text = '\n'.join(
+            [start for start, _ in self.slots] +
+            [end for _, end in self.slots] + self.areas).encode('utf-8')
+        return b''.join((
+            _HEADER.pack(sys.byteorder[0].encode(), len(self.slots),
+                         self.n_stages, len(text)),
+            text, self.codes.tobytes(), self.rows.tobytes()))
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        """Reads a schedule written by to_bytes
+
+        Raises:
+            ValueError: Raised when data is not a schedule
+
+        Returns:
+            [Schedule]: The schedule
+        """
+        byteorder, n_slots, n_stages, n_text = _HEADER.unpack_from(data)
+        offset = _HEADER.size
+        text = data[offset:offset + n_text].decode('utf-8')
+        offset += n_text
+
+        codes = array('H')
+        n_codes = n_slots * n_stages * DAYS * codes.itemsize
+        codes.frombytes(data[offset:offset + n_codes])
+        offset += n_codes
+        rows = array('h')
+        rows.frombytes(data[offset:])
+        if (len(codes) != n_slots * n_stages * DAYS or
+                len(rows) != n_slots * n_stages):
+            raise ValueError('Truncated schedule')
+        if byteorder != sys.byteorder[0].encode():
+            codes.byteswap()
+            rows.byteswap()
+
+        strings = text.split('\n') if text else []
+        slots = list(zip(strings[:n_slots], strings[n_slots:2 * n_slots]))
+        return cls(slots, n_stages, strings[2 * n_slots:], codes, rows)
+
+    @classmethod
+    def from_rows(cls, rows: list):
+        """Builds the schedule from csv rows
+
+        Args:
+            rows (list(dict)): The schedule, as read by
+                `lutils.lcsv.read_csv` with the 'stage' column transformed to
+                int.
+
+        Returns:
+            [Schedule]: The schedule
+        """
+        slots = sorted(set((row['start'], row['end']) for row in rows),
+                       key=lambda slot: time_to_min(slot[0]))
+        slot_index = {slot: i for i, slot in enumerate(slots)}
+        n_stages = max((row['stage'] for row in rows), default=0)
+
+        areas = []
+        area_codes = {}
+        codes = array('H', bytes(2 * len(slots) * n_stages * DAYS))
+        row_indices = array('h', [-1] * (len(slots) * n_stages))
+        for i, row in enumerate(rows):
+            slot = slot_index[(row['start'], row['end'])]
+            stage = row['stage']
+            row_indices[slot * n_stages + stage - 1] = i
+            for day in range(1, DAYS + 1):
+                area = row.get(str(day))
+                if area is None or area == '':
+                    continue
+                if area not in area_codes:
+                    areas.append(area)
+                    area_codes[area] = len(areas)
+                codes[((slot * n_stages) + stage - 1) * DAYS + day - 1] = \
+                    area_codes[area]
+
+        return cls(slots, n_stages, areas, codes, row_indices)
+
+    @classmethod
+    def from_csv(cls, filepath: str, delimiter: str = ';'):
+        """Reads a schedule csv
+
+        Args:
+            filepath (str): Path to the schedule csv
+            delimiter (str): The delimiter for the csv
+
+        Returns:
+            [Schedule]: The schedule
+        """
+        import lutils.lcsv
+
+        rows = lutils.lcsv.read_csv(filepath,
+                                    transforms={'stage': lambda x: int(x)},
+                                    delimiter=delimiter)
+        return cls.from_rows(rows)
+
+    def offset(self, slot: int, stage: int, day: int):
+        """Offset of (slot, stage, day) into codes
+
+        Args:
+            slot (int): 0-based index of the time slot
+            stage (int): Stage, 1-based
+            day (int): Day of the month, 1-based
+        """
+        return ((slot * self.n_stages) + stage - 1) * DAYS + day - 1
+
+    def area_code(self, area: str):
+        """Code of area in the area table, or 0 if it is not in the schedule
+        """
+        return self._area_codes.get(str(area), 0)
+
+    def area(self, slot: int, stage: int, day: int):
+        """The area shed in slot at stage (and not at lower stages) on day
+
+        Returns:
+            [str or None]: The area, or None if no area is shed
+        """
+        code = self.codes[self.offset(slot, stage, day)]
+        return self.areas[code - 1] if code else None
+
+    def row(self, slot: int, stage: int):
+        """Row index of (slot, stage) in the source csv, or -1"""
+        return self.rows[slot * self.n_stages + stage - 1]
+
+    def to_numpy(self):
+        """The area codes as a NumPy array of shape (slots, stages, days)
+
+        NumPy is only imported when this is called, it is not a hard
+        dependency.
+        """
+        import numpy as np
+
+        return np.frombuffer(self.codes, dtype=np.uint16).reshape(
+            len(self.slots), self.n_stages, DAYS)
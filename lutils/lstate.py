@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""
+Implements the ran-check state store: the area, time, stage and shedding
+blocks for which the command last ran, kept in the LOGRAN file
+"""
+import os
+from contextlib import contextmanager
+from datetime import datetime
+
+import lutils.lcache
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, the store is then not locked
+    fcntl = None
+
+
+class RanState():
+    """
+    The state of the last run of the command
+
+    Args:
+        area (str): The configured area
+        date (datetime): Time at which the command ran
+        stage (int): Stage at which the command ran
+        blocks (frozenset(tuple), optional): The shedding blocks (as yielded
+            by loadshedding.iterate_shedding_blocks) that triggered the
+            command. None for states written by older versions, which only
+            stored area, date and stage.
+    """
+    __slots__ = ('area', 'date', 'stage', 'blocks')
+
+    def __init__(self, area: str, date: datetime, stage: int,
+                 blocks: frozenset = None):
+        self.area = str(area)
+        self.date = date
+        self.stage = int(stage)
+        self.blocks = None if blocks is None else frozenset(
+            tuple(block) for block in blocks)
+
+    def dumps(self):
+        import json
+
+        return json.dumps({
+            'area': self.area,
+            'date': self.date.isoformat(),
+            'stage': self.stage,
+            'blocks': None if self.blocks is None else sorted(self.blocks),
+        })
+
+    @classmethod
+    def loads(cls, text: str):
+        """Parses a state written by dumps, or the older area;date;stage line
+
+        Raises:
+            ValueError: Raised when text is not a valid state
+        """
+        text = text.strip()
+        if not text.startswith('{'):
+            area, date, stage = text.split(';')
+            return cls(area, datetime.fromisoformat(date), int(stage))
+
+        import json
+
+        try:
+            state = json.loads(text)
+            return cls(state['area'], datetime.fromisoformat(state['date']),
+                       state['stage'], state['blocks'])
+        except (KeyError, TypeError) as e:
+            raise ValueError(f'Invalid ran state {text!r}') from e
+
+    def __eq__(self, other):
+        return isinstance(other, RanState) and \
+            all(getattr(self, k) == getattr(other, k) for k in self.__slots__)
+
+    def __repr__(self):
+        return (f'RanState(area={self.area!r}, date={self.date!r}, '
+                f'stage={self.stage!r}, blocks={self.blocks!r})')
+
+
+class StateStore():
+    """
+    The ran-check state, stored in a file
+
+    Reads and writes can be wrapped in lock() to make a read-decide-write
+    sequence exclusive between processes (e.g. overlapping cron runs, or the
+    daemon and a manual run). Writes replace the file atomically, a reader
+    never sees a partially written state.
+
+    Args:
+        path (str): Path of the state file (LOGRAN). The lock file is
+            <path>.lock
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextmanager
+    def lock(self):
+        """Holds an exclusive lock on the store, blocking until it is free
+        """
+        if fcntl is None:
+            yield
+            return
+        with open(f'{self.path}.lock', 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def read(self):
+        """The stored state
+
+        Raises:
+            ValueError: Raised when the stored state is invalid
+
+        Returns:
+            [RanState or None]: The state, or None if nothing is stored
+        """
+        try:
+            with open(self.path, 'r') as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        return RanState.loads(text)
+
+    def write(self, state: RanState):
+        """Stores state, replacing the file atomically
+
+        Raises:
+            OSError: Raised when the state could not be written
+        """
+        if not lutils.lcache.write_atomic(self.path, state.dumps().encode()):
+            raise OSError(f'Could not write the ran state to {self.path}')
+
+    def clear(self):
+        """Removes the stored state, if any"""
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Implements subscriptions to stage APIs that push changes, with server-sent
+events or long-polling, so that a daemon learns of a stage change within
+seconds without polling
+"""
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# A long-poll that returns sooner than this without a change means the
+# server does not hold requests
+LONG_POLL_MIN_SECONDS = 1
+
+
+class SubscriptionUnsupported(RuntimeError):
+    """Raised when the server does not support the subscription mode"""
+
+
+def read_events(lines):
+    """Parses a server-sent events stream
+
+    Args:
+        lines (iterable(bytes)): The lines of the stream
+
+    Yields:
+        [tuple(str, str, str)]: (event, data, id) of each event with data.
+            The event defaults to 'message'.
+    """
+    event, data, event_id = '', [], ''
+    for line in lines:
+        line = line.decode('utf-8').rstrip('\r\n')
+        if not line:
+            if data:
+                yield event or 'message', '\n'.join(data), event_id
+            event, data = '', []
+            continue
+        if line.startswith(':'):
+            # A comment, e.g. a keep-alive
+            continue
+        name, _, value = line.partition(':')
+        if value.startswith(' '):
+            value = value[1:]
+        if name == 'event':
+            event = value
+        elif name == 'data':
+            data.append(value)
+        elif name == 'id':
+            event_id = value
+
+
+def subscribe_sse(url: str, timeout: float):
+    """Yields the data of each event the server at url sends
+
+    The server is expected to send the current value when the stream opens,
+    and a comment at least every timeout seconds to keep it open.
+
+    Args:
+        url (str): URL of the event stream
+        timeout (float): Seconds without any data after which the stream is
+            considered broken
+
+    Raises:
+        SubscriptionUnsupported: Raised when the response is not an event
+            stream
+
+    Yields:
+        [bytes]: The data of each event
+    """
+    request = urllib.request.Request(
+        url, headers={'Accept': 'text/event-stream',
+                      'Cache-Control': 'no-cache'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        content_type = response.headers.get('Content-Type', '')
+        if not content_type.startswith('text/event-stream'):
+            raise SubscriptionUnsupported(
+                f'{url} is not an event stream ({content_type})')
+        for _, data, _ in read_events(response):
+            yield data.encode('utf-8')
+
+
+def subscribe_long_poll(url: str, wait: float, clock=time.monotonic):
+    """Yields the response of url each time it changes, by long-polling
+
+    Each request carries the ETag of the last response (If-None-Match) and
+    asks the server to hold it for up to wait seconds (Prefer: wait), until
+    the response changes. The server responds 304 Not Modified if it did not.
+
+    Args:
+        url (str): URL of the stage API
+        wait (float): Seconds the server may hold a request
+        clock (callable, optional): Monotonic clock, in seconds
+
+    Raises:
+        SubscriptionUnsupported: Raised when the server does not send an
+            ETag, or does not hold the requests
+
+    Yields:
+        [bytes]: The response, first the current one
+    """
+    etag = None
+    while True:
+        request = urllib.request.Request(
+            url, headers={'Prefer': f'wait={int(wait)}'})
+        if etag is not None:
+            request.add_header('If-None-Match', etag)
+
+        time_start = clock()
+        try:
+            with urllib.request.urlopen(
+                    request, timeout=wait + 10) as response:
+                body = response.read()
+                etag_new = response.headers.get('ETag')
+        except urllib.error.HTTPError as e:
+            if e.code != 304 or etag is None:
+                raise
+            etag_new = etag
+            body = None
+
+        if etag_new is None:
+            raise SubscriptionUnsupported(f'{url} does not send an ETag')
+        if etag_new == etag:
+            if clock() - time_start < LONG_POLL_MIN_SECONDS:
+                raise SubscriptionUnsupported(
+                    f'{url} does not hold long-poll requests')
+            continue
+        etag = etag_new
+        yield body
+
+
+class Subscriber():
+    """
+    Keeps a subscription open in a thread, and the latest response
+
+    The subscription is reopened when it fails, after a backoff. If the
+    server does not support it, the subscriber stops, and the caller should
+    poll instead.
+
+    Args:
+        subscribe (callable): Returns an iterator over the responses, e.g.
+            subscribe_sse
+        validate (callable, optional): Receives each response, and raises an
+            exception if it is not valid. Invalid responses are skipped.
+        on_error (callable, optional): Receives the exception of each
+            failure, e.g. to log it
+        backoff_initial (float): Seconds to wait after the first failure
+        backoff_max (float): Maximum seconds to wait between attempts
+
+    Attributes:
+        body (bytes): The latest valid response, None before the first
+        connected (bool): True while the subscription is open and has sent a
+            valid response
+        stopped (bool): True once the subscriber gave up, or was stopped
+    """
+
+    def __init__(self, subscribe, validate=None, on_error=None,
+                 backoff_initial: float = 1, backoff_max: float = 60):
+        self.subscribe = subscribe
+        self.validate = validate
+        self.on_error = on_error
+        self.backoff_initial = backoff_initial
+        self.backoff_max = backoff_max
+        self.body = None
+        self.connected = False
+        self.stopped = False
+        self._changed = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._changed.set()
+
+    def wait(self, timeout: float):
+        """Waits for up to timeout seconds for a new response, or a change
+        of the connection
+
+        Returns:
+            [bool]: True if something changed
+        """
+        changed = self._changed.wait(max(timeout, 0))
+        self._changed.clear()
+        return changed
+
+    def _set(self, connected: bool, body: bytes = None):
+        if body is not None:
+            self.body = body
+        self.connected = connected
+        self._changed.set()
+
+    def _run(self):
+        failures = 0
+        while not self._stop.is_set():
+            try:
+                for body in self.subscribe():
+                    if self._stop.is_set():
+                        break
+                    try:
+                        if self.validate is not None:
+                            self.validate(body)
+                    except Exception as e:
+                        if self.on_error is not None:
+                            self.on_error(e)
+                        continue
+                    failures = 0
+                    self._set(True, body)
+            except SubscriptionUnsupported as e:
+                if self.on_error is not None:
+                    self.on_error(e)
+                break
+            except Exception as e:
+                if self.on_error is not None:
+                    self.on_error(e)
+                failures += 1
+
+            self._set(False)
+            backoff = min(self.backoff_initial * 2 ** max(failures - 1, 0),
+                          self.backoff_max)
+            self._stop.wait(backoff)
+
+        self.stopped = True
+        self._set(False)
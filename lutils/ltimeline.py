@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Implements a precomputed stage timeline: the stage as a step function of
+time, sampled once from a stage schedule and then looked up by bisection
+"""
+import bisect
+import pickle
+from datetime import datetime, timedelta
+
+import lutils.lcache
+
+# Increment when the layout of the stored timeline changes
+TIMELINE_VERSION = 1
+
+
+class StageTimeline():
+    """
+    The stage between start and end, stored as the times at which it changes
+
+    Args:
+        key (str): Identifies the stage schedule the timeline was computed
+            from, e.g. a hash of its contents
+        start (datetime): Start of the timeline
+        end (datetime): End of the timeline (exclusive)
+        times (list(datetime)): Sorted times at which the stage changes, the
+            first is start
+        stages (list(int)): The stage from each time on
+    """
+    __slots__ = ('key', 'start', 'end', 'times', 'stages')
+
+    def __init__(self, key: str, start: datetime, end: datetime,
+                 times: list, stages: list):
+        self.key = key
+        self.start = start
+        self.end = end
+        self.times = times
+        self.stages = stages
+
+    def __getstate__(self):
+        return (self.key, self.start, self.end, self.times, self.stages)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    @classmethod
+    def from_function(cls, key: str, stage, start: datetime, end: datetime,
+                      step: timedelta = timedelta(minutes=1)):
+        """Samples stage(time) every step from start to end
+
+        Args:
+            key (str): See StageTimeline
+            stage (callable): Returns the stage at a (naive) datetime
+            start (datetime): Start of the timeline, rounded down to the
+                minute
+            end (datetime): End of the timeline
+            step (timedelta, optional): Sampling interval. Stage schedules
+                change on the minute at most
+
+        Returns:
+            [StageTimeline]: The timeline
+        """
+        start = start.replace(second=0, microsecond=0)
+        times, stages = [], []
+        time = start
+        while time < end:
+            stage_time = stage(time)
+            if not stages or stages[-1] != stage_time:
+                times.append(time)
+                stages.append(stage_time)
+            time += step
+        return cls(key, start, end, times, stages)
+
+    def covers(self, date: datetime):
+        """True if date is in [start, end)"""
+        return self.start <= date < self.end
+
+    def stage(self, date: datetime):
+        """The stage at date
+
+        Raises:
+            ValueError: Raised when date is not covered by the timeline
+        """
+        if not self.covers(date):
+            raise ValueError(
+                f'{date} is not in the timeline [{self.start}, {self.end})')
+        return self.stages[bisect.bisect_right(self.times, date) - 1]
+
+    def segments(self, date_from: datetime = None):
+        """Yields the (start, end, stage) of the constant-stage segments that
+        end after date_from, end exclusive
+        """
+        ends = self.times[1:] + [self.end]
+        i = 0
+        if date_from is not None:
+            i = max(bisect.bisect_right(self.times, date_from) - 1, 0)
+        for start, end, stage in zip(
+                self.times[i:], ends[i:], self.stages[i:]):
+            yield start, end, stage
+
+
+def load(path: str, key: str = None):
+    """Loads the timeline stored at path, if it was computed for key
+
+    Args:
+        path (str): Path of the stored timeline
+        key (str, optional): Key of the stage schedule. None loads the
+            timeline of any stage schedule
+
+    Returns:
+        [StageTimeline or None]: The timeline, or None if there is none or it
+            is for another key
+    """
+    try:
+        with open(path, 'rb') as f:
+            entry = pickle.loads(f.read())
+    except Exception:
+        return None
+    if not isinstance(entry, dict) or \
+            entry.get('version') != TIMELINE_VERSION or \
+            (key is not None and entry.get('key') != key):
+        return None
+    return entry['timeline']
+
+
+def store(path: str, timeline: StageTimeline):
+    """Stores timeline at path, best effort, see lutils.lcache.write_atomic
+
+    Returns:
+        [bool]: True if the timeline was written
+    """
+    return lutils.lcache.write_atomic(path, pickle.dumps({
+        'version': TIMELINE_VERSION,
+        'key': timeline.key,
+        'timeline': timeline,
+    }, protocol=pickle.HIGHEST_PROTOCOL))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Implements lightweight timing of the phases of a run, emitted as a JSON line
+"""
+import time
+
+
+class _Phase():
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name: str):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.timings.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _NullPhase():
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class Timings():
+    """
+    Monotonic durations of the named phases of a run.
+
+    Phases are timed with `with timings.phase('name'):`, durations of a phase
+    that is entered more than once are summed. When disabled (no logger),
+    phase() returns a shared no-op context manager, and nothing is recorded
+    or emitted.
+
+    Args:
+        logger (logging.Logger, optional): Logger the timings are emitted to,
+            as a JSON line. None disables the timings.
+
+    Attributes:
+        start (float): perf_counter() at creation, the start of the run
+        phases (dict): Seconds spent in each phase, in order of first entry
+    """
+
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    @property
+    def enabled(self):
+        return self.logger is not None
+
+    def phase(self, name: str):
+        """Context manager timing the phase name"""
+        if self.logger is None:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def add(self, name: str, seconds: float):
+        """Adds seconds to the duration of the phase name"""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def event(self, **fields):
+        """The timings as a dict
+
+        Args:
+            **fields: Additional fields of the event, e.g. the outcome of the
+                run
+
+        Returns:
+            [dict]: fields, with the 'phases' durations and the 'total'
+                duration since start, in seconds
+        """
+        event = dict(fields)
+        event['phases'] = {
+            name: round(seconds, 6) for name, seconds in self.phases.items()
+        }
+        event['total'] = round(time.perf_counter() - self.start, 6)
+        return event
+
+    def emit(self, **fields):
+        """Logs the event as a JSON line, if enabled, see event"""
+        if self.logger is None:
+            return
+        import json
+
+        self.logger.info(json.dumps(self.event(**fields), default=str))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Implements checks of the invariants of the schedule csvs, e.g. to gate
+schedule updates:
+
+    python3 -m lutils.lvalidate schedules/*.csv
+
+Each csv is read once into the array-backed Schedule, and the invariants are
+checked with slices of its [time-slot x stage x day] array.
+"""
+import re
+
+import lutils.lschedule
+
+TIME_PATTERN = re.compile(r'^(\d{1,2}):(\d{2})(?::(\d{2}))?$')
+
+
+def check_rows(rows: list):
+    """Checks the columns, times and stages of the csv rows
+
+    Args:
+        rows (list(dict)): The csv rows, as read by lutils.lcsv.read_csv
+            without transforms
+
+    Returns:
+        [list(str)]: The violations
+    """
+    violations = []
+    if rows:
+        missing = [str(day) for day in range(1, lutils.lschedule.DAYS + 1)
+                   if str(day) not in rows[0]]
+        if missing:
+            violations.append(f'Missing day columns {", ".join(missing)}')
+
+    for i, row in enumerate(rows):
+        for column in ('start', 'end'):
+            match = TIME_PATTERN.match(row.get(column) or '')
+            if match is None or int(match.group(1)) > 23 or \
+                    int(match.group(2)) > 59 or \
+                    int(match.group(3) or 0) > 59:
+                violations.append(
+                    f'Row {i}: invalid {column} time {row.get(column)!r}')
+        stage = row.get('stage') or ''
+        if not stage.isdigit() or int(stage) < 1:
+            violations.append(f'Row {i}: invalid stage {stage!r}')
+    return violations
+
+
+def check_schedule(schedule, n_rows: int):
+    """Checks the invariants of a schedule
+
+        - every time slot has exactly one row per stage, from 1 to the
+          highest stage
+        - every day, including days 29 to 31, has an area in every row
+        - each stage adds an area that is not shed at lower stages in the
+          same time slot and day, i.e. stage N is a strict superset of stage
+          N - 1
+
+    Args:
+        schedule (lutils.lschedule.Schedule): The schedule
+        n_rows (int): Number of rows in the csv, to find duplicate rows
+
+    Returns:
+        [list(str)]: The violations
+    """
+    violations = []
+    n_stages = schedule.n_stages
+    days = lutils.lschedule.DAYS
+    codes = schedule.codes
+
+    if n_rows != len(schedule.slots) * n_stages:
+        violations.append(
+            f'{n_rows} rows, expected {len(schedule.slots)} time slots x '
+            f'{n_stages} stages = {len(schedule.slots) * n_stages}, there '
+            f'are duplicate rows')
+
+    for slot, (start, end) in enumerate(schedule.slots):
+        for stage in range(1, n_stages + 1):
+            if schedule.row(slot, stage) < 0:
+                violations.append(f'{start} - {end}: no row for stage {stage}')
+                continue
+            offset = schedule.offset(slot, stage, 1)
+            row_codes = codes[offset:offset + days]
+            if 0 in row_codes:
+                missing = [str(day + 1) for day, code in enumerate(row_codes)
+                           if code == 0]
+                violations.append(
+                    f'{start} - {end}, stage {stage}: no area on days '
+                    f'{", ".join(missing)}')
+
+        for day in range(1, days + 1):
+            # The areas added at each stage, stage 1 first
+            offset = schedule.offset(slot, 1, day)
+            stage_codes = codes[offset:offset + n_stages * days:days]
+            shed = set()
+            for stage, code in enumerate(stage_codes, start=1):
+                if code == 0:
+                    continue
+                if code in shed:
+                    violations.append(
+                        f'{start} - {end}, day {day}: stage {stage} adds area '
+                        f'{schedule.areas[code - 1]}, which is already shed '
+                        'at a lower stage')
+                shed.add(code)
+    return violations
+
+
+def validate(path: str, delimiter: str = ';'):
+    """Checks all invariants of the schedule csv at path
+
+    Returns:
+        [list(str)]: The violations, empty if the schedule is valid
+    """
+    import lutils.lcsv
+
+    rows = lutils.lcsv.read_csv(path, delimiter=delimiter)
+    violations = check_rows(rows)
+    if violations:
+        # The schedule cannot be built from invalid times or stages
+        return violations
+
+    for row in rows:
+        row['stage'] = int(row['stage'])
+    schedule = lutils.lschedule.Schedule.from_rows(rows)
+    return check_schedule(schedule, len(rows))
+
+
+if __name__ == '__main__':
+    import argparse
+    import glob
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description='Check the invariants of schedule csvs')
+    parser.add_argument(
+        'paths', nargs='*',
+        help='Schedule csvs. Default is all csvs in schedules/')
+    args = parser.parse_args()
+
+    paths = args.paths or sorted(glob.glob('schedules/*.csv'))
+    invalid = 0
+    for path in paths:
+        violations = validate(path)
+        if violations:
+            invalid += 1
+        print(f'{path}: {len(violations)} violations')
+        for violation in violations:
+            print(f'    {violation}')
+    sys.exit(1 if invalid else 0)
@@ -0,0 +1,217 @@
+"""Converts municipal load shedding workbooks to the `loadshedding` schedule
+format.
+
+The workbook has a worksheet per stage. Each worksheet has
+    - header rows, with the days of the month in the area columns. A column
+      can hold more than one day, e.g. the Cape Town schedule is the same for
+      day d and day d + 16, with the days in two header rows
+    - a row per time interval, with the start and end time in the first two
+      columns, and the area(s) shed in each area column
+
+In a cumulative workbook (e.g. Cape Town) the cells of stage N list all areas
+shed up to stage N, comma separated, otherwise only the area added at stage N.
+
+The time intervals and days are inferred from the worksheets. The workbook is
+streamed with openpyxl in read-only mode, and the output computed with set
+operations over whole worksheets, instead of per cell lookups.
+
+    python3 schedules/schedule_workbook_conversion.py <WORKBOOK.xlsx> <OUTPUT.csv>
+"""
+import argparse
+import csv
+import datetime
+import re
+
+DAYS = 31
+
+TIME_PATTERN = re.compile(r'^\s*(\d{1,2}):(\d{2})(?::(\d{2}))?\s*$')
+
+
+def parse_time(value):
+    """Parses a time cell
+
+    Args:
+        value: The cell value, a time, datetime, fraction of a day, or a
+            'H:MM' or 'HH:MM:SS' string
+
+    Returns:
+        [str or None]: The time as 'HH:MM:SS', or None if value is not a time
+    """
+    if isinstance(value, datetime.datetime):
+        value = value.time()
+    if isinstance(value, datetime.time):
+        return value.strftime('%H:%M:%S')
+    if isinstance(value, float) and 0 <= value < 1:
+        minutes = round(value * 24 * 60)
+        return f'{minutes // 60:02d}:{minutes % 60:02d}:00'
+    if isinstance(value, str):
+        match = TIME_PATTERN.match(value)
+        if match is not None:
+            hour, minute, second = match.groups()
+            return f'{int(hour):02d}:{minute}:{second or "00"}'
+    return None
+
+
+def parse_areas(value):
+    """Parses an area cell, e.g. 5, '5' or '1, 9'
+
+    Returns:
+        [frozenset(str)]: The areas
+    """
+    if value is None:
+        return frozenset()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return frozenset(
+        area.strip() for area in str(value).split(',') if area.strip())
+
+
+def parse_sheet(rows):
+    """Parses the rows of a stage worksheet
+
+    Args:
+        rows (iterable(tuple)): The cell values of each row
+
+    Raises:
+        ValueError: Raised when the worksheet has no header or time rows
+
+    Returns:
+        [tuple(dict, list, list)]: The days of each area column (by column
+            index), the (start, end) of each time interval, and for each time
+            interval the areas of each area column
+    """
+    column_days = {}
+    slots = []
+    cells = []
+    for row in rows:
+        row = tuple(row)
+        start = parse_time(row[0]) if len(row) > 0 else None
+        end = parse_time(row[1]) if len(row) > 1 else None
+        if start is None or end is None:
+            if slots:
+                # Trailing rows, e.g. notes
+                continue
+            # A header row, with the days of the area columns
+            for j, value in enumerate(row[2:], start=2):
+                if isinstance(value, (int, float)) and \
+                        1 <= value <= DAYS and int(value) == value:
+                    column_days.setdefault(j, []).append(int(value))
+            continue
+        slots.append((start, end))
+        cells.append({
+            j: parse_areas(row[j] if j < len(row) else None)
+            for j in column_days
+        })
+
+    if not column_days or not slots:
+        raise ValueError('No header row with days, or no time rows')
+    return column_days, slots, cells
+
+
+def convert_sheets(sheets, cumulative: bool = True):
+    """Converts the worksheets of a workbook, one per stage from stage 1
+
+    Args:
+        sheets (list(iterable(tuple))): The rows of each stage worksheet
+        cumulative (bool, optional): The cells of stage N list all areas shed
+            up to stage N
+
+    Raises:
+        ValueError: Raised when the worksheets are inconsistent, or a cell
+            does not add exactly one area
+
+    Returns:
+        [list(list)]: The schedule rows, with the header row first
+    """
+    parsed = [parse_sheet(rows) for rows in sheets]
+    column_days, slots, _ = parsed[0]
+    for stage, (days_stage, slots_stage, _) in enumerate(parsed, start=1):
+        if days_stage != column_days or slots_stage != slots:
+            raise ValueError(
+                f'The days or time intervals of stage {stage} differ from '
+                'stage 1')
+
+    # areas[stage][slot][column]: the area added at stage
+    areas = []
+    previous = [{j: frozenset() for j in column_days} for _ in slots]
+    for stage, (_, _, cells) in enumerate(parsed, start=1):
+        added = []
+        for slot, (cells_slot, previous_slot) in enumerate(
+                zip(cells, previous)):
+            added_slot = {}
+            for j, cell in cells_slot.items():
+                new = cell - previous_slot[j] if cumulative else cell
+                if len(new) != 1:
+                    raise ValueError(
+                        f'Stage {stage}, {slots[slot][0]} - '
+                        f'{slots[slot][1]}, days {column_days[j]}: expected '
+                        f'one new area, found {sorted(new)}')
+                (added_slot[j],) = new
+            added.append(added_slot)
+        areas.append(added)
+        if cumulative:
+            previous = cells
+
+    output = [['start', 'end', 'stage'] + list(range(1, DAYS + 1))]
+    for slot, (start, end) in enumerate(slots):
+        for stage, added in enumerate(areas, start=1):
+            row = [start, end, stage] + [''] * DAYS
+            for j, area in added[slot].items():
+                for day in column_days[j]:
+                    row[2 + day] = area
+            output.append(row)
+    return output
+
+
+def read_workbook(path: str, sheet_name: str = 'Sheet{stage}'):
+    """Streams the stage worksheets of the workbook at path
+
+    Args:
+        path (str): Path to the .xlsx workbook
+        sheet_name (str, optional): Name of the worksheet of each stage
+
+    Returns:
+        [list(list(tuple))]: The cell values of each stage worksheet
+    """
+    # Only import when needed, it is not a dependency of loadshedding
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(path, read_only=True, data_only=True)
+    try:
+        sheets = []
+        stage = 1
+        while sheet_name.format(stage=stage) in workbook.sheetnames:
+            worksheet = workbook[sheet_name.format(stage=stage)]
+            sheets.append(list(worksheet.iter_rows(values_only=True)))
+            stage += 1
+    finally:
+        workbook.close()
+    if not sheets:
+        raise ValueError(
+            f'No worksheet {sheet_name.format(stage=1)!r} in {path}')
+    return sheets
+
+
+def write_csv(path: str, rows: list):
+    with open(path, 'w', newline='') as f:
+        csv.writer(f, delimiter=';', lineterminator='\n').writerows(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Convert a load shedding workbook to a schedule csv')
+    parser.add_argument('workbook', help='Path to the .xlsx workbook')
+    parser.add_argument('output', help='Path of the output csv')
+    parser.add_argument(
+        '--sheet-name', default='Sheet{stage}',
+        help='Name of the worksheet of each stage, with {stage} replaced by '
+             'the stage number. Default: "Sheet{stage}"')
+    parser.add_argument(
+        '--incremental', action='store_true',
+        help='The cells list only the area added at each stage, instead of '
+             'all areas shed up to that stage')
+    args = parser.parse_args()
+
+    write_csv(args.output, convert_sheets(
+        read_workbook(args.workbook, args.sheet_name),
+        cumulative=not args.incremental))
@@ -0,0 +1,156 @@
+"""Unit Tests for reading and validating the configuration files
+"""
+
+import os
+import tempfile
+import unittest
+
+import configuration
+
+configuration_user = """
+VERSION: '0.2.2'
+AREA: 8
+QUERY_MODE: DIRECT
+SCHEDULE_CSV: 'schedules/load_shedding_city_power.csv'
+API_URL: "https://loadshedding.eskom.co.za/LoadShedding/GetStatus"
+CMD: "sudo /usr/sbin/s2disk"
+GUI_NOTIFICATION: True
+PAD_START: 17
+IGNORE_END: 30
+RAN_CHECK: True
+CUSTOM: 'kept'
+"""
+
+
+class TestConfiguration(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'configuration.yaml')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, contents):
+        with open(self.path, 'w') as f:
+            f.write(contents)
+
+    def test_read(self):
+        """Tests that values can be read by key and attribute, with defaults
+        applied and the area as str
+        """
+        self.write(configuration_user)
+        c = configuration.read_configuration_user(self.path)
+
+        self.assertIsInstance(c, configuration.UserConfiguration)
+        self.assertEqual(c['PAD_START'], 17)
+        self.assertEqual(c.PAD_START, 17)
+        self.assertEqual(c['AREA'], '8')
+        self.assertEqual(c['POLL_INTERVAL'], 300)
+        self.assertEqual(c['CUSTOM'], 'kept')
+        self.assertNotIn('MISSING', c)
+        with self.assertRaises(KeyError):
+            c['MISSING']
+        with self.assertRaises(AttributeError):
+            c.MISSING = 1
+
+    def test_all_errors(self):
+        """Tests that all problems are reported at once
+        """
+        self.write(configuration_user
+                   .replace("API_URL:", "#")
+                   .replace("CMD:", "#")
+                   .replace("PAD_START: 17", "PAD_START: '17'"))
+        with self.assertRaises(configuration.MissingKeyError) as context:
+            configuration.read_configuration_user(self.path)
+        self.assertEqual(len(context.exception.errors), 3)
+
+        self.write(configuration_user
+                   .replace("VERSION: '0.2.2'", "VERSION: '0.1.0'")
+                   .replace("RAN_CHECK: True", "RAN_CHECK: 1"))
+        with self.assertRaises(configuration.VersionError) as context:
+            configuration.read_configuration_user(self.path)
+        self.assertEqual(len(context.exception.errors), 2)
+
+    def test_nested_errors(self):
+        """Tests that the RETRY settings, the STAGE_SOURCES entries and bools
+        for numbers are reported at once too
+        """
+        self.write(configuration_user.replace("PAD_START: 17",
+                                              "PAD_START: true") + """
+RETRY:
+  DEADLNE: 30
+  ATTEMPTS: '3'
+STAGE_SOURCES:
+  - api_url: http://127.0.0.1/
+    query_mode: direct
+  - API_URL: http://127.0.0.1/
+    QUERY_MODE: CACHED
+  - http://127.0.0.1/
+""")
+        with self.assertRaises(configuration.InvalidValueError) as context:
+            configuration.read_configuration_user(self.path)
+        errors = context.exception.errors
+        self.assertEqual(len(errors), 5, errors)
+        self.assertIn('PAD_START', errors[0])
+        self.assertIn('DEADLNE', errors[1])
+
+    def test_hook_errors(self):
+        """Tests that malformed PRE_SHUTDOWN_HOOKS entries are reported
+        """
+        self.write(configuration_user + """
+PRE_SHUTDOWN_HOOKS:
+  - sync
+  - cmd: sync
+    timeout: 5
+  - CMD: sync
+    TIMEOUT: 30s
+  - CMD: sync
+    TIMEOUT: -1
+  - TIMEOUT: 5
+  - CMD: sync
+    TIMOUT: 5
+  - 30
+""")
+        with self.assertRaises(configuration.InvalidValueError) as context:
+            configuration.read_configuration_user(self.path)
+        errors = context.exception.errors
+        self.assertEqual(len(errors), 5, errors)
+        self.assertIn('entry 2 TIMEOUT', errors[0])
+        self.assertIn('entry 3 TIMEOUT', errors[1])
+
+    def test_defaults_not_shared(self):
+        """Tests that configurations do not share the mutable defaults
+        """
+        self.write(configuration_user)
+        a = configuration.read_configuration_user(self.path, cache=False)
+        b = configuration.read_configuration_user(self.path, cache=False)
+        a['PRE_SHUTDOWN_HOOKS'].append('sync')
+        self.assertEqual(b['PRE_SHUTDOWN_HOOKS'], [])
+        self.assertEqual(
+            configuration.UserConfiguration.DEFAULTS['PRE_SHUTDOWN_HOOKS'],
+            [])
+
+    def test_cache(self):
+        """Tests that the validated configuration is cached, and re-read when
+        the file changes
+        """
+        self.write(configuration_user)
+        configuration.read_configuration_user(self.path)
+        self.assertTrue(os.path.exists(self.path + '.cache'))
+
+        # A stale cache with the same mtime and size would still be used, so
+        # change the size
+        self.write(configuration_user.replace('PAD_START: 17',
+                                              'PAD_START: 5'))
+        c = configuration.read_configuration_user(self.path)
+        self.assertEqual(c['PAD_START'], 5)
+
+        # Errors are not cached
+        self.write(configuration_user.replace('PAD_START: 17', ''))
+        for _ in range(2):
+            with self.assertRaises(configuration.MissingKeyError):
+                configuration.read_configuration_user(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
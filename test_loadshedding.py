@@ -3,10 +3,29 @@
 
 import unittest
 import datetime
+import itertools
+import os
+import time
 
+import lutils.lbitmap
+import lutils.lcache
+import lutils.lcommand
 import lutils.lcsv
+import lutils.lexport
+import lutils.lfleet
+import lutils.lindex
+import lutils.lreplay
+import lutils.lschedule
+import lutils.lstate
+import lutils.lvalidate
+import lutils.ltimeline
+import lutils.ltiming
 
-from loadshedding import check_shedding
+from loadshedding import (
+    check_shedding, blocks_shedding, next_shedding_windows, get_next_wakeup,
+    compile_schedule, run_shedding, iterate_timeline_windows,
+    iterate_area_windows,
+)
 
 test_areas = {
     "city_power": {
@@ -263,5 +282,1312 @@ class TestCheckShedding(unittest.TestCase):
         self.run_test_type('test_midnight_month')
 
 
+class TestScheduleIndex(unittest.TestCase):
+    @staticmethod
+    def blocks_linear(stage_current, schedule, area, pad_start, ignore_end,
+                      date_check):
+        """Reference implementation: a linear scan over all schedule rows
+        """
+        def to_min(time):
+            hour, minute = [int(x) for x in time.split(':')][:2]
+            return hour*60 + minute
+
+        now = date_check.hour*60 + date_check.minute
+        day_tomorrow = (date_check + datetime.timedelta(days=1)).day
+        for i, row in enumerate(schedule):
+            if not row['stage'] <= stage_current:
+                continue
+            start, end = to_min(row['start']), to_min(row['end'])
+            if end < start:
+                end += 24*60
+            for day, offset in ((date_check.day, 0), (day_tomorrow, 24*60)):
+                if (row[str(day)] == area and
+                        start + offset - pad_start <= now
+                        <= end + offset - ignore_end):
+                    yield i, row['start'], row['end'], row['stage'], area
+
+    def test_matches_linear_scan(self):
+        """Tests that the compiled index finds exactly the blocks a linear
+        scan over the schedule rows finds
+        """
+        import random
+
+        random.seed(0)
+        for area in test_areas.keys():
+            schedule = lutils.lcsv.read_csv(
+                test_areas[area]['configuration_user']['SCHEDULE_CSV'],
+                transforms={'stage': lambda x: int(x)},
+                delimiter=';')
+            index = lutils.lindex.ScheduleIndex(schedule)
+
+            for i in range(2048):
+                configuration_user = {
+                    'AREA': str(random.randint(1, 16)),
+                    'PAD_START': random.randint(0, 60),
+                    'IGNORE_END': random.randint(0, 60),
+                }
+                stage = random.randint(0, 8)
+                datetime_test = datetime.datetime(2021, 1, 1) + \
+                    datetime.timedelta(minutes=random.randrange(366*24*60))
+
+                with self.subTest(area=area, i=i):
+                    expected = list(self.blocks_linear(
+                        stage, schedule, configuration_user['AREA'],
+                        configuration_user['PAD_START'],
+                        configuration_user['IGNORE_END'],
+                        datetime_test))
+                    blocks = blocks_shedding(
+                        stage, index, configuration_user, datetime_test)
+                    self.assertEqual(blocks, expected)
+
+
+class TestSheddingWindows(unittest.TestCase):
+    def test_matches_check_shedding(self):
+        """Tests that the windows cover exactly the minutes for which
+        check_shedding returns True, across a month rollover
+        """
+        date_from = datetime.datetime(2021, 2, 27, 13, 7, 30)
+        date_to = date_from + datetime.timedelta(days=3)
+        for area in test_areas.keys():
+            schedule = lutils.lindex.ScheduleIndex(lutils.lcsv.read_csv(
+                test_areas[area]['configuration_user']['SCHEDULE_CSV'],
+                transforms={'stage': lambda x: int(x)},
+                delimiter=';'))
+            for area_id, stage in (('1', 1), ('8', 4), ('13', 8), ('2', 0)):
+                configuration_user = {
+                    'AREA': area_id, 'PAD_START': 17, 'IGNORE_END': 30,
+                }
+                windows = next_shedding_windows(
+                    stage, schedule, configuration_user, date_from,
+                    count=100, days=4)
+
+                minutes_windows = set()
+                for window_start, window_end, _ in windows:
+                    minute = window_start
+                    while minute <= window_end:
+                        minutes_windows.add(minute)
+                        minute += datetime.timedelta(minutes=1)
+
+                minutes_shedding = set()
+                minute = date_from.replace(second=0)
+                while minute < date_to:
+                    if check_shedding(
+                            stage, schedule, configuration_user, minute):
+                        minutes_shedding.add(minute)
+                    minute += datetime.timedelta(minutes=1)
+
+                with self.subTest(area=area, area_id=area_id, stage=stage):
+                    self.assertEqual(
+                        {m for m in minutes_windows
+                         if date_from.replace(second=0) <= m < date_to},
+                        minutes_shedding)
+
+
+class TestDaemonWakeup(unittest.TestCase):
+    def setUp(self):
+        self.schedule = lutils.lindex.ScheduleIndex(lutils.lcsv.read_csv(
+            'schedules/load_shedding_city_power.csv',
+            transforms={'stage': lambda x: int(x)},
+            delimiter=';'))
+        self.configuration_user = {
+            'AREA': '8', 'PAD_START': 17, 'IGNORE_END': 30,
+        }
+
+    def test_sleep_until_window(self):
+        """Tests that the daemon sleeps until the padded start of the next
+        window, if that is before the next stage query
+        """
+        date_now = datetime.datetime(2021, 3, 1, 1, 0, 10)
+        date_poll = date_now + datetime.timedelta(hours=12)
+        wakeup = get_next_wakeup(4, self.schedule, self.configuration_user,
+                                 date_now, date_poll)
+        self.assertEqual(wakeup, datetime.datetime(2021, 3, 1, 5, 43))
+
+    def test_sleep_until_poll(self):
+        """Tests that the daemon wakes up for the next stage query
+        """
+        date_now = datetime.datetime(2021, 3, 1, 1, 0, 10)
+        date_poll = date_now + datetime.timedelta(minutes=5)
+        wakeup = get_next_wakeup(4, self.schedule, self.configuration_user,
+                                 date_now, date_poll)
+        self.assertEqual(wakeup, date_poll)
+
+        # Nothing to wait for at stage 0
+        wakeup = get_next_wakeup(0, self.schedule, self.configuration_user,
+                                 date_now, date_poll)
+        self.assertEqual(wakeup, date_poll)
+
+    def test_every_minute_while_shedding(self):
+        """Tests that the daemon checks every minute while shedding
+        """
+        date_now = datetime.datetime(2021, 3, 1, 6, 0, 10)
+        date_poll = date_now + datetime.timedelta(minutes=5)
+        wakeup = get_next_wakeup(4, self.schedule, self.configuration_user,
+                                 date_now, date_poll)
+        self.assertEqual(wakeup, datetime.datetime(2021, 3, 1, 6, 1))
+
+
+class TestDaemon(unittest.TestCase):
+    configuration_system = {'METRICS_PORT': None}
+    configuration_user = {
+        'AREA': '8', 'PAD_START': 17, 'IGNORE_END': 30,
+        'GUI_NOTIFICATION': False, 'QUERY_MODE': 'direct',
+        'SCHEDULE_CSV': 'schedules/load_shedding_city_power.csv',
+        'SCHEDULE_CACHE': False, 'POLL_INTERVAL': 3600,
+        'STAGE_SUBSCRIBE': None,
+    }
+
+    class Stop(Exception):
+        pass
+
+    class Subscriber():
+        """A connected subscription that pushed body"""
+
+        def __init__(self, body):
+            self.body = body
+            self.connected = True
+            self.stopped = False
+
+        def stop(self):
+            self.connected = False
+            self.stopped = True
+
+    def run_daemon(self, stages, ran, n_sleeps, subscriber=None):
+        """Runs the daemon on a fake clock, that the sleeps advance, until
+        it slept n_sleeps times
+
+        Returns:
+            [tuple(list, list)]: The seconds of each sleep, and the stage of
+                each run_shedding call
+        """
+        import logging
+        from unittest import mock
+        import loadshedding
+
+        loadshedding.logger = logging.getLogger('test')
+        clock = [datetime.datetime(2021, 3, 1, 1, 0, 10)]
+        sleeps = []
+
+        def sleep(seconds):
+            sleeps.append(seconds)
+            clock[0] += datetime.timedelta(seconds=seconds)
+            if len(sleeps) == n_sleeps:
+                raise self.Stop()
+
+        if subscriber is not None:
+            subscriber.wait = sleep
+        with mock.patch.object(loadshedding, 'get_date_now',
+                               lambda: clock[0]), \
+                mock.patch.object(loadshedding.time, 'sleep', sleep), \
+                mock.patch.object(loadshedding, 'get_stage_current',
+                                  side_effect=stages), \
+                mock.patch.object(loadshedding, 'run_shedding',
+                                  side_effect=ran) as run, \
+                mock.patch.object(loadshedding, 'get_stage_subscriber',
+                                  return_value=subscriber), \
+                self.assertRaises(self.Stop):
+            loadshedding.daemon(
+                self.configuration_system, self.configuration_user,
+                logging.getLogger('test'), logging.getLogger('test_stage'))
+        return sleeps, [call.args[3] for call in run.call_args_list]
+
+    def test_errors(self):
+        """Tests that errors in the stage query and the evaluation are logged,
+        and that the daemon keeps the previous stage and sleeps until the
+        next poll
+        """
+        with self.assertLogs('test', 'ERROR') as logs:
+            sleeps, stages = self.run_daemon(
+                [KeyError('schedule_csv'), 4, KeyError('schedule_csv'), 0],
+                [RuntimeError('dialog'), False, False], 4)
+        self.assertEqual(len(logs.records), 3)
+        self.assertEqual(sleeps, [3600, 3600, 3600, 3600])
+        # The stage is kept after the failed query
+        self.assertEqual(stages, [4, 4, 0])
+
+    def test_subscription_error(self):
+        """Tests that the subscription is stopped if its response fails, and
+        that the stage is polled instead
+        """
+        subscriber = self.Subscriber(b'not a stage')
+        with self.assertLogs('test', 'WARNING') as logs:
+            sleeps, stages = self.run_daemon([4, 0], [False, False], 2,
+                                             subscriber)
+        self.assertTrue(subscriber.stopped)
+        self.assertIn('polling', '\n'.join(logs.output))
+        self.assertEqual(sleeps, [3600, 3600])
+        self.assertEqual(stages, [4, 0])
+
+        subscriber = self.Subscriber(b'5')
+        sleeps, stages = self.run_daemon([], [False], 1, subscriber)
+        self.assertFalse(subscriber.stopped)
+        self.assertEqual(stages, [4])
+
+    def test_sleep_until_window(self):
+        """Tests that the daemon sleeps until the next window, and checks
+        every minute while shedding
+        """
+        self.configuration_user = dict(
+            self.configuration_user, POLL_INTERVAL=6*3600)
+        sleeps, stages = self.run_daemon([4, 4], [False, True], 2)
+        # 01:00:10 until 05:43, the window less PAD_START
+        self.assertEqual(sleeps, [4*3600 + 42*60 + 50, 60])
+        self.assertEqual(stages, [4, 4])
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.configuration_system = {
+            'LOGRAN': os.path.join(self.directory.name, 'ran.log'),
+        }
+        self.configuration_user = {
+            'AREA': '8', 'PAD_START': 17, 'IGNORE_END': 30,
+            'RAN_CHECK': True, 'GUI_NOTIFICATION': False, 'CMD': 'true',
+            'SCHEDULE_CSV': 'schedules/load_shedding_city_power.csv',
+            'SCHEDULE_CACHE': False,
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def main(self, date_now, stage):
+        """Runs main at date_now, with the stage API returning stage
+
+        Returns:
+            [tuple(bool, int)]: What main returned, and the number of stage
+                queries
+        """
+        import logging
+        from unittest import mock
+        import loadshedding
+
+        with mock.patch.object(loadshedding, 'get_date_now',
+                               lambda: date_now), \
+                mock.patch.object(loadshedding, 'get_stage_current',
+                                  return_value=stage) as query:
+            ran = loadshedding.main(
+                self.configuration_system, self.configuration_user,
+                logging.getLogger('test'), logging.getLogger('test_stage'))
+        return ran, query.call_count
+
+    def test_fast_path(self):
+        """Tests that the stage is not queried if the area is not shed at
+        any stage, but the run is marked in the stage log, and is queried
+        otherwise
+        """
+        with self.assertLogs('test', 'INFO') as logs, \
+                self.assertLogs('test_stage', 'INFO') as logs_stage:
+            self.assertEqual(self.main(
+                datetime.datetime(2021, 3, 1, 1, 0), 8), (False, 0))
+        self.assertIn('stage not queried', '\n'.join(logs.output))
+        self.assertEqual([r.getMessage() for r in logs_stage.records],
+                         [lutils.lreplay.SKIPPED])
+
+        # Shed at stage 8, but not at stage 4
+        self.assertEqual(self.main(
+            datetime.datetime(2021, 3, 1, 9, 0), 4), (False, 1))
+
+
+class TestScheduleCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        import shutil
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'schedule.csv')
+        shutil.copy('schedules/load_shedding_city_power.csv', self.path)
+        self.builds = 0
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def build(self, path):
+        self.builds += 1
+        return compile_schedule(path)
+
+    def load(self):
+        return lutils.lcache.load(self.path, self.build, tag='test')
+
+    def test_rebuild_when_stale(self):
+        """Tests that the cache is only rebuilt if the csv contents changed
+        """
+        schedule = self.load()
+        self.assertTrue(os.path.exists(lutils.lcache.cache_path_for(
+            self.path)))
+        self.assertEqual(self.load().schedule.codes, schedule.schedule.codes)
+        self.assertEqual(self.builds, 1)
+
+        # Touched, but not changed
+        os.utime(self.path, ns=(0, 0))
+        self.load()
+        self.assertEqual(self.builds, 1)
+
+        with open(self.path, 'a') as f:
+            f.write('23:00;23:30;1' + ';99'*31 + '\n')
+        schedule = self.load()
+        self.assertEqual(self.builds, 2)
+        self.assertEqual(schedule.schedule.area(12, 1, 1), '99')
+
+    def test_corrupt_cache(self):
+        """Tests that a corrupt cache file is rebuilt
+        """
+        with open(lutils.lcache.cache_path_for(self.path), 'wb') as f:
+            f.write(b'not a cache')
+        self.assertEqual(len(self.load().schedule.slots), 12)
+        self.assertEqual(self.builds, 1)
+
+    def test_schedule_bytes(self):
+        """Tests that the schedule round-trips through its binary form, in
+        either byte order, and that a truncated one is rejected
+        """
+        import sys
+
+        schedule = lutils.lschedule.Schedule.from_csv(self.path)
+        data = schedule.to_bytes()
+        swapped = [lutils.lschedule.Schedule.from_bytes(data)]
+        other = b'b' if sys.byteorder == 'little' else b'l'
+        codes, rows = schedule.codes[:], schedule.rows[:]
+        codes.byteswap()
+        rows.byteswap()
+        n_arrays = len(codes) * 2 + len(rows) * 2
+        swapped.append(lutils.lschedule.Schedule.from_bytes(
+            other + data[1:-n_arrays] + codes.tobytes() + rows.tobytes()))
+        for loaded in swapped:
+            self.assertEqual(loaded.slots, schedule.slots)
+            self.assertEqual(loaded.areas, schedule.areas)
+            self.assertEqual(loaded.n_stages, schedule.n_stages)
+            self.assertEqual(loaded.codes, schedule.codes)
+            self.assertEqual(loaded.rows, schedule.rows)
+        with self.assertRaises(ValueError):
+            lutils.lschedule.Schedule.from_bytes(data[:-2])
+
+    def test_read_schedule_cached(self):
+        """Tests that the cached schedule evaluates like the compiled one,
+        is smaller than the csv, and loads faster than the csv is read
+        """
+        import timeit
+        import loadshedding
+
+        schedule = loadshedding.read_schedule(self.path)
+        cached = loadshedding.read_schedule(self.path)
+        self.assertLess(
+            os.path.getsize(lutils.lcache.cache_path_for(self.path)),
+            os.path.getsize(self.path))
+        configuration_user = {'AREA': '8', 'PAD_START': 17, 'IGNORE_END': 30}
+        date = datetime.datetime(2021, 7, 1)
+        for minute in range(0, 2*24*60, 7):
+            date_check = date + datetime.timedelta(minutes=minute)
+            self.assertEqual(
+                blocks_shedding(4, cached, configuration_user, date_check),
+                blocks_shedding(4, schedule, configuration_user, date_check))
+
+        time_cached = min(timeit.repeat(
+            lambda: loadshedding.read_schedule(self.path),
+            number=20, repeat=5))
+        time_csv = min(timeit.repeat(
+            lambda: lutils.lcsv.read_csv(
+                self.path, transforms={'stage': lambda x: int(x)},
+                delimiter=';'),
+            number=20, repeat=5))
+        self.assertLess(time_cached, time_csv)
+
+
+class TestSchedule(unittest.TestCase):
+    def test_matches_rows(self):
+        """Tests that the array-backed schedule holds the same areas as the
+        csv rows
+        """
+        for area in test_areas.keys():
+            path = test_areas[area]['configuration_user']['SCHEDULE_CSV']
+            rows = lutils.lcsv.read_csv(
+                path, transforms={'stage': lambda x: int(x)}, delimiter=';')
+            schedule = lutils.lschedule.Schedule.from_csv(path)
+
+            self.assertEqual(len(schedule.areas), 16)
+            for i, row in enumerate(rows):
+                slot = schedule.slots.index((row['start'], row['end']))
+                self.assertEqual(schedule.row(slot, row['stage']), i)
+                for day in range(1, 31 + 1):
+                    self.assertEqual(
+                        schedule.area(slot, row['stage'], day),
+                        row[str(day)])
+
+
+class TestFleet(unittest.TestCase):
+    def evaluate(self, use_numpy):
+        import random
+
+        random.seed(1)
+        schedules = [
+            compile_schedule(test_areas[area]['configuration_user']
+                             ['SCHEDULE_CSV'])
+            for area in test_areas.keys()
+        ]
+        entries = [
+            (random.choice(schedules), str(random.randint(1, 17)),
+             random.randint(0, 60), random.randint(0, 60))
+            for _ in range(256)
+        ]
+        for i in range(64):
+            stage = random.randint(0, 9)
+            datetime_test = datetime.datetime(2021, 1, 1) + \
+                datetime.timedelta(minutes=random.randrange(366*24*60))
+
+            status = lutils.lfleet.evaluate_fleet(
+                entries, stage, datetime_test, use_numpy=use_numpy)
+            expected = [
+                check_shedding(stage, schedule, {
+                    'AREA': area, 'PAD_START': pad_start,
+                    'IGNORE_END': ignore_end,
+                }, datetime_test)
+                for schedule, area, pad_start, ignore_end in entries
+            ]
+            with self.subTest(i=i):
+                self.assertEqual(status, expected)
+
+    def test_matches_check_shedding(self):
+        """Tests that the batch evaluation matches check_shedding per entry
+        """
+        self.evaluate(use_numpy=False)
+
+    def test_matches_check_shedding_numpy(self):
+        """Tests that the vectorized batch evaluation matches check_shedding
+        per entry
+        """
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            self.skipTest('NumPy is not installed')
+        self.evaluate(use_numpy=True)
+
+
+class TestStageTimeline(unittest.TestCase):
+    configuration_user = {'AREA': '8', 'PAD_START': 17, 'IGNORE_END': 30}
+    date_start = datetime.datetime(2021, 7, 13, 0, 0)
+
+    @staticmethod
+    def stage(date):
+        # Stage 4 from 10:00 to 14:00, 2 from 20:00 on, 0 otherwise
+        if 10 <= date.hour < 14:
+            return 4
+        if date.hour >= 20:
+            return 2
+        return 0
+
+    def timeline(self, key='key'):
+        return lutils.ltimeline.StageTimeline.from_function(
+            key, self.stage, self.date_start,
+            self.date_start + datetime.timedelta(days=2))
+
+    def test_lookup(self):
+        """Tests that only the stage changes are kept, and looked up
+        """
+        timeline = self.timeline()
+        self.assertEqual(timeline.stages, [0, 4, 0, 2, 0, 4, 0, 2])
+        for minute in range(0, 2*24*60, 7):
+            date = self.date_start + datetime.timedelta(minutes=minute)
+            self.assertEqual(timeline.stage(date), self.stage(date))
+        with self.assertRaises(ValueError):
+            timeline.stage(self.date_start - datetime.timedelta(minutes=1))
+
+    def test_store(self):
+        """Tests that a stored timeline is only loaded for the same key
+        """
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'stage_timeline.cache')
+            self.assertTrue(lutils.ltimeline.store(path, self.timeline()))
+            timeline = lutils.ltimeline.load(path, 'key')
+            self.assertEqual(timeline.times, self.timeline().times)
+            self.assertIsNone(lutils.ltimeline.load(path, 'other'))
+
+    def test_windows(self):
+        """Tests that the windows over the timeline cover exactly the
+        minutes for which the stage PAD_START minutes later is shed
+        """
+        schedule = compile_schedule('schedules/load_shedding_city_power.csv')
+        timeline = self.timeline()
+        pad_start = datetime.timedelta(
+            minutes=self.configuration_user['PAD_START'])
+        date_from = self.date_start + datetime.timedelta(hours=3)
+        windows = list(iterate_timeline_windows(
+            timeline, schedule, self.configuration_user, date_from))
+        self.assertTrue(windows)
+
+        date = date_from
+        while date + pad_start < timeline.end:
+            expected = check_shedding(
+                timeline.stage(date + pad_start), schedule,
+                self.configuration_user, date)
+            actual = any(start <= date <= end for start, end, _ in windows)
+            self.assertEqual(actual, expected, date)
+            date += datetime.timedelta(minutes=1)
+
+
+class TestExport(unittest.TestCase):
+    date_from = datetime.datetime(2021, 7, 30, 12, 0)
+    date_to = datetime.datetime(2021, 8, 2, 0, 0)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.schedule = compile_schedule(
+            'schedules/load_shedding_city_power.csv')
+
+    def events(self, areas, stage):
+        return list(lutils.lexport.merge_areas({
+            area: iterate_area_windows(
+                self.schedule, area, self.date_from, self.date_to,
+                stage=stage)
+            for area in areas
+        }))
+
+    def test_windows(self):
+        """Tests that the windows, with an exclusive end, cover the minutes
+        of the scheduled blocks, including past midnight
+        """
+        index = lutils.lbitmap.BitmapIndex(self.schedule)
+        for area in ('8', '12'):
+            events = self.events([area], 4)
+            shed = index.shed(area, self.date_from, self.date_to, 4)
+            date = self.date_from
+            while date < self.date_to:
+                actual = any(start <= date < end
+                             for _, start, end, _ in events)
+                self.assertEqual(actual, date in shed, (area, date))
+                date += datetime.timedelta(minutes=1)
+
+    def test_past_midnight(self):
+        """Tests that a block that runs past midnight is exported until it
+        ends, also from a range that starts after midnight
+        """
+        windows = list(iterate_area_windows(
+            self.schedule, '12', datetime.datetime(2021, 7, 1),
+            datetime.datetime(2021, 7, 3), stage=1))
+        self.assertEqual(windows, [(datetime.datetime(2021, 7, 1, 22, 0),
+                                    datetime.datetime(2021, 7, 2, 0, 30), 1)])
+
+        windows = list(iterate_area_windows(
+            self.schedule, '12', datetime.datetime(2021, 7, 2, 0, 10),
+            datetime.datetime(2021, 7, 3), stage=1))
+        self.assertEqual(windows, [(datetime.datetime(2021, 7, 2, 0, 10),
+                                    datetime.datetime(2021, 7, 2, 0, 30), 1)])
+
+    def test_merge_areas(self):
+        """Tests that the events of all areas are ordered by start, and
+        labelled with their area
+        """
+        areas = self.schedule.schedule.areas
+        events = self.events(areas, 2)
+        self.assertEqual(events, sorted(events, key=lambda e: (e[1], e[0])))
+        for area in areas:
+            self.assertEqual(
+                [event[1:] for event in events if event[0] == area],
+                list(iterate_area_windows(
+                    self.schedule, area, self.date_from, self.date_to,
+                    stage=2)))
+
+    def test_formats(self):
+        """Tests the iCalendar and JSON lines formats
+        """
+        import json
+
+        events = self.events(['8'], 4)
+        lines = list(lutils.lexport.export_lines(events, 'ical'))
+        self.assertEqual(lines[0], 'BEGIN:VCALENDAR\r\n')
+        self.assertEqual(lines[-1], 'END:VCALENDAR\r\n')
+        self.assertEqual(lines.count('BEGIN:VEVENT\r\n'), len(events))
+        # Times are in UTC
+        area, start, end, stage = events[0]
+        self.assertIn(
+            f'DTSTART:{(start - datetime.timedelta(hours=2)):%Y%m%dT%H%M%SZ}'
+            '\r\n', lines)
+
+        lines = list(lutils.lexport.export_lines(events, 'jsonl'))
+        self.assertEqual(json.loads(lines[0]), {
+            'area': area, 'start': start.isoformat() + '+02:00',
+            'end': end.isoformat() + '+02:00', 'stage': stage,
+        })
+
+
+class TestReplay(unittest.TestCase):
+    date_from = datetime.datetime(2021, 7, 29)
+    date_to = datetime.datetime(2021, 8, 1)
+    lines = [
+        '2021-07-29 00:00:00,101 - INFO - 0',
+        '2021-07-29 05:10:00,101 - INFO - 2',
+        '2021-07-29 05:20:00,101 - INFO - 2',
+        '2021-07-29 14:45:00,101 - INFO - 6',
+        '2021-07-30 01:00:00,101 - INFO - {"schedule": []}',
+        '2021-07-30 09:35:00,101 - INFO - 1',
+        '2021-07-30 21:50:00,101 - INFO - 8',
+        '2021-07-31 08:05:00,101 - INFO - 0',
+        '2021-07-31 16:00:00,101 - INFO - 4',
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.schedule = compile_schedule(
+            'schedules/load_shedding_city_power.csv')
+
+    def setUp(self):
+        try:
+            import numpy  # noqa: F401
+        except ImportError:
+            self.skipTest('NumPy is not installed')
+
+    def test_history(self):
+        """Tests that repeated stages and lines that are not a stage are
+        skipped
+        """
+        history = lutils.lreplay.StageHistory.from_lines(
+            reversed(self.lines))
+        self.assertEqual(list(history.stages), [0, 2, 6, 1, 8, 0, 4])
+        self.assertEqual(
+            lutils.lreplay.from_minute(history.start), self.date_from)
+
+        # A log of loadshedding_thingamabob mode, of skipped runs, or an
+        # empty one
+        for lines in ([self.lines[4]],
+                      ['2021-07-29 00:00:00,101 - INFO - skipped'], []):
+            with self.assertRaises(ValueError):
+                lutils.lreplay.StageHistory.from_lines(lines)
+
+    def test_skipped(self):
+        """Tests that the last stage is carried across the skipped runs,
+        until the last one
+        """
+        lines = self.lines[:4] + [
+            '2021-07-29 23:00:00,101 - INFO - skipped',
+            '2021-07-30 11:00:00,101 - INFO - skipped',
+        ]
+        history = lutils.lreplay.StageHistory.from_lines(lines)
+        self.assertEqual(list(history.stages), [0, 2, 6])
+        self.assertEqual(lutils.lreplay.from_minute(history.end),
+                         datetime.datetime(2021, 7, 30, 11, 1))
+
+    def test_schedules(self):
+        """Tests that the stage schedules logged in loadshedding_thingamabob
+        mode hold until the next line, with the stage of each minute
+        """
+        import json
+
+        calls = []
+
+        def build_timeline(response, date_from, date_to):
+            # {"schedule": [[hour, stage], ...]}, the stage from each hour
+            calls.append((date_from, date_to))
+            hours = json.loads(response)['schedule']
+            return lutils.ltimeline.StageTimeline.from_function(
+                response, lambda date: ([0] + [
+                    stage for hour, stage in hours if hour <= date.hour])[-1],
+                date_from, date_to)
+
+        lines = self.lines[:4] + [
+            '2021-07-30 01:00:00,101 - INFO - '
+            '{"schedule": [[0, 2], [6, 4], [8, 2]]}',
+            '2021-07-30 23:00:00,101 - INFO - {"schedule": [[0, 3]]}',
+        ] + self.lines[5:7]
+        history = lutils.lreplay.StageHistory.from_lines(
+            reversed(lines), build_timeline)
+        self.assertEqual(calls, [
+            (datetime.datetime(2021, 7, 30, 1, 0),
+             datetime.datetime(2021, 7, 30, 9, 35)),
+            (datetime.datetime(2021, 7, 30, 23, 0),
+             datetime.datetime(2021, 7, 30, 23, 1)),
+        ])
+        self.assertEqual(
+            [(lutils.lreplay.from_minute(m), s)
+             for m, s in zip(history.minutes, history.stages)][3:],
+            [(datetime.datetime(2021, 7, 30, 1, 0), 2),
+             (datetime.datetime(2021, 7, 30, 6, 0), 4),
+             (datetime.datetime(2021, 7, 30, 8, 0), 2),
+             (datetime.datetime(2021, 7, 30, 9, 35), 1),
+             (datetime.datetime(2021, 7, 30, 21, 50), 8),
+             (datetime.datetime(2021, 7, 30, 23, 0), 3)])
+        self.assertEqual(lutils.lreplay.from_minute(history.end),
+                         datetime.datetime(2021, 7, 30, 23, 1))
+
+        # Only stage schedules
+        history = lutils.lreplay.StageHistory.from_lines(
+            [lines[4]], build_timeline)
+        self.assertEqual(list(history.stages), [2])
+
+    def test_matches_check_shedding(self):
+        """Tests that the replay matches running check_shedding every minute,
+        and the outages the schedule blocks
+        """
+        index = lutils.lbitmap.BitmapIndex(self.schedule)
+        # The stage is raised at midnight, during blocks of the previous day
+        lines_midnight = [
+            '2021-07-29 00:00:00,101 - INFO - 0',
+            '2021-07-30 00:00:00,101 - INFO - 8',
+            '2021-07-30 00:20:00,101 - INFO - 0',
+            '2021-07-31 00:00:00,101 - INFO - 6',
+            '2021-07-31 05:00:00,101 - INFO - 0',
+        ]
+        for lines, area, pad_start, ignore_end in itertools.product(
+                (self.lines, lines_midnight), ('3', '8', '12'),
+                (0, 17), (0, 30, 90)):
+            with self.subTest(lines=lines[1], area=area, pad_start=pad_start,
+                              ignore_end=ignore_end):
+                history = lutils.lreplay.StageHistory.from_lines(lines)
+                result, = lutils.lreplay.replay(
+                    history, self.schedule, [area], [pad_start],
+                    [ignore_end], self.date_from, self.date_to)
+
+                shutdown, outage = [], []
+                stage = 0
+                stages = dict(zip(history.minutes, history.stages))
+                date = self.date_from
+                while date < self.date_to:
+                    stage = stages.get(lutils.lreplay.to_minute(date), stage)
+                    shutdown.append(check_shedding(
+                        stage, self.schedule,
+                        {'AREA': area, 'PAD_START': pad_start,
+                         'IGNORE_END': ignore_end}, date))
+                    # Until the blocks end, also past midnight
+                    outage.append(area in index.shed_at(date, stage))
+                    date += datetime.timedelta(minutes=1)
+
+                def starts(minutes):
+                    return [i for i, x in enumerate(minutes)
+                            if x and (i == 0 or not minutes[i - 1])]
+
+                self.assertEqual(result['executions'], len(starts(shutdown)))
+                self.assertEqual(result['outage_windows'], len(starts(outage)))
+                self.assertEqual(
+                    result['early_minutes'],
+                    sum(s and not o for s, o in zip(shutdown, outage)))
+                self.assertEqual(
+                    result['missed_windows'],
+                    sum(not shutdown[i] for i in starts(outage)))
+
+
+class TestBitmap(unittest.TestCase):
+    date_from = datetime.datetime(2021, 7, 30, 12, 7)
+    date_to = datetime.datetime(2021, 8, 1, 3, 0)
+
+    @classmethod
+    def setUpClass(cls):
+        cls.schedule = compile_schedule(
+            'schedules/load_shedding_city_power.csv')
+        cls.index = lutils.lbitmap.BitmapIndex(cls.schedule)
+
+    def test_shed(self):
+        """Tests that the bitmaps cover the scheduled blocks, including the
+        minutes of blocks of the previous day after midnight
+        """
+        for area in ('3', '8'):
+            for stage in (0, 2, 8):
+                bitmap = self.index.shed(area, self.date_from, self.date_to,
+                                         stage)
+                date = self.date_from
+                while date < self.date_to:
+                    now = date.hour*60 + date.minute
+                    expected = any(
+                        start <= now + offset < end and
+                        block_stage <= stage
+                        for day, offset in (
+                            (date, 0),
+                            (date - datetime.timedelta(days=1), 24*60))
+                        for start, end, block_stage, *_ in
+                        self.schedule.intervals(area, day.day))
+                    self.assertEqual(date in bitmap, expected, (area, date))
+                    date += datetime.timedelta(minutes=1)
+
+    def test_empty(self):
+        """Tests that the union of no bitmaps is empty, and the intersection
+        all minutes, if their minutes are given
+        """
+        start = datetime.datetime(2021, 7, 31, 0, 10)
+        union = lutils.lbitmap.union([], start, 90)
+        self.assertEqual((union.start, union.length, union.count()),
+                         (start, 90, 0))
+        intersection = lutils.lbitmap.intersection(iter([]), start, 90)
+        self.assertEqual(intersection, ~union)
+        self.assertEqual(intersection.count(), 90)
+        for function in (lutils.lbitmap.union, lutils.lbitmap.intersection):
+            with self.assertRaises(ValueError):
+                function([])
+            # Over other minutes
+            with self.assertRaises(ValueError):
+                function([union], start, 60)
+
+        powered = self.index.powered_all(
+            [], self.date_from, self.date_to, 4)
+        self.assertEqual(powered.count(), powered.length)
+        self.assertFalse(self.index.shed_any(
+            [], self.date_from, self.date_to, 4))
+
+    def test_queries(self):
+        """Tests the set operations, the run decoding and the areas shed at a
+        minute
+        """
+        areas = ['2', '6', '8']
+        powered = self.index.powered_all(areas, self.date_from, self.date_to,
+                                         4)
+        shed = [self.index.shed(area, self.date_from, self.date_to, 4)
+                for area in areas]
+        self.assertEqual(powered, ~lutils.lbitmap.union(shed))
+        self.assertEqual(powered, ~lutils.lbitmap.union(
+            shed, powered.start, powered.length))
+        self.assertEqual(lutils.lbitmap.intersection(shed),
+                         shed[0] & shed[1] & shed[2])
+        self.assertFalse(powered & shed[0])
+        self.assertEqual(powered.count() + (shed[0] | shed[1] | shed[2])
+                         .count(), powered.length)
+
+        windows = list(powered.windows())
+        self.assertTrue(windows)
+        for start, end in windows:
+            self.assertTrue(start < end)
+            self.assertIn(start, powered)
+            self.assertIn(end - datetime.timedelta(minutes=1), powered)
+            self.assertNotIn(end, powered)
+            self.assertNotIn(start - datetime.timedelta(minutes=1), powered)
+
+        date = datetime.datetime(2021, 7, 31, 0, 10)
+        self.assertEqual(
+            self.index.shed_at(date, 4),
+            [area for area in self.schedule.schedule.areas
+             if date in self.index.shed(
+                 area, date, date + datetime.timedelta(minutes=1), 4)])
+
+        with self.assertRaises(ValueError):
+            shed[0] & self.index.shed('2', self.date_from, self.date_to +
+                                      datetime.timedelta(days=1), 4)
+        with self.assertRaises(KeyError):
+            self.index.shed('0', self.date_from, self.date_to, 4)
+
+    def test_runs(self):
+        """Tests the run decoding of the bits
+        """
+        bitmap = lutils.lbitmap.MinuteBitmap(self.date_from, 12, 0b111011001)
+        self.assertEqual(list(bitmap.runs()), [(0, 1), (3, 5), (6, 9)])
+        self.assertEqual(list((~bitmap).runs()), [(1, 3), (5, 6), (9, 12)])
+        self.assertEqual(list(lutils.lbitmap.MinuteBitmap(
+            self.date_from, 12, -1).runs()), [(0, 12)])
+
+
+class TestValidate(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'schedule.csv')
+        with open('schedules/load_shedding_city_power.csv') as f:
+            self.lines = f.read().splitlines()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def validate(self, lines):
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return lutils.lvalidate.validate(self.path)
+
+    def replace_cell(self, lines, row, column, value):
+        cells = lines[row].split(';')
+        cells[column] = value
+        lines[row] = ';'.join(cells)
+
+    def test_shipped(self):
+        """Tests that the shipped schedules are valid
+        """
+        import glob
+
+        for path in glob.glob('schedules/*.csv'):
+            with self.subTest(path=path):
+                self.assertEqual(lutils.lvalidate.validate(path), [])
+
+    def test_violations(self):
+        """Tests that each kind of violation is reported
+        """
+        # Row 1 is 00:00 stage 1, row 2 00:00 stage 2
+        lines = list(self.lines)
+        self.replace_cell(lines, 0 + 2, 3, lines[1].split(';')[3])
+        violations = self.validate(lines)
+        self.assertEqual(len(violations), 1)
+        self.assertIn('day 1: stage 2 adds area', violations[0])
+
+        lines = list(self.lines)
+        self.replace_cell(lines, 1, 2 + 30, '')
+        violations = self.validate(lines)
+        self.assertEqual(len(violations), 1)
+        self.assertIn('stage 1: no area on days 30', violations[0])
+
+        lines = self.lines + [self.lines[1]]
+        self.assertIn('duplicate rows', self.validate(lines)[0])
+
+        lines = [self.lines[0]] + self.lines[2:]
+        self.assertIn('no row for stage 1', ' '.join(self.validate(lines)))
+
+        lines = list(self.lines)
+        self.replace_cell(lines, 1, 1, '25:30')
+        self.replace_cell(lines, 2, 2, 'one')
+        self.assertEqual(self.validate(lines), [
+            "Row 0: invalid end time '25:30'",
+            "Row 1: invalid stage 'one'",
+        ])
+
+
+class TestRanCheck(unittest.TestCase):
+    configuration_user = {
+        'AREA': '8', 'PAD_START': 17, 'IGNORE_END': 30,
+        'RAN_CHECK': True, 'GUI_NOTIFICATION': False, 'CMD': 'true',
+        'CMD_TIMEOUT': None, 'PRE_SHUTDOWN_HOOKS': [],
+        'PRE_SHUTDOWN_TIMEOUT': 30, 'PRE_SHUTDOWN_DEADLINE': 60,
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.schedule = compile_schedule(
+            'schedules/load_shedding_city_power.csv')
+
+    def setUp(self):
+        import logging
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.configuration_system = {
+            'LOGRAN': os.path.join(self.directory.name, 'ran.log'),
+        }
+        self.logger = logging.getLogger('test')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_shedding(self, stage, date_now):
+        return run_shedding(
+            self.configuration_system, self.configuration_user, self.logger,
+            stage, self.schedule, date_now)
+
+    def test_state(self):
+        """Tests that the state round-trips, and that the older
+        area;date;stage line is read
+        """
+        date = datetime.datetime(2021, 7, 13, 10, 0)
+        state = lutils.lstate.RanState(
+            '8', date, 4, {(1, '10:00', '12:30', 3, '8')})
+        self.assertEqual(lutils.lstate.RanState.loads(state.dumps()), state)
+        self.assertEqual(
+            lutils.lstate.RanState.loads(f'8;{date.isoformat()};4'),
+            lutils.lstate.RanState('8', date, 4))
+        with self.assertRaises(ValueError):
+            lutils.lstate.RanState.loads('{"area": "8"}')
+
+    def test_override(self):
+        """Tests that the command runs once per block, and the state is
+        cleared when not shedding
+        """
+        date_now = datetime.datetime(2021, 7, 13, 10, 0)
+        self.assertTrue(self.run_shedding(8, date_now))
+        state = lutils.lstate.StateStore(
+            self.configuration_system['LOGRAN']).read()
+        self.assertEqual(state.blocks, frozenset(blocks_shedding(
+            8, self.schedule, self.configuration_user, date_now)))
+
+        self.assertIsNone(self.run_shedding(
+            8, date_now + datetime.timedelta(minutes=1)))
+        self.assertFalse(self.run_shedding(0, date_now))
+        self.assertFalse(os.path.exists(self.configuration_system['LOGRAN']))
+        self.assertTrue(self.run_shedding(8, date_now))
+
+    def test_override_legacy(self):
+        """Tests that a state written by an older version still overrides
+        """
+        date_now = datetime.datetime(2021, 7, 13, 10, 0)
+        with open(self.configuration_system['LOGRAN'], 'w') as f:
+            f.write(f'8;{date_now.isoformat()};8')
+        self.assertIsNone(self.run_shedding(
+            8, date_now + datetime.timedelta(minutes=1)))
+
+    def test_concurrent(self):
+        """Tests that of concurrent runs, only one runs the command
+        """
+        import concurrent.futures
+
+        date_now = datetime.datetime(2021, 7, 13, 10, 0)
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            ran = list(executor.map(
+                lambda _: self.run_shedding(8, date_now), range(8)))
+        self.assertEqual(ran.count(True), 1)
+        self.assertEqual(ran.count(None), 7)
+
+
+class TestCommand(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'out')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_run_command(self):
+        """Tests the exit status, and that on timeout the command and the
+        processes it started are killed
+        """
+        result = lutils.lcommand.run_command('exit 3')
+        self.assertEqual(result.returncode, 3)
+        self.assertFalse(result.ok)
+        self.assertTrue(lutils.lcommand.run_command('true').ok)
+
+        result = lutils.lcommand.run_command(
+            f'(sleep 1; echo late > {self.path}) & sleep 10', timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertLess(result.seconds, 5)
+        time.sleep(1.5)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_run_hooks(self):
+        """Tests that the hooks run concurrently, each until its timeout or
+        the deadline
+        """
+        hooks = [
+            lutils.lcommand.Hook.from_configuration(hook, timeout=5)
+            for hook in ('sleep 0.5', {'cmd': 'sleep 0.5'},
+                         {'CMD': 'sleep 10', 'TIMEOUT': 0.2}, 'sleep 10')
+        ]
+        with self.assertRaises(ValueError):
+            lutils.lcommand.Hook.from_configuration({'TIMEOUT': 1})
+
+        results = lutils.lcommand.run_hooks(hooks, deadline=1)
+        self.assertEqual([r.ok for r in results], [True, True, False, False])
+        self.assertEqual([r.timed_out for r in results],
+                         [False, False, True, True])
+        self.assertLess(results[2].seconds, 1)
+        self.assertLess(max(r.seconds for r in results), 4)
+        self.assertEqual(lutils.lcommand.run_hooks([]), [])
+
+    def test_run_shedding(self):
+        """Tests that the hooks run before CMD, and CMD runs even if a hook
+        failed
+        """
+        import logging
+
+        schedule = compile_schedule('schedules/load_shedding_city_power.csv')
+        configuration_user = dict(
+            TestRanCheck.configuration_user,
+            RAN_CHECK=False,
+            CMD=f'echo cmd >> {self.path}',
+            PRE_SHUTDOWN_HOOKS=[f'echo hook >> {self.path}', 'exit 1'])
+        timings = lutils.ltiming.Timings(logging.getLogger('test'))
+        self.assertTrue(run_shedding(
+            {'LOGRAN': self.path + '.ran'}, configuration_user,
+            logging.getLogger('test'), 8, schedule,
+            datetime.datetime(2021, 7, 13, 10, 0), timings=timings))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'hook\ncmd\n')
+        self.assertIn('hooks', timings.phases)
+        self.assertIn('command', timings.phases)
+
+    def test_run_shedding_bad_hooks(self):
+        """Tests that CMD runs if the hooks cannot be started, e.g. with a
+        malformed TIMEOUT
+        """
+        import logging
+        from unittest import mock
+
+        import loadshedding
+
+        schedule = compile_schedule('schedules/load_shedding_city_power.csv')
+        configuration_user = dict(
+            TestRanCheck.configuration_user,
+            RAN_CHECK=False,
+            CMD=f'echo cmd >> {self.path}',
+            PRE_SHUTDOWN_HOOKS=[{'CMD': f'echo hook >> {self.path}',
+                                 'TIMEOUT': '30s'}])
+        with self.assertLogs('test', 'ERROR'):
+            self.assertTrue(run_shedding(
+                {'LOGRAN': self.path + '.ran'}, configuration_user,
+                logging.getLogger('test'), 8, schedule,
+                datetime.datetime(2021, 7, 13, 10, 0)))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'cmd\n')
+
+        configuration_user['PRE_SHUTDOWN_HOOKS'] = [
+            f'echo hook >> {self.path}']
+        with mock.patch.object(loadshedding, 'start_hooks',
+                               side_effect=TypeError('timeout')), \
+                self.assertLogs('test', 'ERROR') as logs:
+            self.assertTrue(loadshedding.run_shedding(
+                {'LOGRAN': self.path + '.ran'}, configuration_user,
+                logging.getLogger('test'), 8, schedule,
+                datetime.datetime(2021, 7, 13, 10, 0)))
+        self.assertIn('Skipping the pre-shutdown hooks',
+                      '\n'.join(logs.output))
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'cmd\ncmd\n')
+
+    def run_notification(self, hooks, dialog):
+        """Runs run_shedding with GUI_NOTIFICATION, dialog stands in for the
+        dialog and returns whether the user cancelled
+        """
+        import logging
+        from unittest import mock
+
+        import loadshedding
+
+        schedule = compile_schedule('schedules/load_shedding_city_power.csv')
+        configuration_user = dict(
+            TestRanCheck.configuration_user,
+            RAN_CHECK=False, GUI_NOTIFICATION=True,
+            PRE_SHUTDOWN_WITH_NOTIFICATION=True,
+            CMD=f'echo cmd >> {self.path}', PRE_SHUTDOWN_HOOKS=hooks)
+        timings = lutils.ltiming.Timings(logging.getLogger('test'))
+        with mock.patch.object(loadshedding, 'get_override_status',
+                               side_effect=lambda *_: (dialog(), 'test')):
+            self.assertTrue(run_shedding(
+                {'LOGRAN': self.path + '.ran', 'NOTIFICATION_TIMEOUT': 1},
+                configuration_user, logging.getLogger('test'), 8, schedule,
+                datetime.datetime(2021, 7, 13, 10, 0), timings=timings))
+        return timings
+
+    def test_hooks_during_notification(self):
+        """Tests that the hooks run while the dialog is shown, so that CMD
+        runs right after it
+        """
+        def dialog():
+            # The hook finishes while the dialog is shown
+            deadline = time.monotonic() + 5
+            while not os.path.exists(self.path):
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.05)
+            time.sleep(0.6)
+            return False
+
+        timings = self.run_notification(
+            [f'echo hook >> {self.path}; sleep 0.5'], dialog)
+        with open(self.path) as f:
+            self.assertEqual(f.read(), 'hook\ncmd\n')
+        self.assertLess(timings.phases['hooks'], 0.3)
+
+    def test_hooks_cancelled(self):
+        """Tests that cancelling the dialog kills the hooks, and CMD does not
+        run
+        """
+        time_start = time.monotonic()
+        self.run_notification(
+            [f'sleep 10; echo hook >> {self.path}'], lambda: True)
+        self.assertLess(time.monotonic() - time_start, 5)
+        time.sleep(0.2)
+        self.assertFalse(os.path.exists(self.path))
+
+        hook_run = lutils.lcommand.HookRun(
+            [lutils.lcommand.Hook('sleep 10')])
+        hook_run.cancel()
+        result, = hook_run.wait()
+        self.assertTrue(result.cancelled)
+        self.assertFalse(result.ok)
+
+
+class TestTimings(unittest.TestCase):
+    class Logger():
+        def __init__(self):
+            self.messages = []
+
+        def info(self, message):
+            self.messages.append(message)
+
+    def test_disabled(self):
+        """Tests that disabled timings record and emit nothing
+        """
+        timings = lutils.ltiming.Timings()
+        with timings.phase('evaluation'):
+            pass
+        timings.emit()
+        self.assertFalse(timings.enabled)
+        self.assertEqual(timings.phases, {})
+
+    def test_run_shedding(self):
+        """Tests that the phases of run_shedding are recorded, summed when
+        entered more than once, and emitted as a JSON line
+        """
+        import json
+        import logging
+        import tempfile
+
+        logger = self.Logger()
+        timings = lutils.ltiming.Timings(logger=logger)
+        schedule = compile_schedule('schedules/load_shedding_city_power.csv')
+        configuration_user = TestRanCheck.configuration_user
+        date_now = datetime.datetime(2021, 7, 13, 10, 0)
+        with tempfile.TemporaryDirectory() as directory:
+            configuration_system = {
+                'LOGRAN': os.path.join(directory, 'ran.log'),
+            }
+            for stage in (8, 0):
+                run_shedding(
+                    configuration_system, configuration_user,
+                    logging.getLogger('test'), stage, schedule, date_now,
+                    timings=timings)
+        timings.emit(ran=True)
+
+        self.assertEqual(
+            list(timings.phases),
+            ['evaluation', 'ran_check', 'command'])
+        self.assertEqual(len(logger.messages), 1)
+        event = json.loads(logger.messages[0])
+        self.assertEqual(event['ran'], True)
+        self.assertEqual(set(event['phases']), set(timings.phases))
+        self.assertGreaterEqual(event['total'],
+                                sum(event['phases'].values()))
+
+
+class TestStartup(unittest.TestCase):
+    # Modules that are only needed on some paths, and must not be imported
+    # by `import loadshedding`
+    LAZY_MODULES = (
+        'yaml', 'urllib.request', 'asyncio', 'json', 'zoneinfo', 'csv',
+        'logging.handlers',
+    )
+    # Regression threshold for the cumulative import time of loadshedding,
+    # in microseconds. About 3x the time on a desktop, to leave room for slow
+    # machines
+    IMPORT_TIME_THRESHOLD = 100000
+
+    def importtime(self):
+        """Imports loadshedding in a fresh interpreter with -X importtime
+
+        Returns:
+            [dict]: Cumulative import time in microseconds, per module
+        """
+        import subprocess
+        import sys
+
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import loadshedding'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True)
+        times = {}
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            times[name.strip()] = int(cumulative)
+        return times
+
+    def test_import_time(self):
+        """Tests that importing loadshedding stays below the threshold, and
+        does not import the modules that are only needed on some paths
+        """
+        times = min((self.importtime() for _ in range(3)),
+                    key=lambda times: times['loadshedding'])
+        report = '\n'.join(
+            f'{t:>10} us {name}' for name, t in
+            sorted(times.items(), key=lambda item: -item[1])[:10])
+
+        for module in self.LAZY_MODULES:
+            self.assertNotIn(module, times, report)
+        self.assertLess(times['loadshedding'], self.IMPORT_TIME_THRESHOLD,
+                        report)
+
+
 if __name__ == '__main__':
     unittest.main()
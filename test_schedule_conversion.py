@@ -0,0 +1,134 @@
+"""Unit Tests for converting schedule workbooks to the schedule csv format
+"""
+
+import datetime
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'schedules'))
+import schedule_workbook_conversion  # noqa: E402
+
+# Days d and d + 16 in two header rows, as in the Cape Town workbook
+header = [
+    ('Start', 'End', 1, 2),
+    (None, None, 17, 18),
+]
+
+
+class TestWorkbookConversion(unittest.TestCase):
+    def expected(self, areas):
+        """The schedule rows, areas[slot][stage - 1] holds the areas of the
+        columns of days 1 and 17, and of days 2 and 18
+        """
+        slots = [('00:00:00', '02:30:00'), ('02:00:00', '04:30:00')]
+        rows = [['start', 'end', 'stage'] + list(range(1, 31 + 1))]
+        for (start, end), areas_slot in zip(slots, areas):
+            for stage, (area_a, area_b) in enumerate(areas_slot, start=1):
+                row = [start, end, stage] + [''] * 31
+                row[2 + 1] = row[2 + 17] = area_a
+                row[2 + 2] = row[2 + 18] = area_b
+                rows.append(row)
+        return rows
+
+    def test_cumulative(self):
+        """Tests that the cells of a cumulative workbook, listing all areas
+        shed up to the stage, are converted to the area added per stage, for
+        the days of both header rows
+        """
+        sheets = [
+            header + [('00:00', '02:30', 1, 5), ('02:00', '04:30', 2, 6)],
+            header + [('00:00', '02:30', '1, 9', '5,13'),
+                      ('02:00', '04:30', '2, 10', '14, 6'),
+                      ('Notes', 'not a time row')],
+        ]
+        self.assertEqual(
+            schedule_workbook_conversion.convert_sheets(sheets),
+            self.expected([[('1', '5'), ('9', '13')],
+                           [('2', '6'), ('10', '14')]]))
+
+    def test_incremental(self):
+        """Tests that the cells of an incremental workbook, listing only the
+        area added at the stage, are kept
+        """
+        sheets = [
+            header + [('00:00', '02:30', 1, 5), ('02:00', '04:30', 2, 6)],
+            header + [('00:00', '02:30', 9, 13), ('02:00', '04:30', 10, 14)],
+        ]
+        self.assertEqual(
+            schedule_workbook_conversion.convert_sheets(
+                sheets, cumulative=False),
+            self.expected([[('1', '5'), ('9', '13')],
+                           [('2', '6'), ('10', '14')]]))
+
+    def test_times(self):
+        """Tests that the time intervals are inferred from times, datetimes,
+        fractions of a day and strings
+        """
+        sheets = [header + [
+            (datetime.time(0, 0), 0.10416666666666667, 1, 5),
+            (datetime.datetime(2021, 7, 1, 2, 0), '4:30:00', 2, 6),
+        ]]
+        rows = schedule_workbook_conversion.convert_sheets(sheets)
+        self.assertEqual([tuple(row[:2]) for row in rows[1:]],
+                         [('00:00:00', '02:30:00'), ('02:00:00', '04:30:00')])
+
+        for value in ('Start', '25', None, 1.5, 3):
+            self.assertIsNone(schedule_workbook_conversion.parse_time(value))
+
+    def test_errors(self):
+        """Tests that inconsistent worksheets, cells that do not add exactly
+        one area, and worksheets without a header row are rejected
+        """
+        stage_1 = header + [('00:00', '02:30', 1, 5),
+                            ('02:00', '04:30', 2, 6)]
+        for sheets, cumulative in (
+                # No area added at stage 2
+                ([stage_1, stage_1], True),
+                # Two areas added at stage 2
+                ([stage_1, header + [('00:00', '02:30', '1, 9, 3', '5, 13'),
+                                     ('02:00', '04:30', '2, 10', '6, 14')]],
+                 True),
+                ([stage_1, header + [('00:00', '02:30', 9, 13),
+                                     ('02:00', '04:30', '10, 3', 14)]],
+                 False),
+                # An empty cell
+                ([header + [('00:00', '02:30', 1, None),
+                            ('02:00', '04:30', 2, 6)]], True),
+                # A time interval missing at stage 2
+                ([stage_1, header + [('00:00', '02:30', '1, 9', '5, 13')]],
+                 True),
+                # No header row, or no time rows
+                ([[('00:00', '02:30', 1, 5)]], True),
+                ([header], True)):
+            with self.subTest(sheets=sheets, cumulative=cumulative):
+                with self.assertRaises(ValueError):
+                    schedule_workbook_conversion.convert_sheets(
+                        sheets, cumulative=cumulative)
+
+    def test_cape_town(self):
+        """Tests that the shipped Cape Town workbook converts to the shipped
+        csv
+        """
+        try:
+            import openpyxl  # noqa: F401
+        except ImportError:
+            self.skipTest('openpyxl is not installed')
+
+        rows = schedule_workbook_conversion.convert_sheets(
+            schedule_workbook_conversion.read_workbook(
+                'schedules/schedule_intermediate_city_of_cape_town.xlsx'),
+            cumulative=True)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'schedule.csv')
+            schedule_workbook_conversion.write_csv(path, rows)
+            with open(path) as f:
+                converted = f.read()
+        with open('schedules/load_shedding_city_of_cape_town.csv') as f:
+            self.assertEqual(converted, f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,787 @@
+"""Unit Tests for querying the loadshedding stage, against local stand-in
+HTTP servers
+"""
+
+import datetime
+import http.server
+import logging
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import loadshedding
+import lutils.lhttp
+import lutils.lretry
+import lutils.ltimeline
+
+
+class StageServer():
+    """A local stand-in for the stage API, serving body, in a thread
+
+    Args:
+        body (bytes): The response body
+        headers (dict): Extra response headers
+    """
+
+    def __init__(self, body: bytes = b'1', headers: dict = {}):
+        self.body = body
+        self.headers = dict(headers)
+        self.status = 200
+        self.delay = 0
+        self.requests = []
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append(dict(self.headers))
+                time.sleep(server.delay)
+                if server.status != 200:
+                    self.send_error(server.status)
+                    return
+                etag = server.headers.get('ETag')
+                if etag is not None and \
+                        self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                for k, v in server.headers.items():
+                    self.send_header(k, v)
+                self.send_header('Content-Length', str(len(server.body)))
+                self.end_headers()
+                self.wfile.write(server.body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/'
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       kwargs={'poll_interval': 0.05},
+                                       daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.server = StageServer(b'3', {'ETag': '"v1"'})
+
+    def tearDown(self):
+        self.server.close()
+        self.directory.cleanup()
+
+    def cache(self, ttl=0, stale_if_error=0):
+        return lutils.lhttp.HttpCache(
+            os.path.join(self.directory.name, 'cache'), ttl=ttl,
+            stale_if_error=stale_if_error)
+
+    def test_fresh(self):
+        """Tests that a fresh response is reused without a request
+        """
+        cache = self.cache(ttl=60)
+        self.assertEqual(cache.fetch(self.server.url), (b'3', 'fetched'))
+        self.assertEqual(cache.fetch(self.server.url), (b'3', 'fresh'))
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_max_age(self):
+        """Tests that Cache-Control max-age and no-cache shorten the TTL
+        """
+        self.server.headers['Cache-Control'] = 'no-cache'
+        cache = self.cache(ttl=60)
+        cache.fetch(self.server.url)
+        self.assertEqual(cache.fetch(self.server.url), (b'3', 'revalidated'))
+
+        self.server.headers['Cache-Control'] = 'public, max-age=0'
+        cache = self.cache(ttl=60)
+        cache.fetch(self.server.url)
+        self.assertEqual(cache.fetch(self.server.url), (b'3', 'revalidated'))
+
+    def test_revalidate(self):
+        """Tests that a stale response is revalidated with If-None-Match
+        """
+        cache = self.cache()
+        cache.fetch(self.server.url)
+        self.assertEqual(cache.fetch(self.server.url), (b'3', 'revalidated'))
+        self.assertEqual(self.server.requests[1].get('If-None-Match'),
+                         '"v1"')
+
+        self.server.body = b'4'
+        self.server.headers['ETag'] = '"v2"'
+        self.assertEqual(cache.fetch(self.server.url), (b'4', 'fetched'))
+
+    def test_stale_if_error(self):
+        """Tests that the cached response is used if the request fails, or
+        the response is invalid
+        """
+        def validate(body):
+            if int(body) < 0:
+                raise ValueError(body)
+
+        cache = self.cache(stale_if_error=60)
+        cache.fetch(self.server.url, validate=validate)
+
+        self.server.status = 503
+        self.assertEqual(cache.fetch(self.server.url), (b'3', 'stale'))
+
+        self.server.status = 200
+        self.server.body = b'-1'
+        self.server.headers.pop('ETag')
+        self.assertEqual(cache.fetch(self.server.url, validate=validate),
+                         (b'3', 'stale'))
+
+        # Too old
+        cache = self.cache(stale_if_error=-1)
+        with self.assertRaises(ValueError):
+            cache.fetch(self.server.url, validate=validate)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def policy(self, **kwargs):
+        policy = lutils.lretry.RetryPolicy(**kwargs)
+        policy.sleeps = []
+        policy.sleep = policy.sleeps.append
+        return policy
+
+    def test_backoff(self):
+        """Tests that the backoff grows exponentially up to the maximum, with
+        jitter
+        """
+        policy = self.policy(attempts=6, backoff_initial=1, backoff_max=5,
+                             jitter=0)
+
+        def fail(timeout):
+            raise OSError('unreachable')
+
+        with self.assertRaises(lutils.lretry.RetryError):
+            policy.call(fail)
+        self.assertEqual(policy.sleeps, [1, 2, 4, 5, 5])
+
+        policy = self.policy(attempts=3, jitter=0.5)
+        policy.random = lambda: 1
+        with self.assertRaises(lutils.lretry.RetryError):
+            policy.call(fail)
+        self.assertEqual(policy.sleeps, [0.5, 1])
+
+    def test_success(self):
+        """Tests that the result of the first successful attempt is returned
+        """
+        policy = self.policy(attempts=5, attempt_timeout=3)
+        timeouts = []
+        errors = []
+
+        def flaky(timeout):
+            timeouts.append(timeout)
+            if len(timeouts) < 3:
+                raise ValueError('Invalid negative stage! -1')
+            return 2
+
+        self.assertEqual(policy.call(flaky, on_error=errors.append), 2)
+        self.assertEqual(len(errors), 2)
+        self.assertTrue(all(0 < t <= 3 for t in timeouts))
+
+    def test_not_retryable(self):
+        """Tests that client errors are not retried
+        """
+        server = StageServer()
+        server.status = 404
+        try:
+            policy = self.policy()
+            with self.assertRaises(lutils.lretry.RetryError):
+                policy.call(lambda timeout: lutils.lhttp.fetch(
+                    server.url, timeout=timeout))
+            self.assertEqual(len(server.requests), 1)
+        finally:
+            server.close()
+
+    def test_deadline(self):
+        """Tests that no attempt is started, and no backoff is waited, past
+        the deadline
+        """
+        policy = lutils.lretry.RetryPolicy(
+            deadline=0.3, attempts=100, backoff_initial=0.05, jitter=0)
+        attempts = []
+
+        def slow(timeout):
+            attempts.append(timeout)
+            time.sleep(0.1)
+            raise OSError('timeout')
+
+        time_start = time.monotonic()
+        with self.assertRaises(lutils.lretry.RetryError):
+            policy.call(slow)
+        self.assertLess(time.monotonic() - time_start, 0.4)
+        self.assertLess(len(attempts), 4)
+
+    def test_cancel(self):
+        """Tests that a cancelled call stops retrying, without waiting for
+        the backoff
+        """
+        policy = lutils.lretry.RetryPolicy(
+            attempts=10, backoff_initial=10, jitter=0)
+        cancel = threading.Event()
+        attempts = []
+
+        def fail(timeout):
+            attempts.append(timeout)
+            cancel.set()
+            raise OSError('unreachable')
+
+        time_start = time.monotonic()
+        with self.assertRaises(lutils.lretry.RetryCancelled):
+            policy.call(fail, cancel=cancel)
+        self.assertLess(time.monotonic() - time_start, 1)
+        self.assertEqual(len(attempts), 1)
+
+
+class TestGetStage(unittest.TestCase):
+    def setUp(self):
+        loadshedding.logger = logging.getLogger('test')
+        loadshedding.logger_stage = logging.getLogger('test_stage')
+        self.server = StageServer()
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_negative_stage_retried(self):
+        """Tests that the negative stages returned by the API are retried, up
+        to the policy's attempts
+        """
+        self.server.body = b'-1'
+        policy = lutils.lretry.RetryPolicy(attempts=3, backoff_initial=0)
+        with self.assertRaises(loadshedding.StageQueryError):
+            loadshedding.get_stage_direct(
+                self.server.url, retry_policy=policy)
+        self.assertEqual(len(self.server.requests), 3)
+
+        self.server.body = b'5'
+        self.assertEqual(loadshedding.get_stage_direct(
+            self.server.url, retry_policy=policy), 4)
+
+
+class TestStageProxy(unittest.TestCase):
+    def setUp(self):
+        loadshedding.logger = logging.getLogger('test')
+        loadshedding.logger_stage = logging.getLogger('test_stage')
+        self.server = StageServer(b'3')
+        self.proxy = None
+
+    def tearDown(self):
+        if self.proxy is not None:
+            self.proxy.shutdown()
+            self.proxy.server_close()
+        self.server.close()
+
+    def serve(self, query_mode='DIRECT', ttl=60):
+        """Serves the proxy of self.server, returns its URL"""
+        import lutils.lproxy
+
+        configuration_user = {
+            'API_URL': self.server.url, 'QUERY_MODE': query_mode,
+            'HTTP_CACHE': None, 'RETRY': {'ATTEMPTS': 1},
+        }
+        self.flight = loadshedding.get_stage_proxy(
+            configuration_user, ttl, loadshedding.logger)
+        self.proxy = lutils.lproxy.make_server(self.flight, 0)
+        threading.Thread(target=self.proxy.serve_forever,
+                         kwargs={'poll_interval': 0.05}, daemon=True).start()
+        return f'http://127.0.0.1:{self.proxy.server_address[1]}/'
+
+    def test_coalesce(self):
+        """Tests that concurrent requests result in one upstream request, and
+        the response is reused for the TTL
+        """
+        url = self.serve()
+        self.server.delay = 0.3
+        stages = []
+
+        def query():
+            stages.append(loadshedding.get_stage_direct(url))
+
+        threads = [threading.Thread(target=query) for _ in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(stages, [2] * 20)
+        self.assertEqual(len(self.server.requests), 1)
+
+        self.server.delay = 0
+        self.assertEqual(loadshedding.get_stage_direct(url), 2)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_ttl(self):
+        """Tests that the response is requested again once the TTL expired
+        """
+        url = self.serve(ttl=0)
+        for _ in range(3):
+            self.assertEqual(loadshedding.get_stage_direct(url), 2)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_schedule(self):
+        """Tests that the loadshedding_thingamabob response is passed on
+        """
+        body = b'{"schedule_csv": "a,b"}'
+        self.server.body = body
+        url = self.serve('LOADSHEDDING_THINGAMABOB')
+        self.assertEqual(loadshedding.get_stage_schedule(url), body.decode())
+
+    def test_errors(self):
+        """Tests that invalid and failed upstream responses are not served,
+        nor reused
+        """
+        url = self.serve()
+        policy = lutils.lretry.RetryPolicy(attempts=1)
+        for body, status in ((b'0', 200), (b'3', 503)):
+            self.server.body = body
+            self.server.status = status
+            with self.assertRaises(loadshedding.StageQueryError):
+                loadshedding.get_stage_direct(url, retry_policy=policy)
+
+        self.server.status = 200
+        self.assertEqual(loadshedding.get_stage_direct(url), 2)
+        self.assertEqual(self.flight.fetches, 3)
+
+    def test_interrupted(self):
+        """Tests that the waiters are released if the fetch is interrupted,
+        and that the next request fetches again
+        """
+        import lutils.lproxy
+
+        started, release = threading.Event(), threading.Event()
+        results = []
+
+        def fetch():
+            if not results:
+                started.set()
+                release.wait(5)
+                raise KeyboardInterrupt()
+            return b'3'
+
+        flight = lutils.lproxy.SingleFlight(fetch, 60)
+
+        def interrupted():
+            try:
+                flight.get()
+            except KeyboardInterrupt as e:
+                results.append(e)
+
+        def waiter():
+            try:
+                flight.get()
+            except RuntimeError as e:
+                results.append(e)
+
+        threads = [threading.Thread(target=interrupted, daemon=True)]
+        threads[0].start()
+        started.wait(5)
+        threads.append(threading.Thread(target=waiter, daemon=True))
+        threads[1].start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+        self.assertEqual(sorted(type(e).__name__ for e in results),
+                         ['KeyboardInterrupt', 'RuntimeError'])
+        self.assertEqual(flight.get(), (b'3', 0.0))
+        self.assertEqual(flight.fetches, 2)
+
+
+class PushServer():
+    """A local stand-in for a stage API that pushes changes, with server-sent
+    events (Accept: text/event-stream) and long-polling (If-None-Match and
+    Prefer: wait), in a thread
+
+    Args:
+        body (bytes): The initial response body
+    """
+
+    def __init__(self, body: bytes = b'1'):
+        self.body = body
+        self.version = 1
+        self.requests = 0
+        self.changed = threading.Condition()
+        self.closing = False
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests += 1
+                if self.headers.get('Accept') == 'text/event-stream':
+                    self.events()
+                else:
+                    self.long_poll()
+
+            def events(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.end_headers()
+                version = None
+                with server.changed:
+                    while not server.closing:
+                        if version != server.version:
+                            version = server.version
+                            self.wfile.write(
+                                b'data: ' + server.body + b'\n\n')
+                        else:
+                            self.wfile.write(b': keep-alive\n')
+                        self.wfile.flush()
+                        server.changed.wait(0.5)
+
+            def long_poll(self):
+                wait = int(self.headers.get('Prefer', 'wait=0')[5:])
+                etag = self.headers.get('If-None-Match')
+                with server.changed:
+                    server.changed.wait_for(
+                        lambda: etag != f'"{server.version}"' or
+                        server.closing, wait)
+                    if etag == f'"{server.version}"':
+                        self.send_response(304)
+                        self.end_headers()
+                        return
+                    body = server.body
+                    self.send_response(200)
+                    self.send_header('ETag', f'"{server.version}"')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_address[1]}/'
+        threading.Thread(target=self.httpd.serve_forever,
+                         kwargs={'poll_interval': 0.05}, daemon=True).start()
+
+    def publish(self, body: bytes):
+        with self.changed:
+            self.body = body
+            self.version += 1
+            self.changed.notify_all()
+
+    def close(self):
+        with self.changed:
+            self.closing = True
+            self.changed.notify_all()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class TestSubscribe(unittest.TestCase):
+    def setUp(self):
+        loadshedding.logger = logging.getLogger('test')
+        self.server = PushServer(b'3')
+        self.subscriber = None
+
+    def tearDown(self):
+        if self.subscriber is not None:
+            self.subscriber.stop()
+        self.server.close()
+
+    def subscribe(self, mode, url=None):
+        configuration_user = {
+            'API_URL': url or self.server.url, 'QUERY_MODE': 'DIRECT',
+            'STAGE_SOURCES': [], 'STAGE_SUBSCRIBE': mode,
+            'STAGE_SUBSCRIBE_WAIT': 5,
+        }
+        self.subscriber = loadshedding.get_stage_subscriber(
+            configuration_user, loadshedding.logger)
+        return configuration_user
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            self.subscriber.wait(deadline - time.monotonic())
+
+    def check_push(self, mode):
+        configuration_user = self.subscribe(mode)
+        date_now = datetime.datetime(2021, 7, 13)
+        self.wait_for(lambda: self.subscriber.connected)
+        self.assertEqual(loadshedding.get_stage_response(
+            self.subscriber.body, configuration_user, date_now), 2)
+
+        # Invalid responses are skipped
+        for body in (b'0', b'5'):
+            self.server.publish(body)
+        self.wait_for(lambda: self.subscriber.body == b'5')
+        self.assertEqual(loadshedding.get_stage_response(
+            self.subscriber.body, configuration_user, date_now), 4)
+        self.assertTrue(self.subscriber.connected)
+
+    def test_sse(self):
+        """Tests that the stage changes are received as server-sent events,
+        over one request
+        """
+        self.check_push('SSE')
+        self.assertEqual(self.server.requests, 1)
+
+    def test_long_poll(self):
+        """Tests that the stage changes are received by long-polling, with a
+        request per change
+        """
+        self.check_push('LONG_POLL')
+        self.assertLessEqual(self.server.requests, 4)
+
+    def test_unsupported(self):
+        """Tests that the subscriber stops if the API does not push changes,
+        so that the daemon polls instead
+        """
+        stage_server = StageServer(b'3')
+        try:
+            for mode in ('SSE', 'LONG_POLL'):
+                self.subscribe(mode, stage_server.url)
+                self.wait_for(lambda: self.subscriber.stopped)
+                self.assertFalse(self.subscriber.connected)
+        finally:
+            stage_server.close()
+        for mode in (None, 'WEBSOCKET'):
+            self.subscribe(mode)
+            self.assertIsNone(self.subscriber)
+
+    def test_reconnect(self):
+        """Tests that the subscription is reopened after the API failed
+        """
+        import lutils.lsubscribe
+
+        attempts = []
+
+        def subscribe():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConnectionResetError()
+            yield b'3'
+
+        self.subscriber = lutils.lsubscribe.Subscriber(
+            subscribe, backoff_initial=0.01).start()
+        self.wait_for(lambda: self.subscriber.body == b'3')
+        self.assertEqual(len(attempts), 2)
+
+    def test_read_events(self):
+        """Tests the parsing of a server-sent events stream
+        """
+        import lutils.lsubscribe
+
+        lines = [b': keep-alive\r\n', b'event: stage\r\n', b'data: 1\r\n',
+                 b'data:2\r\n', b'id: 7\r\n', b'\r\n', b'\n',
+                 b'data: 3\n', b'\n', b'data: 4\n']
+        self.assertEqual(
+            list(lutils.lsubscribe.read_events(lines)),
+            [('stage', '1\n2', '7'), ('message', '3', '7')])
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        loadshedding.logger = logging.getLogger('test')
+        loadshedding.logger_stage = logging.getLogger('test_stage')
+        loadshedding.metrics = loadshedding.Metrics()
+        self.metrics_server = loadshedding.metrics.serve(0)
+        self.server = StageServer(b'3')
+
+    def tearDown(self):
+        loadshedding.metrics = None
+        self.metrics_server.shutdown()
+        self.metrics_server.server_close()
+        self.server.close()
+
+    def scrape(self):
+        import urllib.request
+
+        port = self.metrics_server.server_address[1]
+        with urllib.request.urlopen(
+                f'http://127.0.0.1:{port}/metrics', timeout=5) as response:
+            return response.read().decode()
+
+    def test_fetch(self):
+        """Tests that the fetch latency and errors are recorded, and exposed
+        in the Prometheus text format
+        """
+        metrics = loadshedding.metrics
+        loadshedding.get_stage_direct(self.server.url)
+        self.server.status = 503
+        policy = lutils.lretry.RetryPolicy(attempts=2, backoff_initial=0)
+        with self.assertRaises(loadshedding.StageQueryError):
+            loadshedding.get_stage_direct(
+                self.server.url, retry_policy=policy)
+
+        self.assertEqual(
+            metrics.fetch_seconds.count(api_url=self.server.url), 3)
+        self.assertEqual(
+            metrics.fetch_errors.value(api_url=self.server.url), 2)
+
+        text = self.scrape()
+        self.assertIn(
+            '# TYPE loadshedding_stage_fetch_duration_seconds histogram',
+            text)
+        self.assertIn(
+            'loadshedding_stage_fetch_duration_seconds_bucket{'
+            f'api_url="{self.server.url}",le="+Inf"}} 3', text)
+        self.assertIn(
+            'loadshedding_stage_fetch_errors_total{'
+            f'api_url="{self.server.url}"}} 2.0', text)
+
+    def test_evaluation(self):
+        """Tests that check_shedding records its duration
+        """
+        schedule = loadshedding.compile_schedule(
+            'schedules/load_shedding_city_power.csv')
+        configuration_user = {'AREA': '8', 'PAD_START': 17, 'IGNORE_END': 30}
+        loadshedding.check_shedding(
+            4, schedule, configuration_user, datetime.datetime(2021, 7, 13))
+        loadshedding.metrics.stage.set(4)
+
+        self.assertEqual(loadshedding.metrics.evaluation_seconds.count(), 1)
+        text = self.scrape()
+        self.assertIn('loadshedding_evaluation_duration_seconds_count 1', text)
+        self.assertIn('loadshedding_stage 4', text)
+
+
+class TestStageTimelineQuery(unittest.TestCase):
+    def setUp(self):
+        loadshedding.logger = logging.getLogger('test')
+        self.directory = tempfile.TemporaryDirectory()
+        self.configuration_user = {
+            'PAD_START': 17,
+            'STAGE_TIMELINE': os.path.join(self.directory.name,
+                                           'stage_timeline.cache'),
+            'STAGE_TIMELINE_DAYS': 1,
+        }
+        self.builds = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def build(self, response, key, date_from, days):
+        # Stands in for loadshedding_thingamabob, the stage is the response
+        self.builds.append(response)
+        return lutils.ltimeline.StageTimeline.from_function(
+            key, lambda date: int(response), date_from,
+            date_from + datetime.timedelta(days=days))
+
+    def test_cached(self):
+        """Tests that the timeline is only rebuilt when the stage schedule
+        changes, or the timeline runs out
+        """
+        from unittest import mock
+
+        date_now = datetime.datetime(2021, 7, 13, 10, 0)
+        with mock.patch.object(loadshedding, 'build_stage_timeline',
+                               self.build):
+            for response, minutes in (
+                    ('3', 0), ('3', 60), ('4', 60), ('4', 2*24*60)):
+                timeline = loadshedding.get_stage_timeline(
+                    response, self.configuration_user,
+                    date_now + datetime.timedelta(minutes=minutes))
+                self.assertEqual(timeline.stages, [int(response)])
+        self.assertEqual(self.builds, ['3', '4', '4'])
+
+    def test_per_source(self):
+        """Tests that the STAGE_SOURCES each keep their own timeline, instead
+        of rebuilding it when another source answered first
+        """
+        from unittest import mock
+
+        date_now = datetime.datetime(2021, 7, 13, 10, 0)
+        with mock.patch.object(loadshedding, 'build_stage_timeline',
+                               self.build):
+            for _ in range(2):
+                for source, response in (('http://a/', '3'),
+                                         ('http://b/', '4')):
+                    timeline = loadshedding.get_stage_timeline(
+                        response, self.configuration_user, date_now,
+                        source=source)
+                    self.assertEqual(timeline.stages, [int(response)])
+        self.assertEqual(self.builds, ['3', '4'])
+        self.assertEqual(len(os.listdir(self.directory.name)), 2)
+
+
+class TestHedgedStage(unittest.TestCase):
+    def setUp(self):
+        loadshedding.logger = logging.getLogger('test')
+        loadshedding.logger_stage = logging.getLogger('test_stage')
+        self.servers = [StageServer(b'3'), StageServer(b'3'),
+                        StageServer(b'5')]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.close()
+
+    def configuration_user(self, quorum=1):
+        return {
+            'STAGE_SOURCES': [
+                {'API_URL': server.url, 'QUERY_MODE': 'DIRECT'}
+                for server in self.servers
+            ],
+            'STAGE_QUORUM': quorum,
+            'HTTP_CACHE': None,
+            'RETRY': {'DEADLINE': 5, 'ATTEMPTS': 1},
+        }
+
+    def test_first_answer(self):
+        """Tests that the fastest source is used, without waiting for the
+        slow ones
+        """
+        self.servers[0].delay = 2
+        self.servers[1].delay = 2
+        time_start = time.monotonic()
+        stage = loadshedding.get_stage_current(
+            self.configuration_user(), datetime.datetime.now())
+        self.assertEqual(stage, 4)
+        self.assertLess(time.monotonic() - time_start, 1)
+
+    def test_quorum(self):
+        """Tests that the stage two sources agree on is used, and that
+        failing sources are tolerated
+        """
+        self.servers[1].delay = 0.2
+        stage = loadshedding.get_stage_current(
+            self.configuration_user(quorum=2), datetime.datetime.now())
+        self.assertEqual(stage, 2)
+
+        self.servers[1].status = 503
+        with self.assertRaises(loadshedding.StageQueryError):
+            loadshedding.get_stage_current(
+                self.configuration_user(quorum=2), datetime.datetime.now())
+
+    def test_log_once(self):
+        """Tests that only the answer used is logged to LOGSTAGE, and that
+        the sources that are still retrying stop
+        """
+        self.servers[0].status = 503
+        self.servers[1].delay = 0.3
+        configuration_user = self.configuration_user()
+        configuration_user['RETRY'] = {
+            'DEADLINE': 5, 'ATTEMPTS': 20, 'BACKOFF_INITIAL': 0.1,
+            'BACKOFF_MAX': 0.1, 'JITTER': 0,
+        }
+        with self.assertLogs('test_stage', 'INFO') as logs:
+            stage = loadshedding.get_stage_current(
+                configuration_user, datetime.datetime.now())
+            # Until the slow source answered
+            time.sleep(0.5)
+        self.assertEqual(stage, 4)
+        self.assertEqual(logs.output, ['INFO:test_stage:4'])
+
+        requests = len(self.servers[0].requests)
+        time.sleep(0.3)
+        self.assertEqual(len(self.servers[0].requests), requests)
+
+
+if __name__ == '__main__':
+    unittest.main()